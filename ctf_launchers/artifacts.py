@@ -0,0 +1,89 @@
+import hashlib
+import os
+import subprocess
+import tempfile
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+from filelock import FileLock
+
+
+ARTIFACTS_DIR = Path(os.getenv('ARTIFACTS_DIR', '/artifacts'))
+ARTIFACTS_OUT = ARTIFACTS_DIR / 'out'
+ARTIFACTS_CACHE = ARTIFACTS_DIR / 'cache'
+# Fingerprint of the sources the artifacts were built from
+ARTIFACTS_FINGERPRINT = ARTIFACTS_DIR / 'fingerprint'
+
+# On images built without precompile the first deploy compiles the project, these make every other launcher process
+# in the container wait for it instead of compiling into the same artifacts at the same time
+COMPILE_LOCK = Path(tempfile.gettempdir()) / 'paradigmctf-compile.lock'
+COMPILED_AT_RUNTIME = Path(tempfile.gettempdir()) / 'paradigmctf-compiled'
+
+FORGE_PATH = '/opt/huff/bin:/opt/foundry/bin:/usr/bin:' + os.getenv('PATH', '/fake')
+
+# Build outputs and vendored dependencies (which can be huge), they do not describe the project itself
+IGNORED_PROJECT_DIRS = {'.git', 'broadcast', 'cache', 'out', 'lib'}
+
+
+class CompilationError(Exception):
+    """Custom exception for project compilation errors."""
+
+
+def get_project_fingerprint(project_location: str) -> str:
+    digest = hashlib.sha256()
+    root = Path(project_location)
+    for path in sorted(root.rglob('*')):
+        relative = path.relative_to(root)
+        if not path.is_file() or IGNORED_PROJECT_DIRS.intersection(relative.parts):
+            continue
+
+        digest.update(str(relative).encode())
+        digest.update(hashlib.sha256(path.read_bytes()).digest())
+    return digest.hexdigest()
+
+
+def get_compiled_fingerprint() -> str | None:
+    """Returns the fingerprint recorded when the image was built, None for images built without precompile."""
+    if not ARTIFACTS_FINGERPRINT.exists():
+        return None
+    return ARTIFACTS_FINGERPRINT.read_text()
+
+
+def compile_project(project_location: str) -> None:
+    """Builds the project into the shared artifacts directory and records the fingerprint of its sources."""
+    fingerprint = get_project_fingerprint(project_location)
+    proc = subprocess.run(
+        args=[
+            '/opt/foundry/bin/forge',
+            'build',
+            '--out',
+            str(ARTIFACTS_OUT),
+            '--cache-path',
+            str(ARTIFACTS_CACHE),
+        ],
+        env={'PATH': FORGE_PATH},
+        cwd=project_location,
+        text=True,
+        encoding='utf8',
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        check=False,
+    )
+    if proc.returncode != 0:
+        msg = f'forge failed to build: {proc.stdout!r}, {proc.stderr!r}'
+        raise CompilationError(msg)
+
+    ARTIFACTS_FINGERPRINT.write_text(fingerprint)
+
+
+@contextmanager
+def compile_guard() -> Iterator[None]:
+    """Serializes the deploys of images built without precompile until one of them compiled the project."""
+    if get_compiled_fingerprint() is not None or COMPILED_AT_RUNTIME.exists():
+        yield
+        return
+
+    with FileLock(COMPILE_LOCK):
+        yield
+        COMPILED_AT_RUNTIME.touch()
@@ -10,6 +10,12 @@ from ctf_server.types import UserData
 ORCHESTRATOR = os.getenv('ORCHESTRATOR_HOST', 'http://orchestrator:7283')
 INSTANCE_ID = os.getenv('INSTANCE_ID')
 
+# The orchestrator sends keepalives well within this, so a silent stream means the connection is gone
+EVENTS_READ_TIMEOUT = 60
+EVENTS_RECONNECT_DELAY = 1
+# Events after which the instance might have what we are waiting for, `subscribed` comes first on every connection
+READINESS_EVENTS = {'event: subscribed', 'event: ready', 'event: metadata-updated'}
+
 
 class DaemonError(Exception):
     """Custom exception for Daemon errors."""
@@ -22,20 +28,41 @@ class Daemon(abc.ABC):
         self.__required_properties = required_properties
 
     def start(self) -> None:
-        while True:
-            instance_body = requests.get(f'{ORCHESTRATOR}/instances/{INSTANCE_ID}', timeout=5).json()
-            if not instance_body['ok']:
-                msg = f'oops: {instance_body}'
-                raise DaemonError(msg)
+        self._run(self.__wait_for_instance())
 
-            user_data = instance_body['data']
-            if any(v not in user_data['metadata'] for v in self.__required_properties):
-                time.sleep(1)
-                continue
+    def __wait_for_instance(self) -> UserData:
+        """Waits on the orchestrator's event stream until the instance has every required metadata key."""
+        while True:
+            try:
+                with requests.get(
+                    f'{ORCHESTRATOR}/events',
+                    params={'instance_id': INSTANCE_ID},
+                    stream=True,
+                    timeout=(5, EVENTS_READ_TIMEOUT),
+                ) as resp:
+                    resp.raise_for_status()
+                    for line in resp.iter_lines(decode_unicode=True):
+                        if line in {'event: expiring', 'event: killed'}:
+                            msg = 'instance went away before it was ready'
+                            raise DaemonError(msg)
+                        if line in READINESS_EVENTS and (user_data := self.__get_ready_instance()) is not None:
+                            return user_data
+            except requests.RequestException:
+                # fall back to polling while the stream is unavailable
+                if (user_data := self.__get_ready_instance()) is not None:
+                    return user_data
+                time.sleep(EVENTS_RECONNECT_DELAY)
 
-            break
+    def __get_ready_instance(self) -> UserData | None:
+        instance_body = requests.get(f'{ORCHESTRATOR}/instances/{INSTANCE_ID}', timeout=5).json()
+        if not instance_body['ok']:
+            msg = f'oops: {instance_body}'
+            raise DaemonError(msg)
 
-        self._run(user_data)
+        user_data: UserData = instance_body['data']
+        if any(v not in user_data['metadata'] for v in self.__required_properties):
+            return None
+        return user_data
 
     @staticmethod
     def update_metadata(new_metadata: dict[str, str]) -> None:
@@ -1,14 +1,23 @@
 import os
+import signal
 import subprocess
+from collections.abc import Callable
+from contextlib import ExitStack
 from json import loads
 
 from web3 import Web3
 
+from ctf_server.tracing import tracer
 from foundry.anvil import anvil_auto_impersonate_account
 
+from .artifacts import ARTIFACTS_CACHE, ARTIFACTS_OUT, FORGE_PATH, compile_guard
+from .governor import deploy_slot
 from .types import ChallengeContract
 
 
+DEPLOY_TIMEOUT = int(os.getenv('DEPLOY_TIMEOUT', '120'))
+
+
 class DeployerError(Exception):
     """Custom exception for deployer errors."""
 
@@ -26,57 +35,90 @@ def _deserialize_deploy_response(response: str) -> list[ChallengeContract]:
     return result
 
 
-def deploy(
+def _run_forge_script(
+    web3: Web3,
+    project_location: str,
+    mnemonic: str,
+    deploy_script: str,
+    env: dict,
+) -> str:
+    rfd, wfd = os.pipe2(os.O_NONBLOCK)  # type: ignore[attr-defined]
+    try:
+        proc = subprocess.Popen(
+            args=[
+                '/opt/foundry/bin/forge',
+                'script',
+                '--rpc-url',
+                web3.provider.endpoint_uri,  # type: ignore[attr-defined]
+                '--out',
+                str(ARTIFACTS_OUT),
+                '--cache-path',
+                str(ARTIFACTS_CACHE),
+                '--broadcast',
+                '--unlocked',
+                '--sender',
+                '0x0000000000000000000000000000000000000000',
+                deploy_script,
+            ],
+            env={
+                'PATH': FORGE_PATH,
+                'MNEMONIC': mnemonic,
+                'OUTPUT_FILE': f'/proc/self/fd/{wfd}',
+            }
+            | env,
+            pass_fds=[wfd],
+            cwd=project_location,
+            text=True,
+            encoding='utf8',
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            # own process group, so that a timeout also kills whatever forge has spawned (e.g. huffc)
+            start_new_session=True,
+        )
+        try:
+            stdout, stderr = proc.communicate(timeout=DEPLOY_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.communicate()
+            msg = f'forge did not finish within {DEPLOY_TIMEOUT} seconds'
+            raise DeployerError(msg) from None
+
+        if proc.returncode != 0:
+            msg = f'forge failed to run: {stdout!r}, {stderr!r}'
+            raise DeployerError(msg)
+
+        return os.read(rfd, 1024).decode('utf8')
+    finally:
+        os.close(rfd)
+        os.close(wfd)
+
+
+def deploy(  # noqa: PLR0913
     web3: Web3,
     project_location: str,
     mnemonic: str,
     deploy_script: str = 'script/Deploy.s.sol:Deploy',
     env: dict | None = None,
+    on_queued: Callable[[int], object] | None = None,
 ) -> list[ChallengeContract]:
+    """Runs the deploy script against `web3`, waiting for a free deploy slot first (see `deploy_slot`)."""
     if env is None:
         env = {}
-    anvil_auto_impersonate_account(web3, enabled=True)
 
-    rfd, wfd = os.pipe2(os.O_NONBLOCK)  # type: ignore[attr-defined]
-    proc = subprocess.Popen(
-        args=[
-            '/opt/foundry/bin/forge',
-            'script',
-            '--rpc-url',
-            web3.provider.endpoint_uri,  # type: ignore[attr-defined]
-            '--out',
-            '/artifacts/out',
-            '--cache-path',
-            '/artifacts/cache',
-            '--broadcast',
-            '--unlocked',
-            '--sender',
-            '0x0000000000000000000000000000000000000000',
-            deploy_script,
-        ],
-        env={
-            'PATH': '/opt/huff/bin:/opt/foundry/bin:/usr/bin:' + os.getenv('PATH', '/fake'),
-            'MNEMONIC': mnemonic,
-            'OUTPUT_FILE': f'/proc/self/fd/{wfd}',
-        }
-        | env,
-        pass_fds=[wfd],
-        cwd=project_location,
-        text=True,
-        encoding='utf8',
-        stdin=subprocess.DEVNULL,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    stdout, stderr = proc.communicate()
-
-    anvil_auto_impersonate_account(web3, enabled=False)
-    if proc.returncode != 0:
-        msg = f'forge failed to run: {stdout!r}, {stderr!r}'
-        raise DeployerError(msg)
-
-    result = os.read(rfd, 1024).decode('utf8')
-
-    os.close(rfd)
-    os.close(wfd)
+    with tracer.span('deploy', script=deploy_script), ExitStack() as stack:
+        # a no-op unless the image was built without precompile and nobody compiled the project yet
+        with tracer.span('deploy.compile_guard'):
+            stack.enter_context(compile_guard())
+
+        with tracer.span('deploy.queue'):
+            stack.enter_context(deploy_slot(on_queued))
+
+        with tracer.span('deploy.forge_script'):
+            anvil_auto_impersonate_account(web3, enabled=True)
+            try:
+                result = _run_forge_script(web3, project_location, mnemonic, deploy_script, env)
+            finally:
+                anvil_auto_impersonate_account(web3, enabled=False)
+
     return _deserialize_deploy_response(result)
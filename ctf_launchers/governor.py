@@ -0,0 +1,85 @@
+import os
+import tempfile
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+from filelock import FileLock, Timeout
+
+
+# Forge deploys that may run at the same time in this container, every launcher process shares these slots
+DEPLOY_MAX_CONCURRENT = int(os.getenv('DEPLOY_MAX_CONCURRENT', str(os.cpu_count() or 1)))
+DEPLOY_GOVERNOR_DIR = Path(os.getenv('DEPLOY_GOVERNOR_DIR', Path(tempfile.gettempdir()) / 'paradigmctf-deploys'))
+DEPLOY_QUEUE_POLL_INTERVAL = 0.5
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _get_queue_position(queue_dir: Path, ticket: Path) -> int:
+    """Returns the amount of live tickets ahead of ours, dropping the ones left behind by killed launchers."""
+    position = 0
+    for other in sorted(queue_dir.iterdir()):
+        if other.name >= ticket.name:
+            break
+
+        if not _is_alive(int(other.name.rsplit('-', 1)[1])):
+            other.unlink(missing_ok=True)
+            continue
+
+        position += 1
+    return position
+
+
+def _try_acquire_slot() -> FileLock | None:
+    for i in range(DEPLOY_MAX_CONCURRENT):
+        slot = FileLock(DEPLOY_GOVERNOR_DIR / f'slot-{i}.lock')
+        try:
+            slot.acquire(timeout=0)
+        except Timeout:
+            continue
+        return slot
+    return None
+
+
+@contextmanager
+def deploy_slot(on_queued: Callable[[int], object] | None = None) -> Iterator[None]:
+    """Waits in a FIFO queue until one of the deploy slots of this container is free, and holds it.
+
+    Slots are file locks, so they are released by the kernel even if the launcher holding them gets killed.
+    `on_queued` is called with our position every time it changes while we wait.
+    """
+    queue_dir = DEPLOY_GOVERNOR_DIR / 'queue'
+    queue_dir.mkdir(parents=True, exist_ok=True)
+
+    ticket = queue_dir / f'{time.time_ns():020d}-{os.getpid()}'
+    ticket.touch()
+
+    slot = None
+    try:
+        last_position = None
+        while True:
+            position = _get_queue_position(queue_dir, ticket)
+            # the ones ahead of us get the first pick, but there might be more free slots than waiters
+            if position < DEPLOY_MAX_CONCURRENT and (slot := _try_acquire_slot()) is not None:
+                break
+
+            if on_queued is not None and position != last_position:
+                on_queued(position + 1)
+            last_position = position
+            time.sleep(DEPLOY_QUEUE_POLL_INTERVAL)
+
+        ticket.unlink(missing_ok=True)
+        yield
+    finally:
+        ticket.unlink(missing_ok=True)
+        if slot is not None:
+            slot.release()
@@ -3,15 +3,17 @@ import sys
 import traceback
 from collections.abc import Callable
 from dataclasses import dataclass
-from time import time
+from time import sleep, time
 
 import requests
-from eth_account.hdaccount import generate_mnemonic
+from eth_account.hdaccount import Language, generate_mnemonic
 
 from ctf_launchers.deployer import deploy
+from ctf_launchers.snapshot import deploy_from_snapshot
 from ctf_launchers.team_provider import TeamProvider
 from ctf_launchers.types import ChallengeContract
 from ctf_launchers.utils import http_url_to_ws
+from ctf_server.tracing import tracer
 from ctf_server.types import (
     DEFAULT_MNEMONIC,
     CreateInstanceRequest,
@@ -31,6 +33,16 @@ PUBLIC_WEBSOCKET_HOST = http_url_to_ws(PUBLIC_HOST)
 ETH_RPC_URL = os.getenv('ETH_RPC_URL')
 TIMEOUT = int(os.getenv('TIMEOUT', '1440'))
 
+# How often we check on our place in the orchestrator's launch queue, must be well below its queue ttl
+LAUNCH_QUEUE_POLL_INTERVAL = 3
+# A request for an instance that is already being launched is held by the orchestrator for up to LAUNCH_LOCK_WAIT
+# seconds (same variable as the orchestrator's), so we wait for that plus the time a launch of our own may take
+LAUNCH_LOCK_WAIT = float(os.getenv('LAUNCH_LOCK_WAIT', '600'))
+LAUNCH_TIMEOUT = LAUNCH_LOCK_WAIT + 60
+# How long and how often we wait for someone else's launch of our instance to finish deploying the challenge
+ATTACH_TIMEOUT = 300
+ATTACH_POLL_INTERVAL = 2
+
 
 @dataclass
 class Action:
@@ -43,6 +55,10 @@ class NonSensitiveError(Exception):
 
 
 class Launcher:
+    # Deploy once into a reference anvil and load the resulting state into every new instance instead of running forge,
+    # only valid for challenges whose deployment does not depend on the team (i.e. on the mnemonic)
+    use_deployment_snapshot = False
+
     def __init__(self, project_location: str, provider: TeamProvider, actions: list[Action] | None = None) -> None:
         if actions is None:
             actions = []
@@ -55,9 +71,11 @@ class Launcher:
         self._actions.append(Action(name='launch new instance', handler=self.launch_instance))
         self._actions.append(Action(name='instance info', handler=self.instance_info))
         self._actions.append(Action(name='kill instance', handler=self.kill_instance))
-        self._actions = [*self._actions, *actions]
+        # appended last so that the numbering of the challenge-specific actions does not change
+        self._actions = [*self._actions, *actions, Action(name='reset instance', handler=self.reset_instance)]
 
     def run(self) -> None:
+        tracer.setup('launcher')
         self.team = self.__team_provider.get_team()
         if not self.team:
             sys.exit(1)
@@ -66,7 +84,7 @@ class Launcher:
             print(f'{i + 1} - {action.name}')
 
         # TODO(es3n1n, 20.07.25): generate only when needed
-        self.mnemonic = generate_mnemonic(12, lang='english')
+        self.mnemonic = generate_mnemonic(12, lang=Language.ENGLISH)
 
         try:
             handler = self._actions[int(input('action? ')) - 1]
@@ -110,6 +128,7 @@ class Launcher:
         resp = requests.post(
             f'{ORCHESTRATOR_HOST}/instances/{self.get_instance_id()}/metadata',
             json=new_metadata,
+            headers=tracer.get_headers(),
             timeout=60,
         )
         body = resp.json()
@@ -118,33 +137,83 @@ class Launcher:
         return None
 
     def launch_instance(self) -> int:
+        with tracer.span('launcher.launch_instance', challenge=CHALLENGE, team=self.team):
+            return self._launch_instance()
+
+    def _launch_instance(self) -> int:
         print('creating private blockchain...')
-        body = requests.post(
-            f'{ORCHESTRATOR_HOST}/instances',
-            json=CreateInstanceRequest(
-                instance_id=self.get_instance_id(),
-                timeout=TIMEOUT,
-                anvil_instances=self.get_anvil_instances(),
-                daemon_instances=self.get_daemon_instances(),
-            ),
-            timeout=60,
-        ).json()
+        request = CreateInstanceRequest(
+            instance_id=self.get_instance_id(),
+            timeout=TIMEOUT,
+            team=self.team,
+            challenge=CHALLENGE,
+            anvil_instances=self.get_anvil_instances(),
+            daemon_instances=self.get_daemon_instances(),
+        )
+        with tracer.span('launcher.create_instance'):
+            while True:
+                body = requests.post(
+                    f'{ORCHESTRATOR_HOST}/instances', json=request, headers=tracer.get_headers(), timeout=LAUNCH_TIMEOUT
+                ).json()
+                if 'queue' not in body:
+                    break
+
+                queue = body['queue']
+                request['ticket'] = body['ticket']
+                print(
+                    f'waiting for a free slot (position {queue["position"]}, ~{queue["estimated_wait"]:.0f}s)...',
+                    flush=True,
+                )
+                sleep(LAUNCH_QUEUE_POLL_INTERVAL)
+
         if not body['ok']:
             raise NonSensitiveError(body['message'])
 
         user_data = body['data']
+        if body.get('attached'):
+            return self._wait_for_deployment()
 
         print('deploying challenge...')
-        challenge_contracts = self.deploy(user_data, self.mnemonic)
+        with tracer.span('launcher.deploy', snapshot=self.use_deployment_snapshot):
+            challenge_contracts = self.deploy(user_data, self.mnemonic)
 
         if x := self.update_metadata({'mnemonic': self.mnemonic, 'challenge_contracts': challenge_contracts}):
             print('unable to update metadata')
             return x
 
+        # lets the players reset the instance later on without redeploying
+        with tracer.span('launcher.snapshot'):
+            resp = requests.post(
+                f'{ORCHESTRATOR_HOST}/instances/{self.get_instance_id()}/snapshot',
+                headers=tracer.get_headers(),
+                timeout=60,
+            )
+        if not resp.json()['ok']:
+            print('unable to snapshot the instance, it will not be resettable')
+
         print('your private blockchain has been set up!')
         self._print_instance_info(user_data, self.mnemonic, challenge_contracts)
         return 0
 
+    def _wait_for_deployment(self) -> int:
+        # the instance was launched by another request of the same team (e.g. a second connection), which also deploys
+        print('the instance is already being launched, waiting for the challenge to be deployed...', flush=True)
+        deadline = time() + ATTACH_TIMEOUT
+        while True:
+            body = requests.get(f'{ORCHESTRATOR_HOST}/instances/{self.get_instance_id()}', timeout=5).json()
+            if not body['ok']:
+                raise NonSensitiveError(body['message'])
+            if 'challenge_contracts' in body['data']['metadata']:
+                break
+            if time() > deadline:
+                msg = 'the challenge is still being deployed, check the instance info again later'
+                raise NonSensitiveError(msg)
+            sleep(ATTACH_POLL_INTERVAL)
+
+        print('your private blockchain has been set up!')
+        self._print_instance_info(body['data'])
+        return 0
+
     def instance_info(self) -> int:
         body = requests.get(f'{ORCHESTRATOR_HOST}/instances/{self.get_instance_id()}', timeout=5).json()
         if not body['ok']:
@@ -160,10 +229,34 @@ class Launcher:
         print(body.get('message', 'no message'))
         return 0
 
+    def reset_instance(self) -> int:
+        print('resetting instance to its freshly deployed state...')
+        resp = requests.post(f'{ORCHESTRATOR_HOST}/instances/{self.get_instance_id()}/reset', timeout=90)
+        body = resp.json()
+        if not body['ok']:
+            raise NonSensitiveError(body['message'])
+
+        print(body['message'])
+        return 0
+
     def deploy(self, user_data: UserData, mnemonic: str) -> list[ChallengeContract]:
         web3 = get_privileged_web3(user_data, 'main')
 
-        return deploy(web3, self.project_location, mnemonic, env=self.get_deployment_args(user_data))
+        if self.use_deployment_snapshot:
+            return deploy_from_snapshot(
+                web3,
+                self.project_location,
+                self.get_anvil_instances()['main'],
+                env=self.get_deployment_args(user_data),
+            )
+
+        return deploy(
+            web3,
+            self.project_location,
+            mnemonic,
+            env=self.get_deployment_args(user_data),
+            on_queued=lambda position: print(f'waiting for a free deployer (position {position})...', flush=True),
+        )
 
     def get_deployment_args(self, _: UserData) -> dict[str, str]:
         # This method can be overridden to provide additional deployment arguments
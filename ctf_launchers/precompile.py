@@ -0,0 +1,18 @@
+import sys
+from pathlib import Path
+
+from ctf_launchers.artifacts import compile_project
+
+
+def main() -> None:
+    # Meant to be run while building the challenge image: python -m ctf_launchers.precompile /challenge/project
+    if len(sys.argv) != 2:  # noqa: PLR2004
+        print(f'usage: {sys.argv[0]} <project directory>', file=sys.stderr)
+        sys.exit(2)
+
+    compile_project(str(Path(sys.argv[1]).resolve()))
+    print('project compiled')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import socket
+import subprocess
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TypedDict
+
+from eth_account.hdaccount import Language, generate_mnemonic
+from filelock import FileLock
+from web3 import Web3
+
+from ctf_launchers.artifacts import get_compiled_fingerprint, get_project_fingerprint
+from ctf_launchers.deployer import deploy
+from ctf_launchers.types import ChallengeContract
+from ctf_server.types import (
+    DEFAULT_ACCOUNTS,
+    DEFAULT_BALANCE,
+    DEFAULT_MNEMONIC,
+    LaunchAnvilInstanceArgs,
+    format_anvil_args,
+    get_account,
+)
+from foundry.anvil import anvil_dump_state, anvil_load_state, anvil_set_balance
+
+
+SNAPSHOT_DIR = Path(os.getenv('SNAPSHOT_DIR', '/tmp/paradigmctf-snapshots'))  # noqa: S108
+REFERENCE_ANVIL_STARTUP_TIMEOUT = 30
+# Bumped whenever the way snapshots are produced changes, so that stale ones are never loaded again
+SNAPSHOT_VERSION = 2
+
+# Anvil arguments that do not change the deployed state
+IGNORED_ANVIL_ARGS = {
+    'image',
+    'mnemonic',
+    'extra_allowed_methods',
+    'profile',
+    'cpus',
+    'memory',
+    'persistence',
+    'state_interval',
+}
+
+
+class SnapshotError(Exception):
+    """Custom exception for deployment snapshot errors."""
+
+
+class DeploymentSnapshot(TypedDict):
+    state: str
+    contracts: list[ChallengeContract]
+
+
+def get_snapshot_key(
+    project_location: str, anvil_args: LaunchAnvilInstanceArgs, deploy_script: str, env: dict[str, str]
+) -> str:
+    key_material = {
+        'version': SNAPSHOT_VERSION,
+        # hashing the sources is only needed for images that were built without precompile
+        'project': get_compiled_fingerprint() or get_project_fingerprint(project_location),
+        'anvil': {k: v for k, v in anvil_args.items() if k not in IGNORED_ANVIL_ARGS},
+        'script': deploy_script,
+        'env': env,
+    }
+    return hashlib.sha256(json.dumps(key_material, sort_keys=True).encode()).hexdigest()
+
+
+@contextmanager
+def reference_anvil(anvil_args: LaunchAnvilInstanceArgs, mnemonic: str) -> Iterator[Web3]:
+    """Runs a throwaway local anvil configured like `anvil_args`, with the accounts of `mnemonic` funded."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    proc = subprocess.Popen(
+        args=[
+            '/opt/foundry/bin/anvil',
+            *format_anvil_args({**anvil_args, 'persistence': 'off'}, 'reference', port, host='127.0.0.1'),
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        web3 = Web3(Web3.HTTPProvider(f'http://127.0.0.1:{port}'))
+        deadline = time.monotonic() + REFERENCE_ANVIL_STARTUP_TIMEOUT
+        while not web3.is_connected():
+            if proc.poll() is not None or time.monotonic() > deadline:
+                msg = 'reference anvil failed to start'
+                raise SnapshotError(msg)
+            time.sleep(0.1)
+
+        for i in range(anvil_args.get('accounts', None) or DEFAULT_ACCOUNTS):
+            anvil_set_balance(
+                web3,
+                get_account(mnemonic, i).address,
+                hex(int(anvil_args.get('balance', None) or DEFAULT_BALANCE) * 10**18),
+            )
+
+        yield web3
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def get_deployment_snapshot(
+    project_location: str,
+    anvil_args: LaunchAnvilInstanceArgs,
+    deploy_script: str = 'script/Deploy.s.sol:Deploy',
+    env: dict[str, str] | None = None,
+) -> DeploymentSnapshot:
+    """Returns the state right after deploying the project, deploying it into a reference anvil the first time.
+
+    Snapshots are shared between launcher processes and keyed by the project sources, so editing the project
+    invalidates them. The deployment runs with a throwaway mnemonic, so it must not depend on the team.
+    """
+    if env is None:
+        env = {}
+
+    SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+    key = get_snapshot_key(project_location, anvil_args, deploy_script, env)
+    snapshot_path = SNAPSHOT_DIR / f'{key}.json'
+
+    with FileLock(SNAPSHOT_DIR / f'{key}.lock'):
+        if snapshot_path.exists():
+            with snapshot_path.open('r') as f:
+                return json.load(f)
+
+        # every instance loads the same state, so it must not fund any key that someone could know: the deployer
+        # keys are never stored anywhere and get emptied before the dump
+        mnemonic = generate_mnemonic(12, lang=Language.ENGLISH)
+        with reference_anvil(anvil_args, mnemonic) as web3:
+            contracts = deploy(web3, project_location, mnemonic, deploy_script, env)
+            accounts = anvil_args.get('accounts', None) or DEFAULT_ACCOUNTS
+            for i in range(accounts):
+                anvil_set_balance(web3, get_account(mnemonic, i).address, hex(0))
+            for i in range(accounts):
+                if web3.eth.get_balance(get_account(DEFAULT_MNEMONIC, i).address) != 0:
+                    msg = 'the deployment funds an account of the default mnemonic'
+                    raise SnapshotError(msg)
+            snapshot = DeploymentSnapshot(state=anvil_dump_state(web3), contracts=contracts)
+
+        tmp_path = snapshot_path.with_suffix('.tmp')
+        with tmp_path.open('w') as f:
+            json.dump(snapshot, f)
+        tmp_path.replace(snapshot_path)
+        return snapshot
+
+
+def deploy_from_snapshot(
+    web3: Web3,
+    project_location: str,
+    anvil_args: LaunchAnvilInstanceArgs,
+    deploy_script: str = 'script/Deploy.s.sol:Deploy',
+    env: dict[str, str] | None = None,
+) -> list[ChallengeContract]:
+    snapshot = get_deployment_snapshot(project_location, anvil_args, deploy_script, env)
+    anvil_load_state(web3, snapshot['state'])
+    return snapshot['contracts']
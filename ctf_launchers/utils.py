@@ -1,8 +1,8 @@
 import json
-from pathlib import Path
 
 from web3 import Web3
 
+from ctf_launchers.artifacts import ARTIFACTS_OUT
 from foundry.anvil import anvil_set_code
 
 
@@ -13,7 +13,7 @@ def anvil_set_code_from_file(
 ) -> None:
     file, contract = target.split(':')
 
-    with Path(f'/artifacts/out/{file}/{contract}.json').open('r') as f:
+    with (ARTIFACTS_OUT / file / f'{contract}.json').open('r') as f:
         cache = json.load(f)
         bytecode = cache['deployedBytecode']['object']
 
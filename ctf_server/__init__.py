@@ -1,2 +1,3 @@
 from ctf_server.anvil_proxy import app as anvil_proxy  # noqa: F401
+from ctf_server.fork_cache import app as fork_cache  # noqa: F401
 from ctf_server.orchestrator import app as orchestrator  # noqa: F401
@@ -0,0 +1,116 @@
+import math
+import os
+from dataclasses import dataclass
+from threading import Lock
+
+from .backends import Backend
+from .databases import Database
+from .types import CreateInstanceRequest
+from .utils import worker
+
+
+# Launches that may be in progress at the same time, across every orchestrator worker
+ADMISSION_MAX_CONCURRENT_LAUNCHES = int(os.getenv('ADMISSION_MAX_CONCURRENT_LAUNCHES', '16'))
+# Live anvil containers a single backend node can hold, 0 disables the capacity check
+ADMISSION_MAX_ANVILS_PER_NODE = int(os.getenv('ADMISSION_MAX_ANVILS_PER_NODE', '0'))
+# Per-team quotas, 0 disables them
+ADMISSION_MAX_TEAM_INSTANCES = int(os.getenv('ADMISSION_MAX_TEAM_INSTANCES', '0'))
+ADMISSION_MAX_TEAM_LAUNCHES_PER_MINUTE = int(os.getenv('ADMISSION_MAX_TEAM_LAUNCHES_PER_MINUTE', '0'))
+
+# A queued launch loses its place if its launcher stops polling for this long
+ADMISSION_QUEUE_TTL = 15.0
+# A launch slot is reclaimed if it is not released for this long (e.g. the orchestrator worker crashed)
+ADMISSION_SLOT_TTL = 300.0
+# Initial guess for the launch duration, refined with every completed launch
+ADMISSION_INITIAL_LAUNCH_DURATION = 10.0
+# How often the leader rebuilds the live anvils count from the instances. The running count misses instances registered
+# before it existed, and drifts when a worker dies halfway through a registration
+ADMISSION_RECOUNT_INTERVAL = 60
+
+
+class AdmissionRejectedError(Exception):
+    """Custom exception for launches refused by the admission controller, the message is shown to the player."""
+
+
+@dataclass
+class QueuedLaunch:
+    position: int
+    estimated_wait: float
+
+
+class AdmissionController:
+    """Decides whether a launch may start right away, has to wait in the FIFO launch queue, or is refused.
+
+    All the state lives in the database, so the limits hold across every orchestrator worker and replica.
+    """
+
+    def __init__(self, database: Database, backend: Backend) -> None:
+        self.__database = database
+        self.__backend = backend
+
+        self.__launch_duration = ADMISSION_INITIAL_LAUNCH_DURATION
+        self.__launch_duration_lock = Lock()
+
+        if ADMISSION_MAX_ANVILS_PER_NODE:
+            worker.run_periodically('Live Anvils Recount', database.recount_live_anvils, ADMISSION_RECOUNT_INTERVAL)
+
+    def admit(self, request: CreateInstanceRequest, ticket: str) -> QueuedLaunch | None:
+        """Returns None if the launch was admitted and must be followed by `release`, or its place in the queue.
+
+        `ticket` identifies this launch request (not the instance, duplicate requests for an instance queue separately).
+        """
+        team = request.get('team')
+        if team is not None:
+            try:
+                self.__check_team_quotas(team)
+            except AdmissionRejectedError:
+                # a launch that was waiting in the queue must give its place up, or it holds up everyone behind it
+                self.__database.leave_launch_queue(ticket)
+                raise
+
+        position = self.__database.acquire_launch_slot(
+            ticket,
+            self.__get_launch_limit(request),
+            ADMISSION_SLOT_TTL,
+            ADMISSION_QUEUE_TTL,
+        )
+        if position > 0:
+            return QueuedLaunch(position=position, estimated_wait=self.__estimate_wait(position))
+
+        if team is not None:
+            self.__database.record_team_launch(team, ticket, 60)
+        return None
+
+    def release(self, ticket: str, duration: float) -> None:
+        self.__database.release_launch_slot(ticket)
+
+        with self.__launch_duration_lock:
+            self.__launch_duration = 0.8 * self.__launch_duration + 0.2 * duration
+
+    def __check_team_quotas(self, team: str) -> None:
+        if ADMISSION_MAX_TEAM_INSTANCES and self.__database.count_team_instances(team) >= ADMISSION_MAX_TEAM_INSTANCES:
+            msg = f'your team already has {ADMISSION_MAX_TEAM_INSTANCES} live instances, kill one of them first'
+            raise AdmissionRejectedError(msg)
+
+        if (
+            ADMISSION_MAX_TEAM_LAUNCHES_PER_MINUTE
+            and self.__database.count_team_launches(team, 60) >= ADMISSION_MAX_TEAM_LAUNCHES_PER_MINUTE
+        ):
+            msg = 'your team is launching instances too often, please try again in a minute'
+            raise AdmissionRejectedError(msg)
+
+    def __get_launch_limit(self, request: CreateInstanceRequest) -> int:
+        limit = ADMISSION_MAX_CONCURRENT_LAUNCHES
+        if not ADMISSION_MAX_ANVILS_PER_NODE:
+            return limit
+
+        # every in-progress launch is going to take up some of the remaining capacity, so only let as many of them
+        # in as the capacity that is left can fit
+        capacity = ADMISSION_MAX_ANVILS_PER_NODE * self.__backend.node_count
+        headroom = capacity - self.__database.count_live_anvils()
+        return min(limit, max(headroom, 0) // max(len(request.get('anvil_instances', {})), 1))
+
+    def __estimate_wait(self, position: int) -> float:
+        with self.__launch_duration_lock:
+            launch_duration = self.__launch_duration
+        return math.ceil(position / ADMISSION_MAX_CONCURRENT_LAUNCHES) * launch_duration
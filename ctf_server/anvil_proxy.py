@@ -1,8 +1,10 @@
 import builtins
 import json
+import os
+import time
 from collections.abc import AsyncGenerator
 from contextlib import asynccontextmanager, suppress
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Any
 
 import aiohttp
@@ -14,12 +16,22 @@ from starlette.responses import JSONResponse
 from starlette.websockets import WebSocketDisconnect
 from websockets import WebSocketException
 
+from . import debug
 from .databases import Database
 from .loaders import load_database
-from .types import InstanceInfo
-from .utils import worker
+from .types import InstanceInfo, UserData
 
 
+ORCHESTRATOR_HOST = os.getenv('ORCHESTRATOR_HOST', 'http://orchestrator:7283')
+# Activity is reported to the database at most this often per instance, it only has to be accurate to the minute
+ACTIVITY_REPORT_INTERVAL = 30.0
+ACTIVITY_REPORT_MAX_TRACKED = 10_000
+# Waking a hibernated instance up includes starting its containers, see backend.WAKE_TIMEOUT
+WAKE_REQUEST_TIMEOUT = 90
+# Consecutive failed health checks before requests are refused without trying the anvil, a single failed probe is often
+# just a busy anvil. 0 never refuses
+HEALTH_REFUSE_AFTER = int(os.getenv('HEALTH_REFUSE_AFTER', '3'))
+
 ALLOWED_NAMESPACES = ['web3', 'eth', 'net']
 DISALLOWED_METHODS = [
     'eth_sign',
@@ -32,11 +44,16 @@ DISALLOWED_METHODS = [
 ]
 
 
+class InstanceUnavailableError(Exception):
+    """Custom exception for instances requests cannot be proxied to, the message is shown to the player."""
+
+
 @dataclass
 class Context:
     # note(es3n1n, 27.03.24): HACK: mypy won't know that we will initialize these within the lifespan
     session: aiohttp.ClientSession = None  # type: ignore[assignment]
     database: Database = None  # type: ignore[assignment]
+    activity_reported_at: dict[str, float] = field(default_factory=dict)
 
     def setup(self) -> None:
         self.session = aiohttp.ClientSession()
@@ -52,13 +69,13 @@ context = Context()
 
 @asynccontextmanager
 async def lifespan(_: FastAPI) -> AsyncGenerator[None]:
-    worker.setup('anvil_proxy')
     context.setup()
     yield
     await context.shutdown()
 
 
 app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+debug.install(app)
 
 
 def jsonrpc_fail(id_: str | int | None, code: int, message: str) -> dict[str, str | dict[str, str | int] | Any]:
@@ -149,6 +166,64 @@ async def proxy_request(anvil_instance: InstanceInfo, body: list | dict) -> dict
     return await send_request(anvil_instance, request_id, body)
 
 
+def report_activity(instance_id: str) -> None:
+    now = time.time()
+    if now - context.activity_reported_at.get(instance_id, 0) < ACTIVITY_REPORT_INTERVAL:
+        return
+
+    if len(context.activity_reported_at) > ACTIVITY_REPORT_MAX_TRACKED:
+        context.activity_reported_at = {
+            k: v for k, v in context.activity_reported_at.items() if now - v < ACTIVITY_REPORT_INTERVAL
+        }
+    context.activity_reported_at[instance_id] = now
+
+    try:
+        context.database.record_activity(instance_id, now)
+    except Exception as e:
+        logger.opt(exception=e).warning(f'failed to report activity of {instance_id}')
+
+
+async def wake_instance(user_data: UserData) -> UserData | None:
+    if not user_data.get('hibernated'):
+        return user_data
+
+    try:
+        async with context.session.post(
+            f'{ORCHESTRATOR_HOST}/instances/{user_data["instance_id"]}/wake',
+            timeout=aiohttp.ClientTimeout(total=WAKE_REQUEST_TIMEOUT),
+        ) as resp:
+            body = await resp.json()
+    except Exception as e:
+        logger.opt(exception=e).error(f'failed to wake instance {user_data["instance_id"]} up')
+        return None
+
+    return body['data'] if body['ok'] else None
+
+
+async def get_awake_instance(external_id: str) -> UserData:
+    """Returns the instance behind `external_id`, waking it up first if it is hibernated."""
+    user_data = context.database.get_instance_by_external_id(external_id)
+    if user_data is None:
+        msg = 'invalid rpc url, instance not found'
+        raise InstanceUnavailableError(msg)
+
+    report_activity(user_data['instance_id'])
+    if user_data.get('hibernated'):
+        # waking up waits for the anvils, whatever health was recorded before it went to sleep does not matter
+        awake = await wake_instance(user_data)
+        if awake is None:
+            msg = 'failed to wake the instance up, please try again'
+            raise InstanceUnavailableError(msg)
+        return awake
+
+    # do not make the player wait for a connection timeout when the health monitor already knows it is down
+    health = user_data.get('health')
+    if health is not None and HEALTH_REFUSE_AFTER > 0 and health['failures'] >= HEALTH_REFUSE_AFTER:
+        msg = 'instance is not responding, please try again later or relaunch it'
+        raise InstanceUnavailableError(msg)
+    return user_data
+
+
 @app.post('/{external_id}/{anvil_id}')
 async def http_rpc(external_id: str, anvil_id: str, request: Request) -> dict | list | None:
     try:
@@ -156,9 +231,10 @@ async def http_rpc(external_id: str, anvil_id: str, request: Request) -> dict |
     except json.JSONDecodeError:
         return jsonrpc_fail(None, -32600, 'expected json body')
 
-    user_data = context.database.get_instance_by_external_id(external_id)
-    if user_data is None:
-        return jsonrpc_fail(None, -32602, 'invalid rpc url, instance not found')
+    try:
+        user_data = await get_awake_instance(external_id)
+    except InstanceUnavailableError as e:
+        return jsonrpc_fail(None, -32602, str(e))
 
     anvil_instance = user_data.get('anvil_instances', {}).get(anvil_id, None)
     if anvil_instance is None:
@@ -171,9 +247,10 @@ async def http_rpc(external_id: str, anvil_id: str, request: Request) -> dict |
 async def ws_rpc(external_id: str, anvil_id: str, client_ws: WebSocket) -> None:
     await client_ws.accept()
 
-    user_data = context.database.get_instance_by_external_id(external_id)
-    if user_data is None:
-        await client_ws.send_json(jsonrpc_fail(None, -32602, 'invalid rpc url, instance not found'))
+    try:
+        user_data = await get_awake_instance(external_id)
+    except InstanceUnavailableError as e:
+        await client_ws.send_json(jsonrpc_fail(None, -32602, str(e)))
         return
 
     anvil_instance = user_data.get('anvil_instances', {}).get(anvil_id, None)
@@ -204,6 +281,8 @@ async def ws_rpc(external_id: str, anvil_id: str, client_ws: WebSocket) -> None:
                     await client_ws.send_json(validation)
                     continue
 
+                report_activity(user_data['instance_id'])
+
                 await remote_ws.send(message_data)
                 response = await remote_ws.recv()
 
@@ -1,3 +1,4 @@
 from .backend import Backend  # noqa: F401
 from .docker_backend import DockerBackend  # noqa: F401
 from .kubernetes_backend import KubernetesBackend  # noqa: F401
+from .process_backend import ProcessBackend  # noqa: F401
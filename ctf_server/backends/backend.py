@@ -1,8 +1,15 @@
 import abc
+import os
 import random
+import re
+import secrets
 import string
 import time
-from threading import Thread
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Event, Thread
 
 from eth_account import Account
 from eth_account.hdaccount import key_from_seed, seed_from_mnemonic
@@ -11,71 +18,547 @@ from loguru import logger
 from web3 import Web3
 
 from ctf_server.databases.database import Database
+from ctf_server.events import publish_event
+from ctf_server.tracing import tracer
 from ctf_server.types import (
     DEFAULT_ACCOUNTS,
     DEFAULT_BALANCE,
     DEFAULT_DERIVATION_PATH,
+    DEFAULT_IMAGE,
     DEFAULT_MNEMONIC,
     CreateInstanceRequest,
+    HealthStatus,
     InstanceInfo,
     LaunchAnvilInstanceArgs,
     UserData,
+    get_persistence,
+    get_privileged_web3,
+    keeps_state,
 )
 from ctf_server.utils import worker
-from foundry.anvil import anvil_set_balance
+from foundry.anvil import anvil_dump_state, anvil_load_state, anvil_reset, anvil_set_balance
+
+from .health import HEALTH_CHECK_INTERVAL, HealthMonitor
+from .reaper import InstanceReaper
+from .resources import apply_resource_profile
+
+
+MANAGED_BY_LABEL = 'app.kubernetes.io/managed-by'
+MANAGED_BY = 'paradigmctf'
+INSTANCE_LABEL = 'paradigmctf/instance-id'
+GENERATION_LABEL = 'paradigmctf/generation'
+CHALLENGE_LABEL = 'paradigmctf/challenge'
+TEAM_LABEL = 'paradigmctf/team'
+# Kubernetes label values are capped at 63 characters
+MAX_LABEL_VALUE_LENGTH = 63
+
+TEARDOWN_WORKERS = 4
+# Instances unregistered at once by bulk kills, each batch is torn down as a whole
+KILL_BATCH_SIZE = 500
+# Teardowns of killed instances are recorded in the database until they succeed, the leader retries the ones that have
+# not succeeded within this long
+TEARDOWN_RETRY_INTERVAL = float(os.getenv('TEARDOWN_RETRY_INTERVAL', '60'))
+
+# Images nobody launched for this long are no longer kept on every node, unless a live instance still runs them
+IMAGE_UNUSED_TTL = float(os.getenv('IMAGE_UNUSED_TTL', str(7 * 24 * 60 * 60)))
+IMAGE_EXPIRY_INTERVAL = 3600
+
+# Stop the containers of instances that have not received any rpc request for this many seconds, 0 disables it
+HIBERNATE_AFTER = float(os.getenv('HIBERNATE_AFTER', '0'))
+HIBERNATION_INTERVAL = 60
+# How long a hibernated instance may take to come back up, and how long the proxy waits for it
+WAKE_TIMEOUT = 60
+
+# Every launch of an instance holds a lock for as long as it runs, renewed in the background. If the worker dies the
+# lock lapses after the ttl
+LAUNCH_LOCK_TTL = 30.0
+# Duplicate launches wait for the launch in progress and get its result, for at most this long
+LAUNCH_LOCK_WAIT = float(os.getenv('LAUNCH_LOCK_WAIT', '600'))
+LAUNCH_LOCK_POLL_INTERVAL = 0.2
+
+
+# How often the leader compares what runs on the nodes with the registered instances
+RECONCILE_INTERVAL = float(os.getenv('RECONCILE_INTERVAL', '60'))
+# Resources younger than this may belong to a launch that has not registered its instance yet, and instances younger
+# than this may still be starting up, so both are left alone
+RECONCILE_GRACE_PERIOD = float(os.getenv('RECONCILE_GRACE_PERIOD', '600'))
+# Upper bound for the teardowns and kills of a single pass, so that a large cleanup never starves the launches
+RECONCILE_MAX_ACTIONS = 20
+
+
+def to_label_value(value: str) -> str:
+    """Squashes `value` into something both docker and kubernetes accept as a label value."""
+    return re.sub(r'[^A-Za-z0-9_.-]', '-', value)[:MAX_LABEL_VALUE_LENGTH].strip('-_.')
 
 
 class InstanceExistsError(Exception):
     pass
 
 
+class TeardownError(Exception):
+    """Custom exception for instance teardown errors."""
+
+
+class LaunchInProgressError(Exception):
+    """Custom exception for duplicate launches that gave up waiting for the launch in progress."""
+
+
+@dataclass
+class ManagedResources:
+    """Everything a backend runs for a single launch, as found on the nodes."""
+
+    instance_id: str
+    generation: str
+    node: str | None
+    # when the oldest resource of the launch was created
+    created_at: float
+
+
+class HibernationError(Exception):
+    """Custom exception for instance hibernation errors."""
+
+
+class InstanceResetError(Exception):
+    """Custom exception for instance reset errors, the message is shown to the player."""
+
+
 class Backend(abc.ABC):
     def __init__(self, database: Database) -> None:
         self._database = database
+        self.__teardown_pool = ThreadPoolExecutor(
+            max_workers=TEARDOWN_WORKERS,
+            thread_name_prefix=f'{self.__class__.__name__} Teardown',
+        )
 
-        # We only want to run this thread for a single worker
-        if worker.is_first:
-            Thread(
-                target=self.__instance_pruner_thread,
-                name=f'{self.__class__.__name__} Anvil Pruner',
-                daemon=True,
-            ).start()
-
-    def __instance_pruner_thread(self) -> None:
-        @logger.catch
-        def pruner() -> None:
-            for instance in self._database.get_expired_instances():
-                logger.info(f'pruning expired instance: {instance["instance_id"]}')
-                self.kill_instance(instance['instance_id'])
+        database.register_image(DEFAULT_IMAGE)
 
-        while True:
-            pruner()
-            time.sleep(1)
+        # The reaper only does anything while this worker is the leader
+        InstanceReaper(database, self.kill_instance).start()
+        worker.run_periodically('Orphan Reconciler', self.reconcile, RECONCILE_INTERVAL)
+        worker.run_periodically('Teardown Retrier', self.retry_teardowns, TEARDOWN_RETRY_INTERVAL)
+        worker.run_periodically('Image Expirer', self.expire_images, IMAGE_EXPIRY_INTERVAL)
+        if HIBERNATE_AFTER > 0 and self.supports_hibernation:
+            worker.run_periodically('Instance Hibernator', self.hibernate_idle_instances, HIBERNATION_INTERVAL)
+
+        monitor = HealthMonitor(database, self.restart_instance if self.supports_restart else None)
+        worker.run_periodically('Health Monitor', monitor.check, HEALTH_CHECK_INTERVAL)
 
     def launch_instance(self, args: CreateInstanceRequest) -> UserData:
-        if self._database.get_instance(args['instance_id']) is not None:
-            raise InstanceExistsError
+        return self.launch_or_attach_instance(args)[0]
+
+    def launch_or_attach_instance(self, args: CreateInstanceRequest) -> tuple[UserData, bool]:
+        """Launches the instance, also returns whether it came from a launch of it that was already in progress."""
+        with tracer.span('backend.launch_instance', instance_id=args['instance_id'], backend=self.__class__.__name__):
+            return self.__launch_instance(args)
+
+    def __launch_instance(self, args: CreateInstanceRequest) -> tuple[UserData, bool]:
+        with self.__launch_lock(args['instance_id']) as attached:
+            if (existing := self._database.get_instance(args['instance_id'])) is not None:
+                # a duplicate of the launch we waited for gets the same instance, anything else is a conflict
+                if attached:
+                    return existing, True
+                raise InstanceExistsError
 
+            return self.__provision_instance(args), False
+
+    @contextmanager
+    def __launch_lock(self, instance_id: str) -> Iterator[bool]:
+        """Serializes the launches of an instance across every worker, yields whether another launch was waited for."""
+        name = f'launch/{instance_id}'
+        # the lease is reentrant for its holder, so concurrent launches within this worker need holders of their own
+        holder = f'{worker.holder}/{secrets.token_hex(4)}'
+
+        attached = False
+        with tracer.span('backend.launch_lock'):
+            deadline = time.monotonic() + LAUNCH_LOCK_WAIT
+            while self._database.acquire_lease(name, holder, LAUNCH_LOCK_TTL) is None:
+                if not attached:
+                    logger.info(f'instance {instance_id} is already being launched, waiting for it')
+                    attached = True
+                if time.monotonic() > deadline:
+                    msg = f'timed out waiting for the launch of instance {instance_id} in progress'
+                    raise LaunchInProgressError(msg)
+                time.sleep(LAUNCH_LOCK_POLL_INTERVAL)
+
+        stop = Event()
+        renewer = Thread(
+            target=self.__renew_launch_lock,
+            args=(name, holder, stop),
+            name=f'Launch Lock {instance_id}',
+            daemon=True,
+        )
+        renewer.start()
         try:
-            user_data = self._launch_instance_impl(args)
+            yield attached
+        finally:
+            stop.set()
+            renewer.join()
+            self._database.release_lease(name, holder)
+
+    def __renew_launch_lock(self, name: str, holder: str, stop: Event) -> None:
+        # pulling images alone can take longer than the ttl
+        while not stop.wait(LAUNCH_LOCK_TTL / 3):
+            try:
+                if self._database.acquire_lease(name, holder, LAUNCH_LOCK_TTL) is None:
+                    logger.warning(f'lost the lock {name}, a duplicate launch might run concurrently')
+            except Exception as e:
+                logger.opt(exception=e).warning(f'failed to renew the lock {name}')
+
+    def __provision_instance(self, args: CreateInstanceRequest) -> UserData:
+        # from here on the backends only deal with concrete limits
+        args = args.copy()
+        args['anvil_instances'] = {
+            anvil_id: apply_resource_profile(anvil_args)
+            for anvil_id, anvil_args in args.get('anvil_instances', {}).items()
+        }
+
+        images = self._get_images(args)
+        for image in images:
+            self._database.register_image(image)
+
+        # Every launch gets its own generation, so that its resources never clash with the ones of a previous
+        # launch of the same instance that are still being torn down
+        generation = self._generate_generation()
+        publish_event(self._database, 'launching', args['instance_id'])
+        try:
+            with tracer.span('backend.provision', generation=generation):
+                user_data = self._launch_instance_impl(args, generation)
+            user_data['team'] = args.get('team')
+            user_data['challenge'] = args.get('challenge')
+            user_data['images'] = sorted(images)
             self._database.register_instance(args['instance_id'], user_data)
         except:
-            self._cleanup_instance(args)
+            logger.warning(f'cleaning up instance: {args["instance_id"]} ({generation})')
+            self._schedule_teardown(args['instance_id'], generation, None)
             raise
         else:
+            publish_event(self._database, 'ready', args['instance_id'])
             return user_data
 
+    @property
+    def node_count(self) -> int:
+        return 1
+
+    @property
+    def supports_hibernation(self) -> bool:
+        return False
+
+    @property
+    def supports_restart(self) -> bool:
+        # restarts go through the same container stop/start as hibernation
+        return self.supports_hibernation
+
+    def reconcile(self) -> None:
+        """Tears down resources no registered instance owns, and kills instances whose resources are gone."""
+        instances = {instance['instance_id']: instance for instance in self._database.get_all_instances()}
+        listed = self._list_resources()
+        if listed is None:
+            return
+
+        resources, nodes = listed
+        now = time.time()
+
+        owned: set[str] = set()
+        orphans: list[ManagedResources] = []
+        for launch in resources:
+            instance = instances.get(launch.instance_id)
+            if instance is not None and instance.get('generation') == launch.generation:
+                owned.add(launch.instance_id)
+            elif now - launch.created_at >= RECONCILE_GRACE_PERIOD:
+                orphans.append(launch)
+
+        lost = [
+            instance_id
+            for instance_id, instance in instances.items()
+            # we can not tell whether the resources of an instance are gone if we could not list its node, and the
+            # resources of instances launched before generations are not labelled, so they are never listed
+            if instance_id not in owned
+            and instance.get('node') in nodes
+            and instance.get('generation') is not None
+            and now - instance['created_at'] >= RECONCILE_GRACE_PERIOD
+        ]
+
+        orphans = orphans[:RECONCILE_MAX_ACTIONS]
+        lost = lost[: RECONCILE_MAX_ACTIONS - len(orphans)]
+        for launch in orphans:
+            if not worker.still_leader():
+                return
+            logger.warning(f'tearing down orphaned resources of {launch.instance_id} ({launch.generation})')
+            self._schedule_teardown(launch.instance_id, launch.generation, launch.node)
+
+        for instance_id in lost:
+            if not worker.still_leader():
+                return
+            logger.warning(f'killing instance {instance_id}, its resources are gone')
+            self.kill_instance(instance_id)
+
+        if orphans or lost:
+            logger.info(f'reconciliation pass done, {len(orphans) + len(lost)} actions taken')
+
+    def expire_images(self) -> None:
+        keep = {DEFAULT_IMAGE}
+        for instance in self._database.get_all_instances():
+            if 'images' not in instance:
+                # we can not tell what this instance runs, wait until it is gone
+                return
+            keep.update(instance['images'])
+
+        for image in self._database.expire_images(time.time() - IMAGE_UNUSED_TTL, keep):
+            logger.info(f'{image} has not been used in a while, no longer keeping it on the nodes')
+
+    def hibernate_idle_instances(self) -> None:
+        for instance_id in self._database.get_idle_instance_ids(time.time() - HIBERNATE_AFTER):
+            if not worker.still_leader():
+                return
+            try:
+                self.hibernate_instance(instance_id)
+            except Exception as e:
+                logger.opt(exception=e).error(f'failed to hibernate instance {instance_id}')
+
+    def hibernate_instance(self, instance_id: str) -> None:
+        with self.__power_lock(instance_id):
+            instance = self._database.get_instance(instance_id)
+            if instance is None or instance.get('hibernated'):
+                return
+
+            # anvils that do not keep their state on disk would come back empty
+            if not keeps_state(instance):
+                return
+
+            logger.info(f'hibernating idle instance: {instance_id}')
+            # marked first, so that a request coming in while the containers stop wakes the instance right back up
+            self._database.set_hibernated(instance_id, hibernated=True)
+            self._stop_instance(instance)
+
+    def wake_instance(self, instance_id: str) -> UserData | None:
+        """Starts the containers of a hibernated instance back up and returns it, once its anvils are reachable."""
+        with self.__power_lock(instance_id):
+            instance = self._database.get_instance(instance_id)
+            if instance is None or not instance.get('hibernated'):
+                return instance
+
+            logger.info(f'waking instance up: {instance_id}')
+            anvil_instances = self._start_instance(instance)
+            self.__wait_until_reachable(instance_id, anvil_instances)
+
+            # the anvils are reachable, whatever the health monitor recorded before the instance went to sleep is stale
+            health = HealthStatus(healthy=True, latency=None, checked_at=time.time(), failures=0)
+            self._database.update_instance(instance_id, {'anvil_instances': anvil_instances, 'health': health})
+            self._database.set_hibernated(instance_id, hibernated=False)
+            instance['anvil_instances'] = anvil_instances
+            instance['hibernated'] = False
+            return instance
+
+    def restart_instance(self, instance_id: str) -> UserData | None:
+        """Restarts every container of the instance, the anvils come back with whatever state they persisted."""
+        with self.__power_lock(instance_id):
+            instance = self._database.get_instance(instance_id)
+            if instance is None or instance.get('hibernated'):
+                return instance
+
+            if not keeps_state(instance):
+                msg = f'instance {instance_id} does not keep its state on disk, restarting it would wipe it'
+                raise HibernationError(msg)
+
+            logger.info(f'restarting instance: {instance_id}')
+            self._stop_instance(instance)
+            anvil_instances = self._start_instance(instance)
+            self.__wait_until_reachable(instance_id, anvil_instances)
+
+            self._database.update_instance(instance_id, {'anvil_instances': anvil_instances})
+            instance['anvil_instances'] = anvil_instances
+            return instance
+
+    @staticmethod
+    def __wait_until_reachable(instance_id: str, anvil_instances: dict[str, InstanceInfo]) -> None:
+        deadline = time.monotonic() + WAKE_TIMEOUT
+        for anvil_instance in anvil_instances.values():
+            web3 = Web3(Web3.HTTPProvider(f'http://{anvil_instance["ip"]}:{anvil_instance["port"]}'))
+            while not web3.is_connected():
+                if time.monotonic() > deadline:
+                    msg = f'instance {instance_id} did not come back up in time'
+                    raise HibernationError(msg)
+                time.sleep(0.1)
+
+    def snapshot_instance(self, instance_id: str) -> UserData | None:
+        """Saves the state of every anvil of the instance, `reset_instance` then brings them back to exactly that."""
+        instance = self.wake_instance(instance_id)
+        if instance is None:
+            return None
+
+        # dumps rather than evm snapshots, which only live in memory and would not survive anvil restarts
+        states = {
+            anvil_id: anvil_dump_state(get_privileged_web3(instance, anvil_id))
+            for anvil_id in instance['anvil_instances']
+        }
+        self._database.set_reset_states(instance_id, states)
+        return instance
+
+    def reset_instance(self, instance_id: str) -> UserData | None:
+        instance = self.wake_instance(instance_id)
+        if instance is None:
+            return None
+
+        states = self._database.get_reset_states(instance_id)
+        if not states:
+            msg = 'this instance cannot be reset, please relaunch it instead'
+            raise InstanceResetError(msg)
+
+        for anvil_id, state in states.items():
+            web3 = get_privileged_web3(instance, anvil_id)
+            # loading a dump only overwrites what is in it, so everything created since has to go first
+            anvil_reset(web3)
+            anvil_load_state(web3, state)
+        return instance
+
+    @contextmanager
+    def __power_lock(self, instance_id: str) -> Iterator[None]:
+        # hibernation runs on the leader while wake-ups come through any worker, they must not interleave
+        name = f'power/{instance_id}'
+        # the lease is reentrant for its holder, so concurrent requests within this worker need holders of their own
+        holder = f'{worker.holder}/{secrets.token_hex(4)}'
+        deadline = time.monotonic() + WAKE_TIMEOUT
+        while self._database.acquire_lease(name, holder, WAKE_TIMEOUT * 2) is None:
+            if time.monotonic() > deadline:
+                msg = f'timed out waiting for instance {instance_id} to hibernate or wake up'
+                raise HibernationError(msg)
+            time.sleep(0.2)
+
+        try:
+            yield
+        finally:
+            self._database.release_lease(name, holder)
+
+    def kill_challenge(self, challenge: str) -> list[UserData]:
+        """Kills every instance of the challenge, tearing their resources down in bulk where the backend can."""
+        instance_ids: list[str] = []
+        cursor = None
+        while True:
+            instances, cursor = self._database.list_instances(cursor, KILL_BATCH_SIZE, challenge=challenge)
+            instance_ids += [instance['instance_id'] for instance in instances]
+            if cursor is None:
+                break
+
+        return self.kill_instances(instance_ids)
+
+    def kill_instances(self, instance_ids: list[str]) -> list[UserData]:
+        """Kills the instances in bulk, returns the ones that were still alive."""
+        killed: list[UserData] = []
+        for i in range(0, len(instance_ids), KILL_BATCH_SIZE):
+            # someone else might have killed some of them in the meantime
+            instances = self._database.unregister_instances(
+                instance_ids[i : i + KILL_BATCH_SIZE], TEARDOWN_RETRY_INTERVAL
+            )
+            for instance in instances:
+                publish_event(self._database, 'killed', instance['instance_id'])
+
+            if instances:
+                self.__teardown_pool.submit(self.__teardown_instances, instances)
+            killed += instances
+        return killed
+
+    def retry_teardowns(self) -> None:
+        """Tears down killed instances whose teardown failed, or whose worker died before it was done."""
+        instances = self._database.get_due_teardowns(KILL_BATCH_SIZE)
+        if not instances or not worker.still_leader():
+            return
+
+        logger.warning(f'retrying the teardown of {len(instances)} instances')
+        # claimed until the next interval, whether this attempt succeeds or not
+        self._database.queue_teardowns(instances, TEARDOWN_RETRY_INTERVAL)
+        self.__teardown_instances(instances)
+
+    def __teardown_instances(self, instances: list[UserData]) -> None:
+        try:
+            self._destroy_instances(instances)
+        except Exception as e:
+            logger.opt(exception=e).error(
+                f'failed to tear down {len(instances)} instances, retrying in {TEARDOWN_RETRY_INTERVAL:.0f}s'
+            )
+            return
+
+        self._database.complete_teardowns(instances)
+
+    def kill_instance(self, instance_id: str) -> UserData | None:
+        instance = self._database.unregister_instance(instance_id, TEARDOWN_RETRY_INTERVAL)
+        if instance is None:
+            return None
+
+        publish_event(self._database, 'killed', instance_id)
+        self.__teardown_pool.submit(self.__teardown_instances, [instance])
+        return instance
+
+    def _schedule_teardown(self, instance_id: str, generation: str, node: str | None) -> None:
+        self.__teardown_pool.submit(self.__teardown, instance_id, generation, node)
+
+    def __teardown(self, instance_id: str, generation: str, node: str | None) -> None:
+        try:
+            self._destroy_instance(instance_id, generation, node)
+        except Exception as e:
+            logger.opt(exception=e).error(f'failed to tear down instance {instance_id} ({generation})')
+
     @abc.abstractmethod
-    def _launch_instance_impl(self, args: CreateInstanceRequest) -> UserData:
+    def _launch_instance_impl(self, args: CreateInstanceRequest, generation: str) -> UserData:
         pass
 
     @abc.abstractmethod
-    def _cleanup_instance(self, args: CreateInstanceRequest) -> None:
-        pass
+    def _destroy_instance(self, instance_id: str, generation: str, node: str | None) -> None:
+        """Removes every resource of a launch, `node` is where it was placed, if known."""
+
+    def _destroy_instances(self, instances: list[UserData]) -> None:
+        """Removes every resource of the given, already unregistered, instances. Raises if any of them failed."""
+        failed = 0
+        for instance in instances:
+            generation = instance.get('generation')
+            try:
+                if generation is None:
+                    self._destroy_legacy_instance(instance)
+                else:
+                    self._destroy_instance(instance['instance_id'], generation, instance.get('node'))
+            except Exception as e:
+                logger.opt(exception=e).warning(
+                    f'failed to tear down instance {instance["instance_id"]} ({generation})'
+                )
+                failed += 1
+
+        if failed:
+            msg = f'failed to tear down {failed} of {len(instances)} instances'
+            raise TeardownError(msg)
+
+    def _destroy_legacy_instance(self, instance: UserData) -> None:
+        """Removes the resources of an instance launched before launches had generations."""
+        logger.warning(f'instance {instance["instance_id"]} has no generation, leaving its resources alone')
 
     @abc.abstractmethod
-    def kill_instance(self, instance_id: str) -> UserData | None:
-        pass
+    def _list_resources(self) -> tuple[list[ManagedResources], set[str | None]] | None:
+        """Lists the resources of every launch in bulk, along with the nodes that could be listed.
+
+        Returns None if nothing could be listed at all.
+        """
+
+    def _stop_instance(self, instance: UserData) -> None:
+        """Stops the instance while keeping its persisted state, only needed if `supports_hibernation`."""
+        msg = f'{type(self).__name__} cannot stop instance {instance["instance_id"]}, it does not support hibernation'
+        raise HibernationError(msg)
+
+    def _start_instance(self, instance: UserData) -> dict[str, InstanceInfo]:
+        """Starts a stopped instance back up and returns where its anvils can now be reached."""
+        msg = f'{type(self).__name__} cannot start instance {instance["instance_id"]}, it does not support hibernation'
+        raise HibernationError(msg)
+
+    @staticmethod
+    def _get_images(args: CreateInstanceRequest) -> set[str]:
+        images = {anvil_args.get('image') or DEFAULT_IMAGE for anvil_args in args.get('anvil_instances', {}).values()}
+        return images | {daemon_args['image'] for daemon_args in args.get('daemon_instances', {}).values()}
+
+    @staticmethod
+    def _get_owner_labels(args: CreateInstanceRequest) -> dict[str, str]:
+        labels = {CHALLENGE_LABEL: args.get('challenge'), TEAM_LABEL: args.get('team')}
+        return {key: to_label_value(value) for key, value in labels.items() if value}
+
+    @staticmethod
+    def _generate_generation() -> str:
+        return secrets.token_hex(4)
 
     @staticmethod
     def _generate_rpc_id(length: int = 24) -> str:
@@ -88,21 +571,24 @@ class Backend(abc.ABC):
         return Account.from_key(private_key)
 
     def _prepare_node(self, args: LaunchAnvilInstanceArgs, web3: Web3) -> None:
-        while not web3.is_connected():
-            time.sleep(0.1)
-            continue
-
-        for i in range(args.get('accounts', None) or DEFAULT_ACCOUNTS):
-            anvil_set_balance(
-                web3,
-                self.__derive_account(
-                    args.get('derivation_path', None) or DEFAULT_DERIVATION_PATH,
-                    args.get('mnemonic', None) or DEFAULT_MNEMONIC,
-                    i,
-                ).address,
-                hex(int(args.get('balance', None) or DEFAULT_BALANCE) * 10**18),
-            )
+        with tracer.span('backend.wait_for_anvil'):
+            while not web3.is_connected():
+                time.sleep(0.1)
+                continue
+
+        with tracer.span('backend.fund_accounts'):
+            for i in range(args.get('accounts', None) or DEFAULT_ACCOUNTS):
+                anvil_set_balance(
+                    web3,
+                    self.__derive_account(
+                        args.get('derivation_path', None) or DEFAULT_DERIVATION_PATH,
+                        args.get('mnemonic', None) or DEFAULT_MNEMONIC,
+                        i,
+                    ).address,
+                    hex(int(args.get('balance', None) or DEFAULT_BALANCE) * 10**18),
+                )
 
     @staticmethod
     def _remap_extra_anvil_keys(out: InstanceInfo, anvil_args: LaunchAnvilInstanceArgs) -> None:
         out['extra_allowed_methods'] = anvil_args.get('extra_allowed_methods', None)
+        out['persistence'] = get_persistence(anvil_args)
@@ -1,18 +1,39 @@
 import http.client
+import ipaddress
+import os
+import re
 import shlex
+import socket
 import time
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime
+from threading import Lock, Thread
 from typing import TYPE_CHECKING
+from urllib.parse import urlparse
 
 import docker
-from docker.errors import APIError, NotFound
+from docker.errors import APIError, ImageNotFound, NotFound
 from docker.types import Mount
 from loguru import logger
 from web3 import Web3
 
 from ctf_server.databases.database import Database
-from ctf_server.types import DEFAULT_IMAGE, CreateInstanceRequest, InstanceInfo, UserData, format_anvil_args
+from ctf_server.tracing import tracer
+from ctf_server.types import (
+    DEFAULT_IMAGE,
+    CreateInstanceRequest,
+    InstanceInfo,
+    LaunchAnvilInstanceArgs,
+    UserData,
+    format_anvil_args,
+    get_persistence,
+)
+from ctf_server.utils import worker
 
-from .backend import Backend
+from .backend import GENERATION_LABEL, INSTANCE_LABEL, MANAGED_BY, MANAGED_BY_LABEL, Backend, ManagedResources
+from .images import ImagePuller
+from .resources import get_daemon_limits
 
 
 if TYPE_CHECKING:
@@ -20,61 +41,316 @@ if TYPE_CHECKING:
     from docker.models.volumes import Volume
 
 
+# Comma-separated docker daemon urls (e.g. tcp://10.0.0.2:2376,ssh://ctf@10.0.0.3), the local daemon if empty. Anvil
+# ports on remote daemons are published on the private address of the url, or on the one after a `#` (e.g.
+# ssh://ctf@ctf-3.example.com#10.0.0.3)
+DOCKER_HOSTS = os.getenv('DOCKER_HOSTS', '')
+# Orchestrator url reachable from remote daemons, daemon instances are only placed on the local daemon if empty
+DOCKER_REMOTE_ORCHESTRATOR_HOST = os.getenv('DOCKER_REMOTE_ORCHESTRATOR_HOST', '')
+DOCKER_HOST_REFRESH_INTERVAL = float(os.getenv('DOCKER_HOST_REFRESH_INTERVAL', '10'))
+# Rough memory footprint of a single container, used to weigh hosts with less memory when placing instances
+DOCKER_CONTAINER_MEMORY_ESTIMATE = int(os.getenv('DOCKER_CONTAINER_MEMORY_ESTIMATE', str(256 * 1024 * 1024)))
+
+# Instances are spread over this many bridge networks (`paradigmctf`, `paradigmctf-1`, ...) so that no single bridge
+# ends up with thousands of endpoints
+DOCKER_NETWORK_SHARDS = max(int(os.getenv('DOCKER_NETWORK_SHARDS', '1')), 1)
+DOCKER_NETWORK = 'paradigmctf'
+NETWORK_SHARDS = [DOCKER_NETWORK] + [f'{DOCKER_NETWORK}-{i}' for i in range(1, DOCKER_NETWORK_SHARDS)]
+# Containers that must reach the instances (anvil proxy, orchestrator, challenges) set this label to `true` to get
+# attached to every shard
+SHARD_ATTACH_LABEL = 'paradigmctf/attach-to-shards'
+
+ANVIL_PORT = 8545
+# Grace period for anvil to dump its state when its container gets stopped
+DOCKER_STOP_TIMEOUT = 30
+
+# How often the leader looks for registered images missing on a host, and how often it pulls them again anyway to pick
+# up new versions of moving tags such as `latest`
+IMAGE_PREFETCH_INTERVAL = 30
+IMAGE_REFRESH_INTERVAL = float(os.getenv('IMAGE_REFRESH_INTERVAL', '3600'))
+
+
+class DockerBackendError(Exception):
+    """Custom exception for Docker backend errors."""
+
+
+@dataclass
+class DockerHost:
+    url: str
+    client: docker.DockerClient
+    # Address other hosts can reach published ports on, None if the containers are reachable on the shared network
+    address: str | None
+    healthy: bool = False
+    containers: int = 0
+    cpus: int = 1
+    memory: int = 0
+    # Instance containers per network shard
+    networks: dict[str, int] = field(default_factory=dict)
+
+    @property
+    def load(self) -> float:
+        cpu_load = self.containers / max(self.cpus, 1)
+        memory_load = self.containers * DOCKER_CONTAINER_MEMORY_ESTIMATE / max(self.memory, 1)
+        return max(cpu_load, memory_load)
+
+
 class DockerBackend(Backend):
     def __init__(self, database: Database) -> None:
-        self.__client = docker.from_env()
+        self.__hosts = self.__load_hosts()
+        self.__hosts_lock = Lock()
+        for host in self.__hosts.values():
+            self.__refresh_host(host)
+        Thread(target=self.__host_monitor_thread, name='Docker Host Monitor', daemon=True).start()
+        worker.run_periodically(
+            'Docker Network Sharder', self.__ensure_all_network_shards, DOCKER_HOST_REFRESH_INTERVAL
+        )
+
+        self.__images = ImagePuller(database, self.__pull_image)
+        self.__prefetched_at: dict[tuple[str, str], float] = {}
+        worker.run_periodically('Docker Image Prefetcher', self.__prefetch_images, IMAGE_PREFETCH_INTERVAL)
 
         # note(es3n1n, 28.03.24): We are initializing base backend after the client because it would start a container
         # prunner thread, and there could be an issue where there would be some expired instances that it will start
         # pruning them before we even init the client, which will result in undefined __client exceptions
         super().__init__(database)
 
-    def _launch_instance_impl(self, request: CreateInstanceRequest) -> UserData:
+    @property
+    def node_count(self) -> int:
+        return max(sum(host.healthy for host in self.__hosts.values()), 1)
+
+    @property
+    def supports_hibernation(self) -> bool:
+        return True
+
+    @staticmethod
+    def __load_hosts() -> dict[str, DockerHost]:
+        urls = [url.strip() for url in DOCKER_HOSTS.split(',') if url.strip()]
+        if not urls:
+            return {'local': DockerHost(url='local', client=docker.from_env(), address=None)}
+
+        hosts: dict[str, DockerHost] = {}
+        for entry in urls:
+            url, _, address = entry.partition('#')
+            if url.startswith('unix://'):
+                address = ''
+            else:
+                address = DockerBackend.__get_private_address(address or urlparse(url).hostname or '')
+            hosts[url] = DockerHost(
+                url=url,
+                client=docker.DockerClient(base_url=url, use_ssh_client=url.startswith('ssh://')),
+                address=address or None,
+            )
+        return hosts
+
+    @staticmethod
+    def __get_private_address(address: str) -> str:
+        # anvil ports are published without any authentication, so they must never end up on a public interface
+        try:
+            resolved = ipaddress.ip_address(socket.gethostbyname(address))
+        except (OSError, ValueError) as e:
+            msg = f'invalid docker host address {address!r}'
+            raise DockerBackendError(msg) from e
+
+        if not resolved.is_private:
+            msg = f'docker host address {address} is public, append `#<private address>` to its url in DOCKER_HOSTS'
+            raise DockerBackendError(msg)
+        return str(resolved)
+
+    def __host_monitor_thread(self) -> None:
+        while True:
+            time.sleep(DOCKER_HOST_REFRESH_INTERVAL)
+            for host in self.__hosts.values():
+                self.__refresh_host(host)
+
+    def __refresh_host(self, host: DockerHost) -> None:
+        try:
+            info = host.client.info()
+            containers = host.client.containers.list(filters={'label': f'{MANAGED_BY_LABEL}={MANAGED_BY}'})
+        except Exception as e:
+            if host.healthy:
+                logger.opt(exception=e).error(f'docker host {host.url} is down, removing it from rotation')
+            host.healthy = False
+            return
+
+        with self.__hosts_lock:
+            if not host.healthy:
+                logger.info(f'docker host {host.url} is up, adding it to rotation')
+            host.healthy = True
+            host.containers = len(containers)
+            host.networks = Counter(
+                network
+                for container in containers
+                for network in container.attrs['NetworkSettings']['Networks']
+                if network in NETWORK_SHARDS
+            )
+            host.cpus = info.get('NCPU', 1)
+            host.memory = info.get('MemTotal', 0)
+
+    def __ensure_all_network_shards(self) -> None:
+        for host in self.__hosts.values():
+            if not host.healthy:
+                continue
+
+            # the host monitor decides whether the host is up, a failed setup is simply retried on the next pass
+            try:
+                self.__ensure_network_shards(host)
+            except Exception as e:
+                logger.opt(exception=e).error(f'failed to set up the network shards on {host.url}')
+
+    @staticmethod
+    def __ensure_network_shards(host: DockerHost) -> None:
+        existing = {network.name for network in host.client.networks.list(names=NETWORK_SHARDS)}
+        for name in NETWORK_SHARDS:
+            if name not in existing:
+                logger.info(f'creating network {name} on {host.url}')
+                try:
+                    host.client.networks.create(name, driver='bridge', labels={MANAGED_BY_LABEL: MANAGED_BY})
+                except APIError as api_error:
+                    if not DockerBackend.__is_already_done(api_error):
+                        raise
+
+        for container in host.client.containers.list(filters={'label': f'{SHARD_ATTACH_LABEL}=true'}):
+            attached = container.attrs['NetworkSettings']['Networks']
+            for name in NETWORK_SHARDS:
+                if name not in attached:
+                    logger.info(f'attaching {container.name} to network {name} on {host.url}')
+                    try:
+                        host.client.networks.get(name).connect(container)
+                    except APIError as api_error:
+                        if not DockerBackend.__is_already_done(api_error):
+                            raise
+
+    @staticmethod
+    def __is_already_done(api_error: APIError) -> bool:
+        # someone else (e.g. a previous leader) created the network or attached the container in the meantime
+        explanation = str(api_error.explanation or '').lower()
+        return (
+            api_error.status_code == http.client.CONFLICT
+            or 'already exists' in explanation
+            or 'already attached' in explanation
+        )
+
+    def __pull_image(self, node: str, image: str, force: bool) -> None:  # noqa: FBT001
+        client = self.__hosts[node].client
+        if not force:
+            try:
+                client.images.get(image)
+            except ImageNotFound:
+                pass
+            else:
+                return
+
+        logger.info(f'pulling {image} on {node}')
+        try:
+            client.images.pull(image)
+        except (APIError, ImageNotFound, NotFound):
+            if not force:
+                raise
+
+            # images built on the host (e.g. challenge daemons) are in no registry, there is nothing to refresh
+            client.images.get(image)
+            logger.info(f'could not refresh {image} on {node}, keeping the local copy')
+
+    def __prefetch_images(self) -> None:
+        now = time.monotonic()
+        for image in self._database.get_images():
+            for host in self.__hosts.values():
+                prefetched_at = self.__prefetched_at.get((host.url, image))
+                if not host.healthy or (prefetched_at is not None and now - prefetched_at < IMAGE_REFRESH_INTERVAL):
+                    continue
+
+                self.__prefetched_at[(host.url, image)] = now
+                self.__images.prefetch(host.url, image, force=True)
+
+    def __place(self, containers: int, *, remote: bool) -> DockerHost:
+        with self.__hosts_lock:
+            candidates = [host for host in self.__hosts.values() if host.healthy and (remote or host.address is None)]
+            if not candidates:
+                msg = 'no healthy docker hosts available'
+                if not remote:
+                    msg += ' for daemons, set DOCKER_REMOTE_ORCHESTRATOR_HOST to run them on remote hosts'
+                raise DockerBackendError(msg)
+
+            host = min(candidates, key=lambda candidate: candidate.load)
+            # account for the new containers right away, so concurrent launches spread out until the next refresh
+            host.containers += containers
+            return host
+
+    def __pick_network(self, host: DockerHost, containers: int) -> str:
+        with self.__hosts_lock:
+            network = min(NETWORK_SHARDS, key=lambda name: host.networks.get(name, 0))
+            host.networks[network] = host.networks.get(network, 0) + containers
+            return network
+
+    def _launch_instance_impl(self, request: CreateInstanceRequest, generation: str) -> UserData:
         instance_id = request['instance_id']
         requested_anvil_instances = request['anvil_instances']
+        labels = self.__get_labels(instance_id, generation) | self._get_owner_labels(request)
+        container_count = len(requested_anvil_instances) + len(request.get('daemon_instances', {}))
+        # daemons talk to the orchestrator, which remote hosts can only reach through an explicitly configured url
+        host = self.__place(
+            container_count, remote=not request.get('daemon_instances') or bool(DOCKER_REMOTE_ORCHESTRATOR_HOST)
+        )
+        network = self.__pick_network(host, container_count)
+        client = host.client
+
+        # normally prefetched already, otherwise only one of the concurrent launches actually pulls
+        with tracer.span('docker.ensure_images', node=host.url):
+            for image in self._get_images(request):
+                self.__images.ensure(host.url, image)
 
-        volume: Volume = self.__client.volumes.create(name=instance_id)
+        volume: Volume | None = None
+        if any(get_persistence(anvil_args) == 'disk' for anvil_args in requested_anvil_instances.values()):
+            volume = client.volumes.create(name=f'{instance_id}-{generation}', labels=labels)
 
         anvil_containers: dict[str, Container] = {}
         for anvil_id, anvil_args in requested_anvil_instances.items():
-            anvil_containers[anvil_id] = self.__client.containers.run(  # type: ignore[call-overload]
-                name=f'{instance_id}-{anvil_id}',
+            anvil_containers[anvil_id] = client.containers.run(  # type: ignore[call-overload]
+                name=f'{instance_id}-{generation}-{anvil_id}',
                 image=anvil_args.get('image', DEFAULT_IMAGE),
-                network='paradigmctf',
+                network=network,
                 entrypoint=['sh', '-c'],
                 command=[
-                    'while true; do anvil '
+                    # sh does not forward signals, so pass SIGTERM on to let anvil dump its state when we are stopped
+                    "trap 'kill -TERM $pid; wait $pid; exit 0' TERM; while true; do anvil "
                     + ' '.join([shlex.quote(str(v)) for v in format_anvil_args(anvil_args, anvil_id)])
-                    + '; sleep 1; done;'
+                    + ' & pid=$!; wait $pid; sleep 1; done;'
                 ],
                 restart_policy={'Name': 'always'},
                 detach=True,
-                mounts=[
-                    Mount(target='/data', source=volume.id),
-                ],
+                labels=labels,
+                **self.__get_limits(anvil_args['cpus'], anvil_args['memory']),  # type: ignore[arg-type]
+                mounts=self.__get_mounts(anvil_args, volume),
+                # containers on other hosts are not on our network, so they are reached through a published port
+                ports={f'{ANVIL_PORT}/tcp': (host.address, None)} if host.address is not None else None,
             )
 
         daemon_containers: dict[str, Container] = {}
+        daemon_limits = self.__get_limits(*get_daemon_limits())
         for daemon_id, daemon_args in request.get('daemon_instances', {}).items():
-            daemon_containers[daemon_id] = self.__client.containers.run(
-                name=f'{instance_id}-{daemon_id}',
+            daemon_containers[daemon_id] = client.containers.run(
+                name=f'{instance_id}-{generation}-{daemon_id}',
                 image=daemon_args['image'],
-                network='paradigmctf',
+                network=network,
                 restart_policy={'Name': 'always'},
                 detach=True,
+                labels=labels,
+                **daemon_limits,
                 environment={
                     'INSTANCE_ID': instance_id,
-                },
+                }
+                | ({'ORCHESTRATOR_HOST': DOCKER_REMOTE_ORCHESTRATOR_HOST} if host.address is not None else {}),
             )
 
         anvil_instances: dict[str, InstanceInfo] = {}
         for anvil_id, anvil_container in anvil_containers.items():
-            container: Container = self.__client.containers.get(anvil_container.id)
+            container: Container = client.containers.get(anvil_container.id)
 
+            ip, port = self.__get_anvil_address(host, container, network)
             anvil_instances[anvil_id] = {
                 'id': anvil_id,
-                'ip': container.attrs['NetworkSettings']['Networks']['paradigmctf']['IPAddress'],
-                'port': 8545,
+                'ip': ip,
+                'port': port,
             }
             self._remap_extra_anvil_keys(anvil_instances[anvil_id], requested_anvil_instances[anvil_id])
 
@@ -94,51 +370,169 @@ class DockerBackend(Backend):
         now = time.time()
         return UserData(
             instance_id=instance_id,
+            generation=generation,
             external_id=self._generate_rpc_id(),
             created_at=now,
             expires_at=now + request['timeout'],
             anvil_instances=anvil_instances,
             daemon_instances=daemon_instances,
             metadata={},
+            node=host.url,
+            network=network,
         )
 
-    def _cleanup_instance(self, args: CreateInstanceRequest) -> None:
-        instance_id = args['instance_id']
+    def _list_resources(self) -> tuple[list[ManagedResources], set[str | None]] | None:
+        launches: dict[tuple[str, str], ManagedResources] = {}
+        nodes: set[str | None] = set()
 
-        self.__try_delete(
-            instance_id,
-            list(args.get('anvil_instances', {}).keys()),
-            list(args.get('daemon_instances', {}).keys()),
-        )
+        filters = {'label': f'{MANAGED_BY_LABEL}={MANAGED_BY}'}
+        for host in self.__hosts.values():
+            if not host.healthy:
+                continue
 
-    def kill_instance(self, instance_id: str) -> UserData | None:
-        instance = self._database.unregister_instance(instance_id)
-        if instance is None:
+            try:
+                containers: list[Container] = host.client.containers.list(all=True, filters=filters)
+                volumes: list[Volume] = host.client.volumes.list(filters=filters)
+            except Exception as e:
+                logger.opt(exception=e).warning(f'failed to list the resources on {host.url}')
+                continue
+
+            nodes.add(host.url)
+            found = [(container.labels, container.attrs['Created']) for container in containers]
+            found += [(volume.attrs.get('Labels') or {}, volume.attrs['CreatedAt']) for volume in volumes]
+            for labels, created in found:
+                if INSTANCE_LABEL not in labels or GENERATION_LABEL not in labels:
+                    continue
+
+                key = (labels[INSTANCE_LABEL], labels[GENERATION_LABEL])
+                created_at = self.__parse_timestamp(created)
+                if key in launches:
+                    launches[key].created_at = min(launches[key].created_at, created_at)
+                else:
+                    launches[key] = ManagedResources(*key, node=host.url, created_at=created_at)
+
+        if not nodes:
             return None
+        return list(launches.values()), nodes
 
-        self.__try_delete(
-            instance_id,
-            list(instance.get('anvil_instances', {}).keys()),
-            list(instance.get('daemon_instances', {}).keys()),
-        )
+    @staticmethod
+    def __parse_timestamp(value: str) -> float:
+        # docker reports nanoseconds, which datetime does not handle
+        return datetime.fromisoformat(re.sub(r'(\.\d{6})\d+', r'\1', value)).timestamp()
 
-        return instance
+    def _stop_instance(self, instance: UserData) -> None:
+        host = self.__get_instance_host(instance)
+        for container in self.__list_containers(host, instance):
+            container.stop(timeout=DOCKER_STOP_TIMEOUT)
 
-    def __try_delete(self, instance_id: str, anvil_ids: list[str], daemon_ids: list[str]) -> None:
-        for anvil_id in anvil_ids:
-            self.__try_delete_container(f'{instance_id}-{anvil_id}')
+    def _start_instance(self, instance: UserData) -> dict[str, InstanceInfo]:
+        host = self.__get_instance_host(instance)
+        prefix = f'{instance["instance_id"]}-{instance["generation"]}-'
 
-        for daemon_id in daemon_ids:
-            self.__try_delete_container(f'{instance_id}-{daemon_id}')
+        anvil_instances: dict[str, InstanceInfo] = {}
+        for container in self.__list_containers(host, instance):
+            container.start()
+            container.reload()
 
-        self.__try_delete_volume(instance_id)
+            # addresses are not kept across restarts
+            anvil_id = container.name.removeprefix(prefix)  # type: ignore[union-attr]
+            if anvil_id in instance['anvil_instances']:
+                ip, port = self.__get_anvil_address(host, container, instance.get('network') or DOCKER_NETWORK)
+                anvil_instances[anvil_id] = instance['anvil_instances'][anvil_id] | {'ip': ip, 'port': port}
+        return anvil_instances
 
-    def __try_delete_container(self, container_name: str) -> None:
-        try:
-            container: Container = self.__client.containers.get(container_name)
-        except NotFound:
-            return
+    def __get_instance_host(self, instance: UserData) -> DockerHost:
+        host = self.__hosts.get(instance.get('node') or 'local')
+        if host is None:
+            msg = f'instance {instance["instance_id"]} lives on an unknown docker host {instance.get("node")}'
+            raise DockerBackendError(msg)
+        return host
+
+    def __list_containers(self, host: DockerHost, instance: UserData) -> list['Container']:
+        labels = self.__get_labels(instance['instance_id'], instance['generation'])
+        return host.client.containers.list(all=True, filters={'label': [f'{k}={v}' for k, v in labels.items()]})
 
+    @staticmethod
+    def __get_anvil_address(host: DockerHost, container: 'Container', network: str) -> tuple[str, int]:
+        network_settings = container.attrs['NetworkSettings']
+        if host.address is None:
+            return network_settings['Networks'][network]['IPAddress'], ANVIL_PORT
+
+        binding = network_settings['Ports'][f'{ANVIL_PORT}/tcp'][0]
+        return host.address, int(binding['HostPort'])
+
+    @staticmethod
+    def __get_mounts(anvil_args: LaunchAnvilInstanceArgs, volume: 'Volume | None') -> list[Mount]:
+        persistence = get_persistence(anvil_args)
+        if persistence == 'disk' and volume is not None:
+            return [Mount(target='/data', source=volume.id)]
+        if persistence == 'tmpfs':
+            # counted against the memory limit of the container, like the rest of anvil's memory
+            return [Mount(target='/data', source=None, type='tmpfs')]
+        return []
+
+    @staticmethod
+    def __get_limits(cpus: float, memory: int) -> dict[str, int | str]:
+        # the swap limit matches the memory one, so that a runaway anvil gets oom killed instead of swapping
+        return {'nano_cpus': int(cpus * 1e9), 'mem_limit': f'{memory}m', 'memswap_limit': f'{memory}m'}
+
+    @staticmethod
+    def __get_labels(instance_id: str, generation: str) -> dict[str, str]:
+        return {
+            MANAGED_BY_LABEL: MANAGED_BY,
+            INSTANCE_LABEL: instance_id,
+            GENERATION_LABEL: generation,
+        }
+
+    def _destroy_instance(self, instance_id: str, generation: str, node: str | None) -> None:
+        filters = {'label': [f'{k}={v}' for k, v in self.__get_labels(instance_id, generation).items()]}
+
+        # we do not know where failed launches were placed, so look for their leftovers everywhere
+        hosts = [self.__hosts[node]] if node in self.__hosts else list(self.__hosts.values())
+        deleted = True
+        for host in hosts:
+            containers: list[Container] = host.client.containers.list(all=True, filters=filters)
+            for container in containers:
+                deleted &= self.__try_delete_container(container)
+
+            volumes: list[Volume] = host.client.volumes.list(filters=filters)
+            for volume in volumes:
+                deleted &= self.__try_delete_volume(volume)
+
+        if not deleted:
+            msg = f'failed to delete some resources of instance {instance_id} ({generation})'
+            raise DockerBackendError(msg)
+
+    def _destroy_legacy_instance(self, instance: UserData) -> None:
+        # before generations, the containers were named after the instance and the volume was the instance id. Such
+        # instances predate multiple hosts, but the daemon they ran on might be any of the configured ones now
+        instance_id = instance['instance_id']
+        names = [
+            f'{instance_id}-{resource_id}'
+            for resource_id in [*instance['anvil_instances'], *instance['daemon_instances']]
+        ]
+        deleted = True
+        for host in self.__hosts.values():
+            for name in names:
+                try:
+                    container: Container = host.client.containers.get(name)
+                except NotFound:
+                    continue
+                deleted &= self.__try_delete_container(container)
+
+            try:
+                volume: Volume = host.client.volumes.get(instance_id)
+            except NotFound:
+                continue
+            deleted &= self.__try_delete_volume(volume)
+
+        if not deleted:
+            msg = f'failed to delete some resources of instance {instance_id}'
+            raise DockerBackendError(msg)
+
+    @staticmethod
+    def __try_delete_container(container: 'Container') -> bool:
+        """Returns whether the container is gone."""
         logger.info(f'deleting container {container.id} ({container.name})')
         try:
             try:
@@ -148,17 +542,21 @@ class DockerBackend(Backend):
                 if api_error.status_code != http.client.CONFLICT:
                     raise
             container.remove()
+        except NotFound:
+            pass
         except Exception as e:
             logger.opt(exception=e).error(f'failed to delete container {container.name} ({container.id})')
+            return False
+        return True
 
-    def __try_delete_volume(self, volume_name: str) -> None:
-        try:
-            volume: Volume = self.__client.volumes.get(volume_name)
-        except NotFound:
-            return
-
+    @staticmethod
+    def __try_delete_volume(volume: 'Volume') -> bool:
         logger.info(f'deleting volume {volume.name} ({volume.id})')
         try:
             volume.remove()
+        except NotFound:
+            pass
         except Exception as e:
             logger.opt(exception=e).error(f'failed to delete volume {volume.name} ({volume.id})')
+            return False
+        return True
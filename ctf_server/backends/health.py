@@ -0,0 +1,100 @@
+import os
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from loguru import logger
+
+from ctf_server.databases.database import Database
+from ctf_server.types import HealthStatus, UserData, keeps_state
+from ctf_server.utils import worker
+
+
+HEALTH_CHECK_INTERVAL = float(os.getenv('HEALTH_CHECK_INTERVAL', '30'))
+HEALTH_CHECK_TIMEOUT = float(os.getenv('HEALTH_CHECK_TIMEOUT', '3'))
+HEALTH_CHECK_WORKERS = int(os.getenv('HEALTH_CHECK_WORKERS', '16'))
+# Instances checked by a single pass, the ones checked the longest ago go first. With the interval this bounds the
+# probes per second no matter how many instances are running
+HEALTH_CHECK_BATCH_SIZE = int(os.getenv('HEALTH_CHECK_BATCH_SIZE', '500'))
+# Consecutive failed checks before the instance gets restarted, 0 disables restarts
+HEALTH_RESTART_AFTER = int(os.getenv('HEALTH_RESTART_AFTER', '3'))
+
+
+class HealthMonitor:
+    """Probes the anvils of every live instance and records how they are doing in the database.
+
+    Only the leader checks. Instances that keep failing are restarted through `restart_instance`, if the backend can
+    and if their anvils keep their state on disk.
+    """
+
+    def __init__(self, database: Database, restart_instance: Callable[[str], object] | None) -> None:
+        self.__database = database
+        self.__restart_instance = restart_instance
+        self.__pool = ThreadPoolExecutor(max_workers=HEALTH_CHECK_WORKERS, thread_name_prefix='Health Monitor')
+
+    def check(self) -> None:
+        instances = [
+            instance
+            for instance in self.__database.get_all_instances()
+            # hibernated anvils are down on purpose, and woken up by the proxy
+            if not instance.get('hibernated')
+        ]
+        instances.sort(key=lambda instance: instance.get('health', {}).get('checked_at', 0.0))
+
+        statuses = list(self.__pool.map(self.__check_instance, instances[:HEALTH_CHECK_BATCH_SIZE]))
+        unhealthy = sum(not status['healthy'] for status in statuses)
+        if unhealthy:
+            logger.warning(f'{unhealthy} of {len(statuses)} checked instances are unhealthy')
+
+    def __check_instance(self, instance: UserData) -> HealthStatus:
+        probes = [self.__probe(anvil['ip'], anvil['port']) for anvil in instance['anvil_instances'].values()]
+        latencies = [latency for latency in probes if latency is not None]
+        healthy = len(latencies) == len(probes)
+        previous = instance.get('health')
+
+        status = HealthStatus(
+            healthy=healthy,
+            latency=max(latencies, default=0.0) if healthy else None,
+            checked_at=time.time(),
+            failures=0 if healthy else (previous['failures'] if previous else 0) + 1,
+        )
+        if not healthy and HEALTH_RESTART_AFTER > 0 and status['failures'] >= HEALTH_RESTART_AFTER:
+            status = self.__try_restart(instance, status)
+
+        try:
+            self.__database.update_instance(instance['instance_id'], {'health': status})
+        except Exception as e:
+            logger.opt(exception=e).warning(f'failed to record the health of instance {instance["instance_id"]}')
+        return status
+
+    def __try_restart(self, instance: UserData, status: HealthStatus) -> HealthStatus:
+        # anvils that do not keep their state on disk would come back empty, better keep them around unhealthy
+        if self.__restart_instance is None or not keeps_state(instance) or not worker.still_leader():
+            return status
+
+        logger.warning(f'restarting instance {instance["instance_id"]}, it failed {status["failures"]} checks in a row')
+        try:
+            self.__restart_instance(instance['instance_id'])
+        except Exception as e:
+            logger.opt(exception=e).error(f'failed to restart unhealthy instance {instance["instance_id"]}')
+            return status
+
+        # the restart waited for the anvils to come back up
+        return HealthStatus(healthy=True, latency=None, checked_at=time.time(), failures=0)
+
+    @staticmethod
+    def __probe(ip: str | None, port: int | None) -> float | None:
+        """Returns how long the anvil took to answer a trivial request, or None if it did not."""
+        started_at = time.monotonic()
+        try:
+            resp = requests.post(
+                f'http://{ip}:{port}',
+                json={'jsonrpc': '2.0', 'id': 1, 'method': 'eth_blockNumber', 'params': []},
+                timeout=HEALTH_CHECK_TIMEOUT,
+            )
+            if 'result' not in resp.json():
+                return None
+        except (requests.RequestException, ValueError):
+            return None
+        return time.monotonic() - started_at
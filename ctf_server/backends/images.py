@@ -0,0 +1,72 @@
+import time
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+
+from loguru import logger
+
+from ctf_server.databases.database import Database
+
+
+IMAGE_PULL_WORKERS = 4
+IMAGE_PULL_TIMEOUT = 600
+# Images can disappear from a node (e.g. pruned by hand), so launches check again once a pull is this old
+IMAGE_READY_TTL = 300
+
+
+class ImagePuller:
+    """Pulls images onto nodes, so that every image is pulled at most once at a time per node.
+
+    Launches needing an image that is already being pulled wait on that pull instead of starting their own. `pull` is
+    called with the node, the image and whether to pull it even if the node already has it (to pick up new versions of
+    moving tags).
+    """
+
+    def __init__(self, database: Database, pull: Callable[[str, str, bool], None]) -> None:
+        self.__database = database
+        self.__pull = pull
+
+        self.__pool = ThreadPoolExecutor(max_workers=IMAGE_PULL_WORKERS, thread_name_prefix='Image Puller')
+        # forced refreshes are kept apart, a launch only needs the image to be there and must not wait for them
+        self.__pulls: dict[tuple[str, str, bool], Future[None]] = {}
+        # when each image was last known to be on each node
+        self.__ready: dict[tuple[str, str], float] = {}
+        self.__lock = Lock()
+
+    def ensure(self, node: str, image: str) -> None:
+        """Blocks until `image` is on `node`."""
+        ready_at = self.__ready.get((node, image))
+        if ready_at is not None and time.monotonic() - ready_at < IMAGE_READY_TTL:
+            return
+
+        self.__start(node, image, force=False).result(timeout=IMAGE_PULL_TIMEOUT)
+
+    def prefetch(self, node: str, image: str, *, force: bool) -> None:
+        self.__start(node, image, force=force)
+
+    def __start(self, node: str, image: str, *, force: bool) -> Future[None]:
+        with self.__lock:
+            pull = self.__pulls.get((node, image, force))
+            if pull is None or pull.done():
+                pull = self.__pool.submit(self.__run, node, image, force)
+                self.__pulls[(node, image, force)] = pull
+            return pull
+
+    def __run(self, node: str, image: str, force: bool) -> None:  # noqa: FBT001
+        self.__set_status(node, image, 'pulling')
+        try:
+            self.__pull(node, image, force)
+        except Exception as e:
+            self.__ready.pop((node, image), None)
+            logger.opt(exception=e).error(f'failed to pull {image} on {node}')
+            self.__set_status(node, image, 'failed', str(e))
+            raise
+
+        self.__ready[(node, image)] = time.monotonic()
+        self.__set_status(node, image, 'ready')
+
+    def __set_status(self, node: str, image: str, state: str, error: str | None = None) -> None:
+        try:
+            self.__database.set_image_status(image, node, {'state': state, 'updated_at': time.time(), 'error': error})
+        except Exception as e:
+            logger.opt(exception=e).warning(f'failed to record the status of {image} on {node}')
@@ -1,4 +1,5 @@
 import http.client
+import os
 import shlex
 import time
 from typing import TYPE_CHECKING, Any
@@ -10,15 +11,36 @@ from loguru import logger
 from web3 import Web3
 
 from ctf_server.databases.database import Database
-from ctf_server.types import DEFAULT_IMAGE, CreateInstanceRequest, InstanceInfo, UserData, format_anvil_args
-
-from .backend import Backend
+from ctf_server.tracing import tracer
+from ctf_server.types import (
+    DEFAULT_IMAGE,
+    CreateInstanceRequest,
+    InstanceInfo,
+    LaunchAnvilInstanceArgs,
+    UserData,
+    format_anvil_args,
+    get_persistence,
+)
+
+from .backend import GENERATION_LABEL, INSTANCE_LABEL, MANAGED_BY, MANAGED_BY_LABEL, Backend, ManagedResources
+from .pod_informer import PodInformer
+from .resources import get_daemon_limits
 
 
 if TYPE_CHECKING:
     from kubernetes.client.models import V1Pod
 
 
+KUBERNETES_NAMESPACE = os.getenv('KUBERNETES_NAMESPACE', 'default')
+POD_STARTUP_TIMEOUT = 120
+# Generations matched by a single bulk delete, keeps the label selectors well within the request size limits
+BULK_DELETE_BATCH_SIZE = 100
+
+
+class KubernetesBackendError(Exception):
+    """Custom exception for Kubernetes backend errors."""
+
+
 class KubernetesBackend(Backend):
     def __init__(self, database: Database, kubeconfig: str) -> None:
         if kubeconfig == 'incluster':
@@ -27,32 +49,44 @@ class KubernetesBackend(Backend):
             config.load_kube_config(kubeconfig)
 
         self.__core_v1 = core_v1_api.CoreV1Api()
+        self.__pods = PodInformer(self.__core_v1, KUBERNETES_NAMESPACE, f'{MANAGED_BY_LABEL}={MANAGED_BY}')
+        self.__pods.start()
 
         # note(es3n1n, 28.03.24): see docker backend ctor if you're wondering why we are doing this after the vars init
         super().__init__(database)
 
-    def _launch_instance_impl(self, request: CreateInstanceRequest) -> UserData:
+    def _launch_instance_impl(self, request: CreateInstanceRequest, generation: str) -> UserData:
         instance_id = request['instance_id']
+        pod_name = f'{instance_id}-{generation}'
 
         pod_manifest = {
             'apiVersion': 'v1',
             'kind': 'Pod',
-            'metadata': {'name': instance_id},
+            'metadata': {
+                'name': pod_name,
+                'labels': {
+                    MANAGED_BY_LABEL: MANAGED_BY,
+                    INSTANCE_LABEL: instance_id,
+                    GENERATION_LABEL: generation,
+                    **self._get_owner_labels(request),
+                },
+            },
             'spec': {
-                'volumes': [{'name': 'workdir', 'emptyDir': {}}],
+                'volumes': self.__get_volumes(request),
                 'containers': self.__get_anvil_containers(request) + self.__get_daemon_containers(request),
             },
         }
 
-        api_response: V1Pod = self.__core_v1.create_namespaced_pod(namespace='default', body=pod_manifest)
-        while True:
-            api_response = self.__core_v1.read_namespaced_pod(
-                name=pod_manifest['metadata']['name'],  # type: ignore[index]
-                namespace='default',
+        self.__core_v1.create_namespaced_pod(namespace=KUBERNETES_NAMESPACE, body=pod_manifest)
+        with tracer.span('kubernetes.wait_for_pod'):
+            api_response: V1Pod | None = self.__pods.wait_for(
+                pod_name,
+                lambda pod: pod is not None and pod.status.phase != 'Pending',
+                POD_STARTUP_TIMEOUT,
             )
-            if api_response.status.phase != 'Pending':
-                break
-            time.sleep(1)
+        if api_response is None or api_response.status.phase != 'Running':
+            msg = f'pod {pod_name} failed to start'
+            raise KubernetesBackendError(msg)
 
         anvil_instances: dict[str, InstanceInfo] = {}
         for offset, anvil_id in enumerate(request.get('anvil_instances', {}).keys()):
@@ -77,6 +111,7 @@ class KubernetesBackend(Backend):
         now = time.time()
         return UserData(
             instance_id=instance_id,
+            generation=generation,
             external_id=self._generate_rpc_id(),
             created_at=now,
             expires_at=now + request['timeout'],
@@ -96,17 +131,14 @@ class KubernetesBackend(Backend):
                     + ' '.join([shlex.quote(str(v)) for v in format_anvil_args(anvil_args, anvil_id, 8545 + offset)])
                     + '; sleep 1; done;'
                 ],
-                'volumeMounts': [
-                    {
-                        'mountPath': '/data',
-                        'name': 'workdir',
-                    }
-                ],
+                'volumeMounts': self.__get_volume_mounts(anvil_args),
+                'resources': self.__get_resources(anvil_args['cpus'], anvil_args['memory']),  # type: ignore[arg-type]
             }
             for offset, (anvil_id, anvil_args) in enumerate(args.get('anvil_instances', {}).items())
         ]
 
     def __get_daemon_containers(self, args: CreateInstanceRequest) -> list[Any]:
+        resources = self.__get_resources(*get_daemon_limits())
         return [
             {
                 'name': daemon_id,
@@ -117,53 +149,87 @@ class KubernetesBackend(Backend):
                         'value': args['instance_id'],
                     }
                 ],
+                'resources': resources,
             }
             for (daemon_id, daemon_args) in args.get('daemon_instances', {}).items()
         ]
 
-    def kill_instance(self, instance_id: str) -> UserData | None:
-        instance = self._database.unregister_instance(instance_id)
-        if instance is None:
+    def _list_resources(self) -> tuple[list[ManagedResources], set[str | None]] | None:
+        pods = self.__pods.list()
+        if pods is None:
             return None
 
-        self.__core_v1.delete_namespaced_pod(namespace='default', name=instance_id, grace_period_seconds=0)
-
-        while True:
-            try:
-                self.__core_v1.read_namespaced_pod(
-                    namespace='default',
-                    name=instance_id,
-                )
-            except ApiException as e:
-                if e.status == http.client.NOT_FOUND:
-                    break
-
-            time.sleep(0.5)
-
-        return instance
-
-    def _cleanup_instance(self, args: CreateInstanceRequest) -> None:
-        instance_id = args['instance_id']
-        logger.warning(f'cleaning up instance: {instance_id}')
+        resources = [
+            ManagedResources(
+                instance_id=pod.metadata.labels[INSTANCE_LABEL],
+                generation=pod.metadata.labels[GENERATION_LABEL],
+                node=None,
+                created_at=pod.metadata.creation_timestamp.timestamp(),
+            )
+            for pod in pods
+            if INSTANCE_LABEL in (pod.metadata.labels or {}) and GENERATION_LABEL in pod.metadata.labels
+        ]
+        # every pod is a single launch, and pods are not placed by us
+        return resources, {None}
+
+    @staticmethod
+    def __get_volumes(args: CreateInstanceRequest) -> list[Any]:
+        used = {get_persistence(anvil_args) for anvil_args in args.get('anvil_instances', {}).values()}
+
+        volumes: list[Any] = []
+        if 'disk' in used:
+            volumes.append({'name': 'workdir', 'emptyDir': {}})
+        if 'tmpfs' in used:
+            volumes.append({'name': 'tmpdir', 'emptyDir': {'medium': 'Memory'}})
+        return volumes
+
+    @staticmethod
+    def __get_volume_mounts(anvil_args: LaunchAnvilInstanceArgs) -> list[Any]:
+        volume = {'disk': 'workdir', 'tmpfs': 'tmpdir'}.get(get_persistence(anvil_args))
+        if volume is None:
+            return []
+        return [{'mountPath': '/data', 'name': volume}]
+
+    @staticmethod
+    def __get_resources(cpus: float, memory: int) -> dict[str, dict[str, str]]:
+        # requests match the limits, so the scheduler packs nodes by what instances may actually use
+        quantities = {'cpu': f'{int(cpus * 1000)}m', 'memory': f'{memory}Mi'}
+        return {'requests': quantities, 'limits': quantities}
+
+    def _destroy_instance(self, instance_id: str, generation: str, _: str | None) -> None:
+        self.__delete_pod(f'{instance_id}-{generation}')
+
+    def __delete_pod(self, pod_name: str) -> None:
+        logger.info(f'deleting pod {pod_name}')
 
         try:
             self.__core_v1.delete_namespaced_pod(
-                namespace='default',
-                name=instance_id,
+                namespace=KUBERNETES_NAMESPACE,
+                name=pod_name,
                 grace_period_seconds=0,
                 propagation_policy='Background',
             )
         except ApiException as e:
             if e.status != http.client.NOT_FOUND:
-                logger.opt(exception=e).error(f'cannot delete pod {instance_id} during cleanup')
-                return
-
-        # wait until the pod disappears so that a subsequent launch can reuse the name
-        while True:
-            try:
-                self.__core_v1.read_namespaced_pod(name=instance_id, namespace='default')
-                time.sleep(0.5)
-            except ApiException as e:
-                if e.status == http.client.NOT_FOUND:
-                    break
                 raise
+
+    def _destroy_legacy_instance(self, instance: UserData) -> None:
+        # before generations, the pod was named after the instance
+        self.__delete_pod(instance['instance_id'])
+
+    def _destroy_instances(self, instances: list[UserData]) -> None:
+        for instance in instances:
+            if instance.get('generation') is None:
+                self._destroy_legacy_instance(instance)
+
+        # generations are unique per launch, so this never catches a pod launched after the instances were killed
+        generations = sorted({generation for instance in instances if (generation := instance.get('generation'))})
+        for i in range(0, len(generations), BULK_DELETE_BATCH_SIZE):
+            batch = generations[i : i + BULK_DELETE_BATCH_SIZE]
+            logger.info(f'deleting {len(batch)} pods in bulk')
+            self.__core_v1.delete_collection_namespaced_pod(
+                namespace=KUBERNETES_NAMESPACE,
+                label_selector=f'{MANAGED_BY_LABEL}={MANAGED_BY},{GENERATION_LABEL} in ({",".join(batch)})',
+                grace_period_seconds=0,
+                propagation_policy='Background',
+            )
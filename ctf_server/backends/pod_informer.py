@@ -0,0 +1,78 @@
+import time
+from collections.abc import Callable
+from threading import Condition, Thread
+from typing import TYPE_CHECKING
+
+from kubernetes import watch
+from loguru import logger
+
+
+if TYPE_CHECKING:
+    from kubernetes.client.api import core_v1_api
+    from kubernetes.client.models import V1Pod
+
+
+class PodInformer:
+    """Local cache of the pods matching a label selector, fed by a single list+watch stream instead of polling."""
+
+    def __init__(self, core_v1: 'core_v1_api.CoreV1Api', namespace: str, label_selector: str) -> None:
+        self.__core_v1 = core_v1
+        self.__namespace = namespace
+        self.__label_selector = label_selector
+
+        self.__pods: dict[str, V1Pod] = {}
+        self.__synced = False
+        self.__condition = Condition()
+
+    def start(self) -> None:
+        Thread(target=self.__run, name=f'{self.__class__.__name__} Watcher', daemon=True).start()
+
+    def get(self, name: str) -> 'V1Pod | None':
+        with self.__condition:
+            return self.__pods.get(name)
+
+    def list(self) -> list['V1Pod'] | None:
+        """Returns every cached pod, or None until the cache has been synced for the first time."""
+        with self.__condition:
+            return list(self.__pods.values()) if self.__synced else None
+
+    def wait_for(self, name: str, predicate: Callable[['V1Pod | None'], bool], timeout: float) -> 'V1Pod | None':
+        """Waits until `predicate` holds for the cached pod `name` (None if missing) and returns it."""
+        with self.__condition:
+            if not self.__condition.wait_for(lambda: self.__synced and predicate(self.__pods.get(name)), timeout):
+                msg = f'timed out waiting for pod {name} in {self.__namespace}'
+                raise TimeoutError(msg)
+            return self.__pods.get(name)
+
+    def __run(self) -> None:
+        while True:
+            try:
+                self.__watch(self.__list())
+            except Exception as e:
+                logger.opt(exception=e).warning('pod watch stream failed, resyncing')
+                time.sleep(1)
+
+    def __list(self) -> str:
+        pods = self.__core_v1.list_namespaced_pod(namespace=self.__namespace, label_selector=self.__label_selector)
+        with self.__condition:
+            self.__pods = {pod.metadata.name: pod for pod in pods.items}
+            self.__synced = True
+            self.__condition.notify_all()
+        return pods.metadata.resource_version
+
+    def __watch(self, resource_version: str) -> None:
+        # note: the stream resumes by itself from the last seen resource version when the server closes it, and raises
+        # once the version is too old (410 Gone), in which case we fall back to relisting
+        for event in watch.Watch().stream(
+            self.__core_v1.list_namespaced_pod,
+            namespace=self.__namespace,
+            label_selector=self.__label_selector,
+            resource_version=resource_version,
+        ):
+            pod: V1Pod = event['object']
+            with self.__condition:
+                if event['type'] == 'DELETED':
+                    self.__pods.pop(pod.metadata.name, None)
+                else:
+                    self.__pods[pod.metadata.name] = pod
+                self.__condition.notify_all()
@@ -0,0 +1,278 @@
+import os
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from threading import Thread
+
+from loguru import logger
+from web3 import Web3
+
+from ctf_server.databases.database import Database
+from ctf_server.types import (
+    CreateInstanceRequest,
+    InstanceInfo,
+    LaunchAnvilInstanceArgs,
+    UserData,
+    format_anvil_args,
+    get_persistence,
+)
+
+from .backend import Backend, ManagedResources
+
+
+# Started in place of anvil for every anvil instance, anything that speaks json-rpc on `--port` will do
+PROCESS_ANVIL_BINARY = os.getenv('PROCESS_ANVIL_BINARY', '/opt/foundry/bin/anvil')
+# Every launch gets a directory in here, holding its ports, supervisors and on-disk state
+PROCESS_WORKDIR = Path(os.getenv('PROCESS_WORKDIR', Path(tempfile.gettempdir()) / 'paradigmctf-instances'))
+# Where anvils with `tmpfs` persistence keep their state
+PROCESS_TMPFS_DIR = Path(os.getenv('PROCESS_TMPFS_DIR', '/dev/shm/paradigmctf-instances'))  # noqa: S108
+PROCESS_HOST = os.getenv('PROCESS_HOST', '127.0.0.1')
+PROCESS_PORT_MIN = int(os.getenv('PROCESS_PORT_MIN', '20000'))
+PROCESS_PORT_MAX = int(os.getenv('PROCESS_PORT_MAX', '29999'))
+# A cgroup v2 directory delegated to us, without one only the memory is capped (through rlimits)
+PROCESS_CGROUP_ROOT = os.getenv('PROCESS_CGROUP_ROOT')
+CGROUP_CPU_PERIOD = 100_000
+
+PROCESS_STARTUP_TIMEOUT = 30
+PROCESS_STOP_TIMEOUT = 10
+
+
+class ProcessBackendError(Exception):
+    """Custom exception for process backend errors."""
+
+
+class ProcessBackend(Backend):
+    """Runs anvils as supervised processes on this machine, without any container runtime.
+
+    Everything about a launch is kept within its working directory, so any worker can stop, restart or tear down what
+    another one launched.
+    """
+
+    def __init__(self, database: Database) -> None:
+        (PROCESS_WORKDIR / 'ports').mkdir(parents=True, exist_ok=True)
+        super().__init__(database)
+
+    @property
+    def supports_hibernation(self) -> bool:
+        return True
+
+    def _launch_instance_impl(self, request: CreateInstanceRequest, generation: str) -> UserData:
+        if request.get('daemon_instances'):
+            msg = 'daemon instances are not supported by the process backend'
+            raise ProcessBackendError(msg)
+
+        instance_id = request['instance_id']
+        launch_dir = PROCESS_WORKDIR / f'{instance_id}-{generation}'
+        launch_dir.mkdir()
+
+        anvil_instances: dict[str, InstanceInfo] = {}
+        for anvil_id, anvil_args in request.get('anvil_instances', {}).items():
+            port = self.__claim_port(launch_dir, anvil_id)
+            script = self.__write_supervisor(launch_dir, anvil_id, anvil_args, port)
+            self.__spawn(script)
+
+            anvil_instances[anvil_id] = {
+                'id': anvil_id,
+                'ip': PROCESS_HOST,
+                'port': port,
+            }
+            self._remap_extra_anvil_keys(anvil_instances[anvil_id], anvil_args)
+
+        for anvil_id, anvil_instance in anvil_instances.items():
+            web3 = Web3(Web3.HTTPProvider(f'http://{anvil_instance["ip"]}:{anvil_instance["port"]}'))
+            self.__wait_until_reachable(web3)
+            self._prepare_node(request['anvil_instances'][anvil_id], web3)
+
+        now = time.time()
+        return UserData(
+            instance_id=instance_id,
+            generation=generation,
+            external_id=self._generate_rpc_id(),
+            created_at=now,
+            expires_at=now + request['timeout'],
+            anvil_instances=anvil_instances,
+            daemon_instances={},
+            metadata={},
+        )
+
+    @staticmethod
+    def __claim_port(launch_dir: Path, anvil_id: str) -> int:
+        # claims are files created exclusively, so concurrent launches in other workers never get the same port
+        for port in range(PROCESS_PORT_MIN, PROCESS_PORT_MAX + 1):
+            claim = PROCESS_WORKDIR / 'ports' / str(port)
+            try:
+                fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+
+            with os.fdopen(fd, 'w') as f:
+                f.write(launch_dir.name)
+
+            # something that is not ours might be listening on it
+            with socket.socket() as sock:
+                try:
+                    sock.bind((PROCESS_HOST, port))
+                except OSError:
+                    claim.unlink(missing_ok=True)
+                    continue
+
+            (launch_dir / f'{anvil_id}.port').write_text(str(port))
+            return port
+
+        msg = 'no free ports left'
+        raise ProcessBackendError(msg)
+
+    @staticmethod
+    def __write_supervisor(launch_dir: Path, anvil_id: str, anvil_args: LaunchAnvilInstanceArgs, port: int) -> Path:
+        state_dir = PROCESS_TMPFS_DIR / launch_dir.name if get_persistence(anvil_args) == 'tmpfs' else launch_dir
+        state_dir.mkdir(parents=True, exist_ok=True)
+
+        # the limits are always set once the resource profile got applied, running without them would be unbounded
+        cpus, memory = anvil_args.get('cpus'), anvil_args.get('memory')
+        if not cpus or not memory:
+            msg = f'anvil {anvil_id} has no cpu or memory limit'
+            raise ProcessBackendError(msg)
+
+        lines = []
+        if PROCESS_CGROUP_ROOT is not None:
+            cgroup = Path(PROCESS_CGROUP_ROOT) / f'{launch_dir.name}-{anvil_id}'
+            cgroup.mkdir(exist_ok=True)
+            (cgroup / 'cpu.max').write_text(f'{int(cpus * CGROUP_CPU_PERIOD)} {CGROUP_CPU_PERIOD}')
+            (cgroup / 'memory.max').write_text(str(memory * 1024 * 1024))
+            lines.append(f'echo $$ > {shlex.quote(str(cgroup / "cgroup.procs"))}')
+        else:
+            # rlimits have no notion of a cpu share, so only the memory is capped
+            lines.append(f'ulimit -d {memory * 1024}')
+
+        command = [
+            PROCESS_ANVIL_BINARY,
+            *format_anvil_args(anvil_args, anvil_id, port, host=PROCESS_HOST, state_dir=str(state_dir)),
+        ]
+        lines += [
+            # same supervision as the containers get: restart anvil when it dies, let it dump its state when stopped
+            "trap 'kill -TERM $pid; wait $pid; exit 0' TERM",
+            f'while true; do {shlex.join(command)} & pid=$!; wait $pid; sleep 1; done',
+        ]
+
+        script = launch_dir / f'{anvil_id}.sh'
+        script.write_text('\n'.join(lines) + '\n')
+        return script
+
+    @staticmethod
+    def __spawn(script: Path) -> None:
+        # the script is written by us, with every argument quoted
+        proc = subprocess.Popen(
+            args=['/bin/sh', str(script)],
+            cwd=script.parent,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            # its own process group, so that the supervisor and its anvil go down together
+            start_new_session=True,
+        )
+        script.with_suffix('.pid').write_text(str(proc.pid))
+        # whichever worker ends up killing it, the one that spawned it reaps it
+        Thread(target=proc.wait, name=f'Supervisor {proc.pid}', daemon=True).start()
+
+    @staticmethod
+    def __wait_until_reachable(web3: Web3) -> None:
+        deadline = time.monotonic() + PROCESS_STARTUP_TIMEOUT
+        while not web3.is_connected():
+            if time.monotonic() > deadline:
+                msg = 'anvil failed to start'
+                raise ProcessBackendError(msg)
+            time.sleep(0.05)
+
+    @staticmethod
+    def __signal_supervisors(launch_dir: Path, sig: signal.Signals) -> list[int]:
+        pgids = []
+        for pid_file in launch_dir.glob('*.pid'):
+            pgid = int(pid_file.read_text())
+            try:
+                os.killpg(pgid, sig)
+            except ProcessLookupError:
+                continue
+            pgids.append(pgid)
+        return pgids
+
+    @staticmethod
+    def __is_group_alive(pgid: int) -> bool:
+        try:
+            os.killpg(pgid, 0)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def _stop_instance(self, instance: UserData) -> None:
+        launch_dir = PROCESS_WORKDIR / f'{instance["instance_id"]}-{instance["generation"]}'
+        pgids = self.__signal_supervisors(launch_dir, signal.SIGTERM)
+
+        deadline = time.monotonic() + PROCESS_STOP_TIMEOUT
+        while any(self.__is_group_alive(pgid) for pgid in pgids):
+            if time.monotonic() > deadline:
+                logger.warning(f'anvils of {instance["instance_id"]} did not stop in time, killing them')
+                self.__signal_supervisors(launch_dir, signal.SIGKILL)
+                break
+            time.sleep(0.1)
+
+    def _start_instance(self, instance: UserData) -> dict[str, InstanceInfo]:
+        launch_dir = PROCESS_WORKDIR / f'{instance["instance_id"]}-{instance["generation"]}'
+        # the ports stay claimed while the instance sleeps, so it comes back exactly where it was
+        for anvil_id in instance['anvil_instances']:
+            self.__spawn(launch_dir / f'{anvil_id}.sh')
+        return instance['anvil_instances']
+
+    def _list_resources(self) -> tuple[list[ManagedResources], set[str | None]] | None:
+        resources = []
+        for launch_dir in PROCESS_WORKDIR.iterdir():
+            if launch_dir.name == 'ports' or '-' not in launch_dir.name:
+                continue
+
+            instance_id, generation = launch_dir.name.rsplit('-', 1)
+            resources.append(
+                ManagedResources(
+                    instance_id=instance_id,
+                    generation=generation,
+                    node=None,
+                    created_at=launch_dir.stat().st_mtime,
+                )
+            )
+        return resources, {None}
+
+    def _destroy_instance(self, instance_id: str, generation: str, _: str | None) -> None:
+        launch_dir = PROCESS_WORKDIR / f'{instance_id}-{generation}'
+        if not launch_dir.exists():
+            return
+
+        logger.info(f'killing processes of {launch_dir.name}')
+        self.__signal_supervisors(launch_dir, signal.SIGKILL)
+
+        for port_file in launch_dir.glob('*.port'):
+            claim = PROCESS_WORKDIR / 'ports' / port_file.read_text()
+            if claim.exists() and claim.read_text() == launch_dir.name:
+                claim.unlink(missing_ok=True)
+
+        if PROCESS_CGROUP_ROOT is not None:
+            for script in launch_dir.glob('*.sh'):
+                self.__try_remove_cgroup(Path(PROCESS_CGROUP_ROOT) / f'{launch_dir.name}-{script.stem}')
+
+        shutil.rmtree(PROCESS_TMPFS_DIR / launch_dir.name, ignore_errors=True)
+        shutil.rmtree(launch_dir, ignore_errors=True)
+
+    @staticmethod
+    def __try_remove_cgroup(cgroup: Path) -> None:
+        # killed processes leave the cgroup asynchronously, it can only be removed once it is empty
+        deadline = time.monotonic() + PROCESS_STOP_TIMEOUT
+        while cgroup.exists():
+            try:
+                cgroup.rmdir()
+            except OSError:
+                if time.monotonic() > deadline:
+                    logger.warning(f'failed to remove cgroup {cgroup}')
+                    return
+                time.sleep(0.1)
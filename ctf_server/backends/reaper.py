@@ -0,0 +1,102 @@
+import os
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+
+from loguru import logger
+
+from ctf_server.databases.database import Database
+from ctf_server.events import publish_event
+from ctf_server.utils import worker
+
+
+REAPER_WORKERS = int(os.getenv('REAPER_WORKERS', '8'))
+REAPER_MAX_ATTEMPTS = 5
+# Upper bound for a single sleep, covers missed notifications and clock drift between the replicas
+REAPER_MAX_SLEEP = 30.0
+# Lower bound while the backlog is not empty, so we do not spin on instances that are already being torn down
+REAPER_BACKLOG_SLEEP = 0.5
+
+
+class InstanceReaper:
+    """Kills expired instances through a bounded worker pool.
+
+    Only the leader worker reaps. Instead of polling, the reaper sleeps until the closest expiry, or until the database
+    tells it that the set of expiries has changed (a new instance with an earlier deadline got registered, for example).
+    """
+
+    def __init__(self, database: Database, kill_instance: Callable[[str], object]) -> None:
+        self.__database = database
+        self.__kill_instance = kill_instance
+
+        self.__pool = ThreadPoolExecutor(max_workers=REAPER_WORKERS, thread_name_prefix='Instance Reaper')
+        self.__in_flight: set[str] = set()
+        self.__in_flight_lock = Lock()
+
+    @property
+    def backlog(self) -> int:
+        with self.__in_flight_lock:
+            return len(self.__in_flight)
+
+    def start(self) -> None:
+        Thread(target=self.__run, name='Instance Reaper Scheduler', daemon=True).start()
+
+    def __run(self) -> None:
+        while True:
+            if not worker.is_leader:
+                time.sleep(1)
+                continue
+
+            try:
+                self.__reap()
+                timeout = self.__get_sleep_time()
+            except Exception as e:
+                logger.opt(exception=e).error('failed to schedule expired instances')
+                timeout = 1.0
+
+            self.__database.wait_for_expiry_change(timeout)
+
+    def __get_sleep_time(self) -> float:
+        timeout = REAPER_MAX_SLEEP
+        next_expiry = self.__database.get_next_expiry()
+        if next_expiry is not None:
+            timeout = min(timeout, next_expiry - time.time())
+
+        return max(timeout, REAPER_BACKLOG_SLEEP if self.backlog else 0.0)
+
+    def __reap(self) -> None:
+        for instance_id in self.__database.get_expired_instance_ids():
+            with self.__in_flight_lock:
+                if instance_id in self.__in_flight:
+                    continue
+                self.__in_flight.add(instance_id)
+
+            self.__pool.submit(self.__kill, instance_id)
+
+        if backlog := self.backlog:
+            logger.info(f'reaper backlog: {backlog} instances')
+
+    def __kill(self, instance_id: str) -> None:
+        try:
+            publish_event(self.__database, 'expiring', instance_id)
+            for attempt in range(1, REAPER_MAX_ATTEMPTS + 1):
+                # we might have lost the lease while the kill was queued, between attempts, or while we were paused
+                if not worker.still_leader():
+                    return
+
+                try:
+                    logger.info(f'pruning expired instance: {instance_id}')
+                    self.__kill_instance(instance_id)
+                except Exception as e:
+                    logger.opt(exception=e).warning(
+                        f'failed to prune instance {instance_id} (attempt {attempt}/{REAPER_MAX_ATTEMPTS})'
+                    )
+                    time.sleep(min(2**attempt, REAPER_MAX_SLEEP))
+                else:
+                    return
+
+            logger.error(f'giving up on pruning instance {instance_id}, it will be retried on the next pass')
+        finally:
+            with self.__in_flight_lock:
+                self.__in_flight.discard(instance_id)
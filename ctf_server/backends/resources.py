@@ -0,0 +1,59 @@
+import json
+import os
+from typing import TypedDict
+
+from ctf_server.types import LaunchAnvilInstanceArgs
+
+
+class ResourceProfile(TypedDict):
+    # cpu cores and MiB of memory the instance is limited to
+    cpus: float
+    memory: int
+    # anvil flags bounding its memory usage, applied unless the challenge sets them itself
+    prune_history: int | bool | None
+    transaction_block_keeper: int | None
+
+
+# Profiles a challenge can pick with `profile`, can be overridden with a json object in RESOURCE_PROFILES
+RESOURCE_PROFILES: dict[str, ResourceProfile] = {
+    'small': {'cpus': 0.5, 'memory': 512, 'prune_history': True, 'transaction_block_keeper': 64},
+    'default': {'cpus': 1.0, 'memory': 1024, 'prune_history': None, 'transaction_block_keeper': None},
+    'large': {'cpus': 2.0, 'memory': 4096, 'prune_history': None, 'transaction_block_keeper': None},
+} | json.loads(os.getenv('RESOURCE_PROFILES', '{}'))
+DEFAULT_RESOURCE_PROFILE = os.getenv('DEFAULT_RESOURCE_PROFILE', 'default')
+
+# Hard caps for whatever a challenge asks for, so that a single instance can not take a whole node over
+MAX_INSTANCE_CPUS = float(os.getenv('MAX_INSTANCE_CPUS', '4'))
+MAX_INSTANCE_MEMORY = int(os.getenv('MAX_INSTANCE_MEMORY', '8192'))
+
+
+class ResourceProfileError(Exception):
+    """Custom exception for invalid resource profiles."""
+
+
+def get_resource_profile(name: str | None) -> ResourceProfile:
+    profile = RESOURCE_PROFILES.get(name or DEFAULT_RESOURCE_PROFILE)
+    if profile is None:
+        msg = f'unknown resource profile: {name}'
+        raise ResourceProfileError(msg)
+    return profile
+
+
+def apply_resource_profile(args: LaunchAnvilInstanceArgs) -> LaunchAnvilInstanceArgs:
+    """Returns `args` with its profile resolved into concrete, capped limits and anvil flags."""
+    profile = get_resource_profile(args.get('profile'))
+
+    result = args.copy()
+    result['cpus'] = min(args.get('cpus') or profile['cpus'], MAX_INSTANCE_CPUS)
+    result['memory'] = min(args.get('memory') or profile['memory'], MAX_INSTANCE_MEMORY)
+    if args.get('prune_history') is None:
+        result['prune_history'] = profile['prune_history']
+    if args.get('transaction_block_keeper') is None:
+        result['transaction_block_keeper'] = profile['transaction_block_keeper']
+    return result
+
+
+def get_daemon_limits() -> tuple[float, int]:
+    # daemons have no say in their resources, they get whatever the default profile allows
+    profile = get_resource_profile(None)
+    return min(profile['cpus'], MAX_INSTANCE_CPUS), min(profile['memory'], MAX_INSTANCE_MEMORY)
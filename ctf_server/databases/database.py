@@ -1,6 +1,30 @@
 import abc
+from typing import Any
 
-from ctf_server.types import UserData
+from ctf_server.types import ImageStatus, InstanceEvent, UserData
+
+
+class InvalidCursorError(Exception):
+    """Custom exception for invalid pagination cursor errors."""
+
+
+def encode_cursor(expires_at: float, instance_id: str) -> str:
+    """Encodes the position right after the given instance in the listing, which is ordered by expiry and then id."""
+    return f'{expires_at!r}/{instance_id}'
+
+
+def decode_cursor(cursor: str) -> tuple[float, str]:
+    expires_at, _, instance_id = cursor.partition('/')
+    try:
+        return float(expires_at), instance_id
+    except ValueError:
+        msg = f'invalid cursor: {cursor}'
+        raise InvalidCursorError(msg) from None
+
+
+def get_teardown_key(instance: UserData) -> str:
+    # a relaunch of the instance has another generation, so its teardown never clashes with the previous one's
+    return f'{instance["instance_id"]}/{instance.get("generation") or ""}'
 
 
 class Database(abc.ABC):
@@ -12,8 +36,8 @@ class Database(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def unregister_instance(self, instance_id: str) -> UserData | None:
-        pass
+    def unregister_instance(self, instance_id: str, teardown_retry_after: float) -> UserData | None:
+        """Unregisters the instance and queues its teardown along with it, see `unregister_instances`."""
 
     @abc.abstractmethod
     def get_instance(self, instance_id: str) -> UserData | None:
@@ -24,9 +48,178 @@ class Database(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def get_expired_instances(self) -> list[UserData]:
+    def get_all_instances(self) -> list[UserData]:
+        pass
+
+    @abc.abstractmethod
+    def list_instances(
+        self,
+        cursor: str | None,
+        limit: int,
+        *,
+        challenge: str | None = None,
+        expires_after: float | None = None,
+        expires_before: float | None = None,
+    ) -> tuple[list[UserData], str | None]:
+        """Lists up to `limit` instances ordered by expiry, starting after `cursor` (None starts from the beginning).
+
+        The expiry bounds are inclusive. Returns the instances along with the cursor of the next page, or None if this
+        was the last one. Instances launched or killed while paginating may or may not show up.
+        """
+
+    @abc.abstractmethod
+    def unregister_instances(self, instance_ids: list[str], teardown_retry_after: float) -> list[UserData]:
+        """Unregisters the instances in bulk, returns the ones that were still registered.
+
+        Their teardown is queued atomically with it (see `queue_teardowns`), so that no instance is forgotten before its
+        resources are.
+        """
+
+    @abc.abstractmethod
+    def extend_instances(self, instance_ids: list[str], seconds: float) -> dict[str, float]:
+        """Pushes the expiry of the instances back by `seconds`, returns the new expiry of the ones that exist."""
+
+    @abc.abstractmethod
+    def queue_teardowns(self, instances: list[UserData], retry_after: float) -> None:
+        """Records that the resources of the unregistered instances still have to be torn down.
+
+        Teardowns that have not been completed within `retry_after` seconds are due for another attempt.
+        """
+
+    @abc.abstractmethod
+    def get_due_teardowns(self, limit: int) -> list[UserData]:
+        pass
+
+    @abc.abstractmethod
+    def complete_teardowns(self, instances: list[UserData]) -> None:
         pass
 
+    @abc.abstractmethod
+    def count_pending_teardowns(self) -> int:
+        pass
+
+    @abc.abstractmethod
+    def get_expired_instance_ids(self) -> list[str]:
+        pass
+
+    @abc.abstractmethod
+    def count_expired_instances(self) -> int:
+        pass
+
+    @abc.abstractmethod
+    def get_next_expiry(self) -> float | None:
+        pass
+
+    @abc.abstractmethod
+    def wait_for_expiry_change(self, timeout: float) -> None:
+        """Blocks for up to `timeout` seconds, returning early if the set of expiries may have changed."""
+
+    @abc.abstractmethod
+    def publish_event(self, event: InstanceEvent) -> None:
+        """Sends `event` to whoever is waiting for events right now, events are not stored."""
+
+    @abc.abstractmethod
+    def wait_for_events(self, timeout: float) -> list[InstanceEvent]:
+        """Blocks for up to `timeout` seconds until events get published, returns every event received since.
+
+        Meant to be called from a single thread per process, which then hands the events out.
+        """
+
     @abc.abstractmethod
     def update_metadata(self, instance_id: str, metadata: dict[str, str | list[dict[str, str]]]) -> None:
         pass
+
+    @abc.abstractmethod
+    def set_reset_states(self, instance_id: str, states: dict[str, str]) -> None:
+        """Stores the state dump of every anvil of the instance to reset it to, dropped along with the instance."""
+
+    @abc.abstractmethod
+    def get_reset_states(self, instance_id: str) -> dict[str, str]:
+        """Returns the state dumps stored for the instance by anvil id, empty if there are none."""
+
+    @abc.abstractmethod
+    def update_instance(self, instance_id: str, fields: dict[str, Any]) -> None:
+        """Overwrites top-level fields of the instance, does nothing if it does not exist anymore."""
+
+    @abc.abstractmethod
+    def record_activity(self, instance_id: str, timestamp: float) -> None:
+        """Bumps the last time the instance was used, ignored for hibernated instances."""
+
+    @abc.abstractmethod
+    def get_idle_instance_ids(self, idle_since: float) -> list[str]:
+        """Returns the instances that are awake but have not been used since `idle_since`."""
+
+    @abc.abstractmethod
+    def set_hibernated(self, instance_id: str, *, hibernated: bool) -> None:
+        pass
+
+    @abc.abstractmethod
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> int | None:
+        """Acquires or renews the lease `name` for `holder`.
+
+        Returns the fencing token of the lease, which only grows between holders, or None if it is held by someone else.
+        """
+
+    @abc.abstractmethod
+    def release_lease(self, name: str, holder: str) -> None:
+        pass
+
+    @abc.abstractmethod
+    def holds_lease(self, name: str, holder: str, token: int) -> bool:
+        """Returns whether `holder` still holds the unexpired lease `name` under the fencing token `token`."""
+
+    @abc.abstractmethod
+    def count_team_instances(self, team: str) -> int:
+        pass
+
+    @abc.abstractmethod
+    def count_live_anvils(self) -> int:
+        pass
+
+    @abc.abstractmethod
+    def recount_live_anvils(self) -> None:
+        """Rebuilds whatever `count_live_anvils` keeps track of from the registered instances."""
+
+    @abc.abstractmethod
+    def acquire_launch_slot(self, ticket: str, limit: int, slot_ttl: float, queue_ttl: float) -> int:
+        """Joins the FIFO launch queue (or refreshes the place in it) and tries to take one of the `limit` launch slots.
+
+        Returns 0 if the slot was taken, or the position in the queue otherwise. Queued tickets that have not been
+        refreshed for `queue_ttl` seconds and slots that have not been released for `slot_ttl` seconds are dropped.
+        """
+
+    @abc.abstractmethod
+    def release_launch_slot(self, ticket: str) -> None:
+        pass
+
+    @abc.abstractmethod
+    def leave_launch_queue(self, ticket: str) -> None:
+        pass
+
+    @abc.abstractmethod
+    def record_team_launch(self, team: str, ticket: str, window: float) -> None:
+        pass
+
+    @abc.abstractmethod
+    def count_team_launches(self, team: str, window: float) -> int:
+        pass
+
+    @abc.abstractmethod
+    def register_image(self, image: str) -> None:
+        """Adds `image` to the images to keep on every node, or marks it as used right now if it already is."""
+
+    @abc.abstractmethod
+    def expire_images(self, unused_since: float, keep: set[str]) -> list[str]:
+        """Removes the images not used since `unused_since` (except the ones in `keep`) along with their statuses."""
+
+    @abc.abstractmethod
+    def get_images(self) -> list[str]:
+        pass
+
+    @abc.abstractmethod
+    def set_image_status(self, image: str, node: str, status: ImageStatus) -> None:
+        pass
+
+    @abc.abstractmethod
+    def get_image_statuses(self) -> dict[str, dict[str, ImageStatus]]:
+        """Returns the pull status of every registered image, by image and then by node."""
@@ -1,12 +1,86 @@
 import time
+from contextlib import suppress
 from json import dumps, loads
-from typing import Any, Never, cast
+from typing import Any, cast
 
 import redis
+from loguru import logger
+from redis.client import PubSub
 
-from ctf_server.types import UserData
+from ctf_server.types import ImageStatus, InstanceEvent, UserData
 
-from .database import Database
+from .database import Database, decode_cursor, encode_cursor, get_teardown_key
+
+
+# Acquires or renews the lease KEYS[1] for the holder ARGV[1] for ARGV[2] ms, KEYS[2] is the fencing token counter
+ACQUIRE_LEASE_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current then
+    local holder, token = string.match(current, '^(.*)/(%d+)$')
+    if holder ~= ARGV[1] then
+        return false
+    end
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return tonumber(token)
+end
+local token = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], ARGV[1] .. '/' .. token, 'PX', ARGV[2])
+return token
+"""
+
+# Releases the lease KEYS[1] if it is still held by ARGV[1]
+RELEASE_LEASE_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current and string.match(current, '^(.*)/%d+$') == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+# Refreshes ARGV[1] in the launch queue KEYS[1] (heartbeats in KEYS[2]) and moves it to the launch slots KEYS[3] if
+# it is at the head of the queue and one of the ARGV[3] slots is free, see Database.acquire_launch_slot
+ACQUIRE_LAUNCH_SLOT_SCRIPT = """
+local now = tonumber(ARGV[2])
+for _, stale in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now - tonumber(ARGV[4]))) do
+    redis.call('ZREM', KEYS[1], stale)
+    redis.call('ZREM', KEYS[2], stale)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now)
+if redis.call('ZSCORE', KEYS[3], ARGV[1]) then
+    return 0
+end
+
+redis.call('ZADD', KEYS[1], 'NX', now, ARGV[1])
+redis.call('ZADD', KEYS[2], now, ARGV[1])
+local rank = redis.call('ZRANK', KEYS[1], ARGV[1])
+local free = tonumber(ARGV[3]) - redis.call('ZCARD', KEYS[3])
+if rank < free then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    redis.call('ZADD', KEYS[3], now + tonumber(ARGV[5]), ARGV[1])
+    return 0
+end
+return rank - math.max(free, 0) + 1
+"""
+
+# Deletes the instances KEYS[3..] and queues the teardown of the ones it deleted in KEYS[1] and KEYS[2], due at ARGV[1].
+# ARGV[2n] and ARGV[2n + 1] are the teardown key and data of the nth instance. Returns the (0-based) deleted indexes
+UNREGISTER_INSTANCES_SCRIPT = """
+local deleted = {}
+for i = 3, #KEYS do
+    if redis.call('DEL', KEYS[i]) == 1 then
+        local key = ARGV[2 * (i - 2)]
+        redis.call('ZADD', KEYS[1], ARGV[1], key)
+        redis.call('HSET', KEYS[2], key, ARGV[2 * (i - 2) + 1])
+        deleted[#deleted + 1] = i - 3
+    end
+end
+return deleted
+"""
+
+
+EVENTS_CHANNEL = 'instance-events'
 
 
 class RedisDatabaseError(Exception):
@@ -24,6 +98,26 @@ class RedisDatabase(Database):
             decode_responses=True,
             **redis_kwargs,
         )
+        self.__expiry_events: PubSub | None = None
+        self.__instance_events: PubSub | None = None
+        self.__acquire_lease_script = self.__client.register_script(ACQUIRE_LEASE_SCRIPT)
+        self.__release_lease_script = self.__client.register_script(RELEASE_LEASE_SCRIPT)
+        self.__acquire_launch_slot_script = self.__client.register_script(ACQUIRE_LAUNCH_SLOT_SCRIPT)
+        self.__unregister_instances_script = self.__client.register_script(UNREGISTER_INSTANCES_SCRIPT)
+        self.__index_challenge_expiries()
+
+    def __index_challenge_expiries(self) -> None:
+        """Adds the instances registered before challenges had their own expiry index to it, once per database."""
+        if self.__client.exists('challenge-expiries-indexed'):
+            return
+
+        # concurrent workers may both go through this, adding the same entries twice is harmless
+        pipeline = self.__client.pipeline()
+        for instance in self.get_all_instances():
+            if challenge := instance.get('challenge'):
+                pipeline.zadd(f'challenge-expiries/{challenge}', {instance['instance_id']: int(instance['expires_at'])})
+        pipeline.set('challenge-expiries-indexed', 1)
+        pipeline.execute()
 
     def register_instance(self, _: str, instance: UserData) -> None:
         pipeline = self.__client.pipeline()
@@ -37,27 +131,67 @@ class RedisDatabase(Database):
                     instance['instance_id']: int(instance['expires_at']),
                 },
             )
+            pipeline.zadd('activity', {instance['instance_id']: instance['created_at']})
+            pipeline.incrby('live_anvils', len(instance['anvil_instances']))
+            if team := instance.get('team'):
+                pipeline.sadd(f'team/{team}', instance['instance_id'])
+            if challenge := instance.get('challenge'):
+                # lets the instances of a challenge be listed without going through every other instance
+                pipeline.zadd(f'challenge-expiries/{challenge}', {instance['instance_id']: int(instance['expires_at'])})
         finally:
             pipeline.execute()
 
-    def update_instance(self, _: str, __: UserData) -> Never:
-        msg = 'not supported'
-        raise RedisDatabaseError(msg)
+    def unregister_instance(self, instance_id: str, teardown_retry_after: float) -> UserData | None:
+        instances = self.unregister_instances([instance_id], teardown_retry_after)
+        return instances[0] if instances else None
 
-    def unregister_instance(self, instance_id: str) -> UserData | None:
-        instance = cast('UserData | None', self.__client.json().get(f'instance/{instance_id}'))
-        if instance is None:
-            return None
+    def unregister_instances(self, instance_ids: list[str], teardown_retry_after: float) -> list[UserData]:
+        if not instance_ids:
+            return []
 
         pipeline = self.__client.pipeline()
-        try:
-            pipeline.json().delete(f'instance/{instance_id}')
-            pipeline.hdel('external_ids', instance['external_id'])
-            pipeline.zrem('expiries', instance_id)
-            pipeline.delete(f'metadata/{instance_id}')
-            return cast('UserData', instance)
-        finally:
-            pipeline.execute()
+        for instance_id in instance_ids:
+            pipeline.json().get(f'instance/{instance_id}')
+        instances = [cast('UserData', instance) for instance in pipeline.execute() if instance is not None]
+        if not instances:
+            return []
+
+        # only whoever actually deleted an instance gets to clean up after it, so that concurrent kills do not release
+        # the same counters twice
+        args: list[str | float] = [time.time() + teardown_retry_after]
+        for instance in instances:
+            args += [get_teardown_key(instance), dumps(instance)]
+        indexes = cast(
+            'list[int]',
+            self.__unregister_instances_script(
+                keys=[
+                    'teardowns',
+                    'teardown-instances',
+                    *(f'instance/{instance["instance_id"]}' for instance in instances),
+                ],
+                args=args,
+            ),
+        )
+        deleted = [instances[i] for i in indexes]
+
+        for instance in deleted:
+            self.__forget_instance(pipeline, instance)
+        pipeline.execute()
+        return deleted
+
+    @staticmethod
+    def __forget_instance(pipeline: redis.client.Pipeline, instance: UserData) -> None:
+        instance_id = instance['instance_id']
+        pipeline.hdel('external_ids', instance['external_id'])
+        pipeline.zrem('expiries', instance_id)
+        pipeline.zrem('activity', instance_id)
+        pipeline.delete(f'metadata/{instance_id}')
+        pipeline.delete(f'reset-states/{instance_id}')
+        pipeline.decrby('live_anvils', len(instance['anvil_instances']))
+        if team := instance.get('team'):
+            pipeline.srem(f'team/{team}', instance_id)
+        if challenge := instance.get('challenge'):
+            pipeline.zrem(f'challenge-expiries/{challenge}', instance_id)
 
     def get_instance(self, instance_id: str) -> UserData | None:
         instance = cast('UserData | None', self.__client.json().get(f'instance/{instance_id}'))
@@ -80,12 +214,198 @@ class RedisDatabase(Database):
         return self.get_instance(instance_id)  # type: ignore[arg-type]
 
     def get_all_instances(self) -> list[UserData]:
-        keys = self.__client.keys('instance/*')
-        return [instance for key in keys if (instance := self.get_instance(key.split('/')[1]))]  # type: ignore[union-attr]
+        # SCAN instead of KEYS, so that we do not block redis for everyone else while going through all the keys
+        keys = self.__client.scan_iter(match='instance/*', count=1000)
+        return self.__get_instances([key.split('/', 1)[1] for key in keys])
+
+    def __get_instances(self, instance_ids: list[str]) -> list[UserData]:
+        """Fetches the instances in a single round trip, skipping the ones that do not exist."""
+        pipeline = self.__client.pipeline()
+        for instance_id in instance_ids:
+            pipeline.json().get(f'instance/{instance_id}')
+            pipeline.hgetall(f'metadata/{instance_id}')
+        results = pipeline.execute()
+
+        instances = []
+        for instance, metadata in zip(results[::2], results[1::2], strict=True):
+            if instance is None:
+                continue
+            instance['metadata'] = {k: loads(v) for k, v in metadata.items()}
+            instances.append(cast('UserData', instance))
+        return instances
+
+    def list_instances(
+        self,
+        cursor: str | None,
+        limit: int,
+        *,
+        challenge: str | None = None,
+        expires_after: float | None = None,
+        expires_before: float | None = None,
+    ) -> tuple[list[UserData], str | None]:
+        key = f'challenge-expiries/{challenge}' if challenge is not None else 'expiries'
+        after = decode_cursor(cursor) if cursor is not None else None
+
+        bounds = [bound for bound in (expires_after, after[0] if after else None) if bound is not None]
+        low: float | str = max(bounds) if bounds else '-inf'
+        high: float | str = expires_before if expires_before is not None else '+inf'
 
-    def get_expired_instances(self) -> list[UserData]:
-        instance_ids = self.__client.zrange('expiries', 0, int(time.time()), byscore=True)
-        return [instance for instance_id in instance_ids if (instance := self.get_instance(instance_id))]  # type: ignore[union-attr]
+        # one more than asked for tells whether there is a next page. Instances that share the expiry of the cursor
+        # come back again, they are skipped and the range is read further until the page is full
+        entries: list[tuple[str, float]] = []
+        offset = 0
+        while len(entries) <= limit:
+            batch = cast(
+                'list[tuple[str, float]]',
+                self.__client.zrange(
+                    key,
+                    low,  # type: ignore[arg-type]
+                    high,  # type: ignore[arg-type]
+                    byscore=True,
+                    offset=offset,
+                    num=limit + 1,
+                    withscores=True,
+                ),
+            )
+            entries += [(member, score) for member, score in batch if after is None or (score, member) > after]
+            if len(batch) <= limit:
+                break
+            offset += len(batch)
+
+        page = entries[:limit]
+        next_cursor = encode_cursor(page[-1][1], page[-1][0]) if len(entries) > limit else None
+        return self.__get_instances([instance_id for instance_id, _ in page]), next_cursor
+
+    def extend_instances(self, instance_ids: list[str], seconds: float) -> dict[str, float]:
+        if not instance_ids:
+            return {}
+
+        pipeline = self.__client.pipeline()
+        for instance_id in instance_ids:
+            pipeline.json().numincrby(f'instance/{instance_id}', '$.expires_at', seconds)  # type: ignore[arg-type]
+            pipeline.json().get(f'instance/{instance_id}', '$.challenge')
+        # instances that do not exist (anymore) fail the increment
+        results = pipeline.execute(raise_on_error=False)
+
+        expiries: dict[str, float] = {}
+        for instance_id, expires_at, challenge in zip(instance_ids, results[::2], results[1::2], strict=True):
+            if isinstance(expires_at, Exception) or not expires_at:
+                continue
+
+            expiries[instance_id] = float(expires_at[0] if isinstance(expires_at, list) else expires_at)
+            # XX, so that instances killed in the meantime are not put back
+            pipeline.zadd('expiries', {instance_id: int(expiries[instance_id])}, xx=True)
+            if challenge and challenge[0]:
+                pipeline.zadd(f'challenge-expiries/{challenge[0]}', {instance_id: int(expiries[instance_id])}, xx=True)
+        pipeline.execute()
+        return expiries
+
+    def queue_teardowns(self, instances: list[UserData], retry_after: float) -> None:
+        if not instances:
+            return
+
+        retry_at = time.time() + retry_after
+        pipeline = self.__client.pipeline()
+        try:
+            pipeline.zadd('teardowns', {get_teardown_key(instance): retry_at for instance in instances})
+            pipeline.hset(
+                'teardown-instances',
+                mapping={get_teardown_key(instance): dumps(instance) for instance in instances},
+            )
+        finally:
+            pipeline.execute()
+
+    def get_due_teardowns(self, limit: int) -> list[UserData]:
+        keys = self.__client.zrange('teardowns', '-inf', time.time(), byscore=True, offset=0, num=limit)  # type: ignore[arg-type]
+        if not keys:
+            return []
+        instances = cast('list[str | None]', self.__client.hmget('teardown-instances', keys))  # type: ignore[arg-type]
+        return [loads(instance) for instance in instances if instance is not None]
+
+    def complete_teardowns(self, instances: list[UserData]) -> None:
+        if not instances:
+            return
+
+        keys = [get_teardown_key(instance) for instance in instances]
+        pipeline = self.__client.pipeline()
+        try:
+            pipeline.zrem('teardowns', *keys)
+            pipeline.hdel('teardown-instances', *keys)
+        finally:
+            pipeline.execute()
+
+    def count_pending_teardowns(self) -> int:
+        return self.__client.zcard('teardowns')  # type: ignore[return-value]
+
+    def get_expired_instance_ids(self) -> list[str]:
+        return self.__client.zrange('expiries', 0, int(time.time()), byscore=True)  # type: ignore[return-value]
+
+    def count_expired_instances(self) -> int:
+        return self.__client.zcount('expiries', 0, int(time.time()))  # type: ignore[return-value]
+
+    def get_next_expiry(self) -> float | None:
+        first = self.__client.zrange('expiries', 0, 0, withscores=True)
+        if not first:
+            return None
+        return first[0][1]  # type: ignore[index]
+
+    def wait_for_expiry_change(self, timeout: float) -> None:
+        try:
+            if self.__expiry_events is None:
+                self.__expiry_events = self.__subscribe_expiry_events()
+
+            if self.__expiry_events.get_message(ignore_subscribe_messages=True, timeout=timeout) is not None:
+                # collapse a burst of changes into a single wake-up
+                while self.__expiry_events.get_message(ignore_subscribe_messages=True) is not None:
+                    pass
+        except redis.RedisError as e:
+            logger.opt(exception=e).warning('lost expiry notifications subscription')
+            if self.__expiry_events is not None:
+                with suppress(redis.RedisError):
+                    self.__expiry_events.close()
+                self.__expiry_events = None
+            time.sleep(timeout)
+
+    def __subscribe_expiry_events(self) -> PubSub:
+        # Keyspace notifications are disabled by default, try enabling them for sorted set events without overriding
+        # whatever else was configured. If we are not allowed to, the reaper will still wake up on its deadlines.
+        try:
+            config = cast('dict[str, str]', self.__client.config_get('notify-keyspace-events'))
+            flags = config.get('notify-keyspace-events', '')
+            if 'K' not in flags or ('z' not in flags and 'A' not in flags):
+                self.__client.config_set('notify-keyspace-events', ''.join(sorted(set(flags) | {'K', 'z'})))
+        except redis.ResponseError as e:
+            logger.warning(f'unable to enable keyspace notifications, expiries will only be polled: {e}')
+
+        db = self.__client.connection_pool.connection_kwargs.get('db', 0)
+        pubsub = self.__client.pubsub()
+        pubsub.subscribe(f'__keyspace@{db}__:expiries')
+        return pubsub
+
+    def publish_event(self, event: InstanceEvent) -> None:
+        self.__client.publish(EVENTS_CHANNEL, dumps(event))
+
+    def wait_for_events(self, timeout: float) -> list[InstanceEvent]:
+        try:
+            if self.__instance_events is None:
+                self.__instance_events = self.__client.pubsub(ignore_subscribe_messages=True)
+                self.__instance_events.subscribe(EVENTS_CHANNEL)
+
+            events: list[InstanceEvent] = []
+            message = self.__instance_events.get_message(timeout=timeout)
+            while message is not None:
+                events.append(loads(message['data']))
+                message = self.__instance_events.get_message()
+        except redis.RedisError as e:
+            logger.opt(exception=e).warning('lost instance events subscription')
+            if self.__instance_events is not None:
+                with suppress(redis.RedisError):
+                    self.__instance_events.close()
+                self.__instance_events = None
+            time.sleep(timeout)
+            return []
+        else:
+            return events
 
     def update_metadata(self, instance_id: str, metadata: dict[str, str | list[dict[str, str]]]) -> None:
         pipeline = self.__client.pipeline()
@@ -94,3 +414,141 @@ class RedisDatabase(Database):
                 pipeline.hset(f'metadata/{instance_id}', k, dumps(v))
         finally:
             pipeline.execute()
+
+    def set_reset_states(self, instance_id: str, states: dict[str, str]) -> None:
+        # kept apart from the instance, dumps can be large and most readers of the instance never need them
+        pipeline = self.__client.pipeline()
+        pipeline.delete(f'reset-states/{instance_id}')
+        pipeline.hset(f'reset-states/{instance_id}', mapping=states)  # type: ignore[arg-type]
+        pipeline.execute()
+
+    def get_reset_states(self, instance_id: str) -> dict[str, str]:
+        return cast('dict[str, str]', self.__client.hgetall(f'reset-states/{instance_id}'))
+
+    def update_instance(self, instance_id: str, fields: dict[str, Any]) -> None:
+        if not self.__client.exists(f'instance/{instance_id}'):
+            return
+
+        pipeline = self.__client.pipeline()
+        for k, v in fields.items():
+            pipeline.json().set(f'instance/{instance_id}', f'$.{k}', v)
+        # the instance might have been unregistered in the meantime, which is fine
+        with suppress(redis.ResponseError):
+            pipeline.execute()
+
+    def record_activity(self, instance_id: str, timestamp: float) -> None:
+        # hibernated instances are not in the set, and must not be put back by a late report
+        self.__client.zadd('activity', {instance_id: timestamp}, xx=True, gt=True)
+
+    def get_idle_instance_ids(self, idle_since: float) -> list[str]:
+        return self.__client.zrange('activity', 0, int(idle_since), byscore=True)  # type: ignore[return-value]
+
+    def set_hibernated(self, instance_id: str, *, hibernated: bool) -> None:
+        self.update_instance(instance_id, {'hibernated': hibernated})
+        if hibernated:
+            self.__client.zrem('activity', instance_id)
+        elif self.__client.exists(f'instance/{instance_id}'):
+            self.__client.zadd('activity', {instance_id: time.time()})
+
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> int | None:
+        token = self.__acquire_lease_script(
+            keys=[f'lease/{name}', f'lease-token/{name}'],
+            args=[holder, int(ttl * 1000)],
+        )
+        return None if token is None else int(token)  # type: ignore[arg-type]
+
+    def release_lease(self, name: str, holder: str) -> None:
+        self.__release_lease_script(keys=[f'lease/{name}'], args=[holder])
+
+    def holds_lease(self, name: str, holder: str, token: int) -> bool:
+        # expired leases are gone from redis, so whatever is there is still valid
+        return self.__client.get(f'lease/{name}') == f'{holder}/{token}'
+
+    def count_team_instances(self, team: str) -> int:
+        return self.__client.scard(f'team/{team}')  # type: ignore[return-value]
+
+    def count_live_anvils(self) -> int:
+        # the counter can be off until the next recount, never report less than nothing
+        return max(int(self.__client.get('live_anvils') or 0), 0)  # type: ignore[arg-type]
+
+    def recount_live_anvils(self) -> None:
+        # registrations racing with this are off until the next recount
+        pipeline = self.__client.pipeline()
+        for key in self.__client.scan_iter(match='instance/*', count=1000):
+            pipeline.json().objlen(key, '$.anvil_instances')
+        lengths = cast('list[list[int | None] | None]', pipeline.execute(raise_on_error=False))
+        total = sum(length[0] or 0 for length in lengths if isinstance(length, list) and length)
+
+        previous = self.__client.getset('live_anvils', total)
+        if previous is not None and int(previous) != total:  # type: ignore[arg-type]
+            logger.warning(f'live anvils counter was off, {previous} instead of {total}')
+
+    def acquire_launch_slot(self, ticket: str, limit: int, slot_ttl: float, queue_ttl: float) -> int:
+        return int(
+            self.__acquire_launch_slot_script(  # type: ignore[arg-type]
+                keys=['launch-queue', 'launch-queue-heartbeats', 'launch-slots'],
+                args=[ticket, time.time(), limit, queue_ttl, slot_ttl],
+            )
+        )
+
+    def release_launch_slot(self, ticket: str) -> None:
+        self.__client.zrem('launch-slots', ticket)
+
+    def leave_launch_queue(self, ticket: str) -> None:
+        pipeline = self.__client.pipeline()
+        try:
+            pipeline.zrem('launch-queue', ticket)
+            pipeline.zrem('launch-queue-heartbeats', ticket)
+        finally:
+            pipeline.execute()
+
+    def record_team_launch(self, team: str, ticket: str, window: float) -> None:
+        now = time.time()
+        pipeline = self.__client.pipeline()
+        try:
+            pipeline.zadd(f'team-launches/{team}', {f'{ticket}/{now}': now})
+            pipeline.zremrangebyscore(f'team-launches/{team}', '-inf', now - window)
+            pipeline.expire(f'team-launches/{team}', int(window) + 1)
+        finally:
+            pipeline.execute()
+
+    def count_team_launches(self, team: str, window: float) -> int:
+        return self.__client.zcount(f'team-launches/{team}', time.time() - window, '+inf')  # type: ignore[return-value]
+
+    def register_image(self, image: str) -> None:
+        pipeline = self.__client.pipeline()
+        pipeline.sadd('images', image)
+        pipeline.zadd('image-last-used', {image: time.time()})
+        pipeline.execute()
+
+    def expire_images(self, unused_since: float, keep: set[str]) -> list[str]:
+        expired: list[str] = []
+        for image in self.get_images():
+            last_used = cast('float | None', self.__client.zscore('image-last-used', image))
+            if image in keep or last_used is None:
+                # images registered before their use was tracked start ageing now
+                self.__client.zadd('image-last-used', {image: time.time()}, nx=True)
+                continue
+            if last_used >= unused_since:
+                continue
+
+            pipeline = self.__client.pipeline()
+            pipeline.srem('images', image)
+            pipeline.zrem('image-last-used', image)
+            pipeline.delete(f'image-status/{image}')
+            pipeline.execute()
+            expired.append(image)
+        return expired
+
+    def get_images(self) -> list[str]:
+        return sorted(self.__client.smembers('images'))  # type: ignore[arg-type]
+
+    def set_image_status(self, image: str, node: str, status: ImageStatus) -> None:
+        self.__client.hset(f'image-status/{image}', node, dumps(status))
+
+    def get_image_statuses(self) -> dict[str, dict[str, ImageStatus]]:
+        statuses: dict[str, dict[str, ImageStatus]] = {}
+        for image in self.get_images():
+            by_node = cast('dict[str, str]', self.__client.hgetall(f'image-status/{image}'))
+            statuses[image] = {node: loads(status) for node, status in by_node.items()}
+        return statuses
@@ -1,11 +1,18 @@
 import json
 import sqlite3
-from threading import Lock
-
-from loguru import logger
+import time
+from collections import deque
+from contextlib import suppress
+from threading import Event, Lock
+from typing import Any
 
 from ctf_server.databases import Database
-from ctf_server.types import InstanceInfo, UserData
+from ctf_server.databases.database import decode_cursor, encode_cursor, get_teardown_key
+from ctf_server.types import ImageStatus, InstanceEvent, UserData
+
+
+# Events nobody picked up yet, beyond this the oldest ones are dropped
+EVENT_BACKLOG = 1000
 
 
 class SQLiteDatabase(Database):
@@ -13,6 +20,11 @@ class SQLiteDatabase(Database):
         super().__init__()
 
         self.__conn_lock = Lock()
+        self.__expiry_changed = Event()
+        # sqlite is only shared within a process, so events never leave it
+        self.__events: deque[InstanceEvent] = deque(maxlen=EVENT_BACKLOG)
+        self.__events_lock = Lock()
+        self.__events_published = Event()
         self.__conn = sqlite3.connect(database=db_path, check_same_thread=False)
         self.__conn.execute(
             """
@@ -23,6 +35,66 @@ CREATE TABLE IF NOT EXISTS anvil_instances
     instance_data JSON
 );"""
         )
+        self.__conn.executescript(
+            """
+CREATE TABLE IF NOT EXISTS leases
+(
+    name VARCHAR PRIMARY KEY,
+    holder VARCHAR,
+    token INTEGER,
+    expires_at REAL
+);
+CREATE TABLE IF NOT EXISTS launch_queue
+(
+    ticket VARCHAR PRIMARY KEY,
+    joined_at REAL,
+    last_seen REAL
+);
+CREATE TABLE IF NOT EXISTS launch_slots
+(
+    ticket VARCHAR PRIMARY KEY,
+    expires_at REAL
+);
+CREATE TABLE IF NOT EXISTS team_launches
+(
+    team VARCHAR,
+    ticket VARCHAR,
+    launched_at REAL
+);
+CREATE TABLE IF NOT EXISTS instance_activity
+(
+    instance_id VARCHAR PRIMARY KEY,
+    last_active REAL
+);
+CREATE TABLE IF NOT EXISTS pending_teardowns
+(
+    teardown_key VARCHAR PRIMARY KEY,
+    instance_data JSON,
+    retry_at REAL
+);
+CREATE TABLE IF NOT EXISTS reset_states
+(
+    instance_id VARCHAR,
+    anvil_id VARCHAR,
+    state TEXT,
+    PRIMARY KEY (instance_id, anvil_id)
+);
+CREATE TABLE IF NOT EXISTS images
+(
+    image VARCHAR PRIMARY KEY,
+    last_used REAL
+);
+CREATE TABLE IF NOT EXISTS image_status
+(
+    image VARCHAR,
+    node VARCHAR,
+    status JSON,
+    PRIMARY KEY (image, node)
+);"""
+        )
+        # databases created before image usage was tracked
+        with suppress(sqlite3.OperationalError):
+            self.__conn.execute('ALTER TABLE images ADD COLUMN last_used REAL')
 
     def register_instance(self, instance_id: str, instance: UserData) -> None:
         self.__conn_lock.acquire()
@@ -31,37 +103,32 @@ CREATE TABLE IF NOT EXISTS anvil_instances
                 'INSERT INTO anvil_instances(instance_id, instance_data) VALUES (?, ?)',
                 (instance_id, json.dumps(instance)),
             )
-        finally:
-            cursor.close()
-            self.__conn_lock.release()
-
-    def update_instance(self, instance_id: str, instance: InstanceInfo) -> None:
-        self.__conn_lock.acquire()
-        try:
-            cursor = self.__conn.execute(
-                'UPDATE anvil_instances SET instance_data = ? WHERE instance_id = ?',
-                (json.dumps(instance), instance_id),
+            cursor.execute(
+                'INSERT OR REPLACE INTO instance_activity(instance_id, last_active) VALUES (?, ?)',
+                (instance_id, instance['created_at']),
             )
         finally:
             cursor.close()
             self.__conn_lock.release()
+            self.__expiry_changed.set()
 
-    def unregister_instance(self, instance_id: str) -> UserData | None:
+    def update_instance(self, instance_id: str, fields: dict[str, Any]) -> None:
         self.__conn_lock.acquire()
         try:
             cursor = self.__conn.execute(
-                'DELETE FROM anvil_instances WHERE instance_id = ? RETURNING instance_data', (instance_id,)
+                'UPDATE anvil_instances SET instance_data = json_patch(instance_data, ?) WHERE instance_id = ?',
+                (json.dumps(fields), instance_id),
             )
-            row = cursor.fetchone()
-            if row is None:
-                return None
-
-            return json.loads(row[0])
+            self.__conn.commit()
         finally:
             cursor.close()
             self.__conn_lock.release()
 
-    def get_all_instances(self) -> list[InstanceInfo]:
+    def unregister_instance(self, instance_id: str, teardown_retry_after: float) -> UserData | None:
+        instances = self.unregister_instances([instance_id], teardown_retry_after)
+        return instances[0] if instances else None
+
+    def get_all_instances(self) -> list[UserData]:
         self.__conn_lock.acquire()
         try:
             cursor = self.__conn.execute('SELECT instance_data FROM anvil_instances')
@@ -77,6 +144,103 @@ CREATE TABLE IF NOT EXISTS anvil_instances
             cursor.close()
             self.__conn_lock.release()
 
+    def unregister_instances(self, instance_ids: list[str], teardown_retry_after: float) -> list[UserData]:
+        if not instance_ids:
+            return []
+
+        placeholders = ', '.join('?' * len(instance_ids))
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute(
+                f'DELETE FROM anvil_instances WHERE instance_id IN ({placeholders}) RETURNING instance_data',  # noqa: S608
+                instance_ids,
+            )
+            instances = [json.loads(row[0]) for row in cursor.fetchall()]
+            cursor.execute(
+                f'DELETE FROM instance_activity WHERE instance_id IN ({placeholders})',  # noqa: S608
+                instance_ids,
+            )
+            cursor.execute(
+                f'DELETE FROM reset_states WHERE instance_id IN ({placeholders})',  # noqa: S608
+                instance_ids,
+            )
+            retry_at = time.time() + teardown_retry_after
+            cursor.executemany(
+                'INSERT OR REPLACE INTO pending_teardowns(teardown_key, instance_data, retry_at) VALUES (?, ?, ?)',
+                [(get_teardown_key(instance), json.dumps(instance), retry_at) for instance in instances],
+            )
+            self.__conn.commit()
+            return instances
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+            self.__expiry_changed.set()
+
+    def list_instances(
+        self,
+        cursor: str | None,
+        limit: int,
+        *,
+        challenge: str | None = None,
+        expires_after: float | None = None,
+        expires_before: float | None = None,
+    ) -> tuple[list[UserData], str | None]:
+        conditions = []
+        params: list[Any] = []
+        if cursor is not None:
+            conditions.append("(json_extract(instance_data, '$.expires_at'), instance_id) > (?, ?)")
+            params += decode_cursor(cursor)
+        if challenge is not None:
+            conditions.append("json_extract(instance_data, '$.challenge') = ?")
+            params.append(challenge)
+        if expires_after is not None:
+            conditions.append("json_extract(instance_data, '$.expires_at') >= ?")
+            params.append(expires_after)
+        if expires_before is not None:
+            conditions.append("json_extract(instance_data, '$.expires_at') <= ?")
+            params.append(expires_before)
+
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        self.__conn_lock.acquire()
+        try:
+            db_cursor = self.__conn.execute(
+                f'SELECT instance_data FROM anvil_instances {where} '  # noqa: S608
+                "ORDER BY json_extract(instance_data, '$.expires_at'), instance_id LIMIT ?",
+                [*params, limit + 1],
+            )
+            instances: list[UserData] = [json.loads(row[0]) for row in db_cursor.fetchall()]
+        finally:
+            db_cursor.close()
+            self.__conn_lock.release()
+
+        if len(instances) <= limit:
+            return instances, None
+        last = instances[limit - 1]
+        return instances[:limit], encode_cursor(last['expires_at'], last['instance_id'])
+
+    def extend_instances(self, instance_ids: list[str], seconds: float) -> dict[str, float]:
+        if not instance_ids:
+            return {}
+
+        placeholders = ', '.join('?' * len(instance_ids))
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute(
+                'UPDATE anvil_instances '  # noqa: S608
+                "SET instance_data = json_set(instance_data, '$.expires_at', "
+                "json_extract(instance_data, '$.expires_at') + ?) "
+                f'WHERE instance_id IN ({placeholders}) '
+                "RETURNING instance_id, json_extract(instance_data, '$.expires_at')",
+                [seconds, *instance_ids],
+            )
+            expiries = dict(cursor.fetchall())
+            self.__conn.commit()
+            return expiries
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+            self.__expiry_changed.set()
+
     def get_instance_by_external_id(self, rpc_id: str) -> UserData | None:
         self.__conn_lock.acquire()
         try:
@@ -105,8 +269,369 @@ CREATE TABLE IF NOT EXISTS anvil_instances
             cursor.close()
             self.__conn_lock.release()
 
-    def get_expired_instances(self) -> list[UserData]:
-        return []
+    def queue_teardowns(self, instances: list[UserData], retry_after: float) -> None:
+        retry_at = time.time() + retry_after
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.executemany(
+                'INSERT OR REPLACE INTO pending_teardowns(teardown_key, instance_data, retry_at) VALUES (?, ?, ?)',
+                [(get_teardown_key(instance), json.dumps(instance), retry_at) for instance in instances],
+            )
+            self.__conn.commit()
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def get_due_teardowns(self, limit: int) -> list[UserData]:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute(
+                'SELECT instance_data FROM pending_teardowns WHERE retry_at <= ? ORDER BY retry_at LIMIT ?',
+                (time.time(), limit),
+            )
+            return [json.loads(row[0]) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def complete_teardowns(self, instances: list[UserData]) -> None:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.executemany(
+                'DELETE FROM pending_teardowns WHERE teardown_key = ?',
+                [(get_teardown_key(instance),) for instance in instances],
+            )
+            self.__conn.commit()
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def count_pending_teardowns(self) -> int:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute('SELECT COUNT(*) FROM pending_teardowns')
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def get_expired_instance_ids(self) -> list[str]:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute(
+                "SELECT instance_id FROM anvil_instances WHERE json_extract(instance_data, '$.expires_at') <= ?",
+                (time.time(),),
+            )
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def count_expired_instances(self) -> int:
+        return len(self.get_expired_instance_ids())
+
+    def get_next_expiry(self) -> float | None:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute("SELECT MIN(json_extract(instance_data, '$.expires_at')) FROM anvil_instances")
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def wait_for_expiry_change(self, timeout: float) -> None:
+        self.__expiry_changed.wait(timeout)
+        self.__expiry_changed.clear()
+
+    def publish_event(self, event: InstanceEvent) -> None:
+        with self.__events_lock:
+            self.__events.append(event)
+            self.__events_published.set()
+
+    def wait_for_events(self, timeout: float) -> list[InstanceEvent]:
+        self.__events_published.wait(timeout)
+        with self.__events_lock:
+            events = list(self.__events)
+            self.__events.clear()
+            self.__events_published.clear()
+        return events
 
     def update_metadata(self, instance_id: str, metadata: dict[str, str | list[dict[str, str]]]) -> None:
-        logger.warning(f'Update metadata not supported in SQLiteDatabase: {instance_id} {metadata}')
+        self.update_instance(instance_id, {'metadata': metadata})
+
+    def set_reset_states(self, instance_id: str, states: dict[str, str]) -> None:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute('DELETE FROM reset_states WHERE instance_id = ?', (instance_id,))
+            cursor.executemany(
+                'INSERT INTO reset_states(instance_id, anvil_id, state) VALUES (?, ?, ?)',
+                [(instance_id, anvil_id, state) for anvil_id, state in states.items()],
+            )
+            self.__conn.commit()
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def get_reset_states(self, instance_id: str) -> dict[str, str]:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute(
+                'SELECT anvil_id, state FROM reset_states WHERE instance_id = ?', (instance_id,)
+            )
+            return dict(cursor.fetchall())
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def record_activity(self, instance_id: str, timestamp: float) -> None:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute(
+                'UPDATE instance_activity SET last_active = MAX(last_active, ?) WHERE instance_id = ?',
+                (timestamp, instance_id),
+            )
+            self.__conn.commit()
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def get_idle_instance_ids(self, idle_since: float) -> list[str]:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute(
+                'SELECT instance_id FROM instance_activity WHERE last_active <= ?',
+                (idle_since,),
+            )
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def set_hibernated(self, instance_id: str, *, hibernated: bool) -> None:
+        self.update_instance(instance_id, {'hibernated': hibernated})
+
+        self.__conn_lock.acquire()
+        try:
+            # like in the redis database, hibernated instances are simply not tracked
+            if hibernated:
+                cursor = self.__conn.execute('DELETE FROM instance_activity WHERE instance_id = ?', (instance_id,))
+            else:
+                cursor = self.__conn.execute(
+                    'INSERT OR REPLACE INTO instance_activity(instance_id, last_active) '
+                    'SELECT instance_id, ? FROM anvil_instances WHERE instance_id = ?',
+                    (time.time(), instance_id),
+                )
+            self.__conn.commit()
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> int | None:
+        now = time.time()
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute('SELECT holder, token, expires_at FROM leases WHERE name = ?', (name,))
+            row = cursor.fetchone()
+            if row is not None and row[0] != holder and row[2] > now:
+                return None
+
+            token = 1
+            if row is not None:
+                # the row survives expiries and releases, so the token keeps growing between holders
+                token = row[1] if row[0] == holder and row[2] > now else row[1] + 1
+            cursor.execute(
+                'INSERT OR REPLACE INTO leases(name, holder, token, expires_at) VALUES (?, ?, ?, ?)',
+                (name, holder, token, now + ttl),
+            )
+            self.__conn.commit()
+            return token
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def release_lease(self, name: str, holder: str) -> None:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute(
+                'UPDATE leases SET expires_at = 0 WHERE name = ? AND holder = ?',
+                (name, holder),
+            )
+            self.__conn.commit()
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def holds_lease(self, name: str, holder: str, token: int) -> bool:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute(
+                'SELECT 1 FROM leases WHERE name = ? AND holder = ? AND token = ? AND expires_at > ?',
+                (name, holder, token, time.time()),
+            )
+            return cursor.fetchone() is not None
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def count_team_instances(self, team: str) -> int:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute(
+                "SELECT COUNT(*) FROM anvil_instances WHERE json_extract(instance_data, '$.team') = ?",
+                (team,),
+            )
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def count_live_anvils(self) -> int:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute(
+                'SELECT COUNT(*) FROM anvil_instances, '
+                "json_each(json_extract(anvil_instances.instance_data, '$.anvil_instances'))"
+            )
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def recount_live_anvils(self) -> None:
+        # counted from the instances themselves every time, there is nothing to rebuild
+        pass
+
+    def acquire_launch_slot(self, ticket: str, limit: int, slot_ttl: float, queue_ttl: float) -> int:
+        now = time.time()
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute('DELETE FROM launch_queue WHERE last_seen < ?', (now - queue_ttl,))
+            cursor.execute('DELETE FROM launch_slots WHERE expires_at < ?', (now,))
+            if cursor.execute('SELECT 1 FROM launch_slots WHERE ticket = ?', (ticket,)).fetchone() is not None:
+                return 0
+
+            cursor.execute(
+                'INSERT INTO launch_queue(ticket, joined_at, last_seen) VALUES (?, ?, ?) '
+                'ON CONFLICT(ticket) DO UPDATE SET last_seen = excluded.last_seen',
+                (ticket, now, now),
+            )
+            rank = cursor.execute(
+                'SELECT COUNT(*) FROM launch_queue '
+                'WHERE joined_at < (SELECT joined_at FROM launch_queue WHERE ticket = ?)',
+                (ticket,),
+            ).fetchone()[0]
+            free = limit - cursor.execute('SELECT COUNT(*) FROM launch_slots').fetchone()[0]
+            if rank >= free:
+                self.__conn.commit()
+                return rank - max(free, 0) + 1
+
+            cursor.execute('DELETE FROM launch_queue WHERE ticket = ?', (ticket,))
+            cursor.execute('INSERT INTO launch_slots(ticket, expires_at) VALUES (?, ?)', (ticket, now + slot_ttl))
+            self.__conn.commit()
+            return 0
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def release_launch_slot(self, ticket: str) -> None:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute('DELETE FROM launch_slots WHERE ticket = ?', (ticket,))
+            self.__conn.commit()
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def leave_launch_queue(self, ticket: str) -> None:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute('DELETE FROM launch_queue WHERE ticket = ?', (ticket,))
+            self.__conn.commit()
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def record_team_launch(self, team: str, ticket: str, window: float) -> None:
+        now = time.time()
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute('DELETE FROM team_launches WHERE launched_at < ?', (now - window,))
+            cursor.execute('INSERT INTO team_launches(team, ticket, launched_at) VALUES (?, ?, ?)', (team, ticket, now))
+            self.__conn.commit()
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def count_team_launches(self, team: str, window: float) -> int:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute(
+                'SELECT COUNT(*) FROM team_launches WHERE team = ? AND launched_at >= ?',
+                (team, time.time() - window),
+            )
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def register_image(self, image: str) -> None:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute(
+                'INSERT INTO images(image, last_used) VALUES (?, ?) '
+                'ON CONFLICT(image) DO UPDATE SET last_used = excluded.last_used',
+                (image, time.time()),
+            )
+            self.__conn.commit()
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def expire_images(self, unused_since: float, keep: set[str]) -> list[str]:
+        self.__conn_lock.acquire()
+        try:
+            # images registered before their use was tracked start ageing now
+            cursor = self.__conn.execute('UPDATE images SET last_used = ? WHERE last_used IS NULL', (time.time(),))
+            cursor.execute('SELECT image FROM images WHERE last_used < ?', (unused_since,))
+            expired = [row[0] for row in cursor.fetchall() if row[0] not in keep]
+            cursor.executemany('DELETE FROM images WHERE image = ?', [(image,) for image in expired])
+            cursor.executemany('DELETE FROM image_status WHERE image = ?', [(image,) for image in expired])
+            self.__conn.commit()
+            return expired
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def get_images(self) -> list[str]:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute('SELECT image FROM images ORDER BY image')
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def set_image_status(self, image: str, node: str, status: ImageStatus) -> None:
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute(
+                'INSERT OR REPLACE INTO image_status(image, node, status) VALUES (?, ?, ?)',
+                (image, node, json.dumps(status)),
+            )
+            self.__conn.commit()
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
+
+    def get_image_statuses(self) -> dict[str, dict[str, ImageStatus]]:
+        statuses: dict[str, dict[str, ImageStatus]] = {image: {} for image in self.get_images()}
+
+        self.__conn_lock.acquire()
+        try:
+            cursor = self.__conn.execute('SELECT image, node, status FROM image_status')
+            for image, node, status in cursor.fetchall():
+                statuses.setdefault(image, {})[node] = json.loads(status)
+            return statuses
+        finally:
+            cursor.close()
+            self.__conn_lock.release()
@@ -0,0 +1,170 @@
+import asyncio
+import http.client
+import io
+import os
+import secrets
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import defaultdict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from types import FrameType
+from typing import Annotated, Literal
+
+from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException, Query
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+
+# The debug endpoints are only mounted when this is set, and every request must carry it as a bearer token
+DEBUG_TOKEN = os.getenv('DEBUG_TOKEN')
+DEBUG_MAX_SECONDS = 60.0
+DEBUG_SAMPLE_INTERVAL = 0.005
+DEBUG_TRACEMALLOC_FRAMES = 10
+
+# (function, file, first line), so that samples taken at different lines of a function share a frame
+Frame = tuple[str, str, int]
+
+
+def require_debug_token(authorization: Annotated[str | None, Header()] = None) -> None:
+    expected = f'Bearer {DEBUG_TOKEN}'
+    if DEBUG_TOKEN is None or authorization is None or not secrets.compare_digest(authorization, expected):
+        raise HTTPException(status_code=http.client.FORBIDDEN, detail='invalid debug token')
+
+
+router = APIRouter(prefix='/debug', dependencies=[Depends(require_debug_token)])
+
+# Captures are expensive while they run, never let two of them overlap within a worker
+_capture_lock = threading.Lock()
+
+
+def install(app: FastAPI) -> None:
+    """Mounts the debug endpoints on `app`, if `DEBUG_TOKEN` is set. Each request is served by a single worker."""
+    if DEBUG_TOKEN:
+        app.include_router(router)
+
+
+@contextmanager
+def _exclusive_capture() -> Iterator[None]:
+    if not _capture_lock.acquire(blocking=False):
+        raise HTTPException(status_code=http.client.CONFLICT, detail='another capture is running in this worker')
+    try:
+        yield
+    finally:
+        _capture_lock.release()
+
+
+def _walk(frame: FrameType | None) -> tuple[Frame, ...]:
+    stack = []
+    while frame is not None:
+        stack.append((frame.f_code.co_name, frame.f_code.co_filename, frame.f_code.co_firstlineno))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+def _sample(seconds: float) -> dict[str, list[tuple[tuple[Frame, ...], float]]]:
+    """Samples the stacks of every other thread, returns them root first along with the time each one stands for."""
+    samples: dict[str, list[tuple[tuple[Frame, ...], float]]] = defaultdict(list)
+    me = threading.get_ident()
+
+    deadline = time.monotonic() + seconds
+    last = time.monotonic() - DEBUG_SAMPLE_INTERVAL
+    while (now := time.monotonic()) < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():  # noqa: SLF001
+            if ident != me:
+                samples[names.get(ident, str(ident))].append((_walk(frame), now - last))
+        last = now
+        time.sleep(DEBUG_SAMPLE_INTERVAL)
+    return samples
+
+
+def _to_speedscope(samples: dict[str, list[tuple[tuple[Frame, ...], float]]], seconds: float) -> dict:
+    frames: dict[Frame, int] = {}
+    profiles = []
+    for thread, thread_samples in samples.items():
+        profiles.append(
+            {
+                'type': 'sampled',
+                'name': thread,
+                'unit': 'seconds',
+                'startValue': 0,
+                'endValue': seconds,
+                'samples': [[frames.setdefault(frame, len(frames)) for frame in stack] for stack, _ in thread_samples],
+                'weights': [weight for _, weight in thread_samples],
+            }
+        )
+
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': f'pid {os.getpid()}',
+        'exporter': 'paradigmctf',
+        'shared': {'frames': [{'name': name, 'file': file, 'line': line} for name, file, line in frames]},
+        'profiles': profiles,
+    }
+
+
+def _to_collapsed(samples: dict[str, list[tuple[tuple[Frame, ...], float]]]) -> str:
+    # the input format of flamegraph.pl and most flame graph viewers
+    counts: dict[str, int] = defaultdict(int)
+    for thread, thread_samples in samples.items():
+        for stack, _ in thread_samples:
+            counts[';'.join([thread, *(f'{name} ({file}:{line})' for name, file, line in stack)])] += 1
+    return ''.join(f'{stack} {count}\n' for stack, count in sorted(counts.items()))
+
+
+@router.get('/profile', response_model=None)
+def profile(
+    seconds: Annotated[float, Query(gt=0, le=DEBUG_MAX_SECONDS)] = 10.0,
+    output: Annotated[Literal['speedscope', 'collapsed'], Query(alias='format')] = 'speedscope',
+) -> JSONResponse | PlainTextResponse:
+    """Samples what every thread of this worker is doing for `seconds`, the event loop included."""
+    with _exclusive_capture():
+        samples = _sample(seconds)
+
+    if output == 'collapsed':
+        return PlainTextResponse(_to_collapsed(samples))
+    return JSONResponse(_to_speedscope(samples, seconds))
+
+
+@router.get('/memory', response_class=PlainTextResponse)
+def memory(
+    seconds: Annotated[float, Query(gt=0, le=DEBUG_MAX_SECONDS)] = 10.0,
+    limit: Annotated[int, Query(gt=0)] = 50,
+) -> str:
+    """Lists the source lines that allocated the most memory, still alive at the end, within the next `seconds`."""
+    with _exclusive_capture():
+        # tracing slows every allocation down, so it only runs for the duration of the capture
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(DEBUG_TRACEMALLOC_FRAMES)
+        try:
+            before = tracemalloc.take_snapshot()
+            time.sleep(seconds)
+            after = tracemalloc.take_snapshot()
+        finally:
+            if started:
+                tracemalloc.stop()
+
+    ignored = [tracemalloc.Filter(inclusive=False, filename_pattern=tracemalloc.__file__)]
+    stats = after.filter_traces(ignored).compare_to(before.filter_traces(ignored), 'lineno')
+    return f'pid {os.getpid()}\n' + ''.join(f'{stat}\n' for stat in stats[:limit])
+
+
+@router.get('/stacks', response_class=PlainTextResponse)
+async def stacks() -> str:
+    """Dumps the stack of every thread and every asyncio task of this worker."""
+    out = io.StringIO()
+    out.write(f'pid {os.getpid()}\n')
+
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    for ident, frame in sys._current_frames().items():  # noqa: SLF001
+        out.write(f'\n--- thread {names.get(ident, ident)} ---\n')
+        traceback.print_stack(frame, file=out)
+
+    for task in asyncio.all_tasks():
+        out.write(f'\n--- task {task.get_name()} ---\n')
+        task.print_stack(file=out)
+    return out.getvalue()
@@ -0,0 +1,95 @@
+import asyncio
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass, field
+from threading import Lock, Thread
+
+from loguru import logger
+
+from ctf_server.databases.database import Database
+from ctf_server.types import InstanceEvent, InstanceEventType
+
+
+# How long the dispatcher blocks on the database at once
+EVENTS_POLL_TIMEOUT = 1.0
+# Events a subscriber may fall behind by, a subscriber that falls further behind gets disconnected
+EVENTS_SUBSCRIBER_BACKLOG = 1000
+
+
+def publish_event(
+    database: Database, event_type: InstanceEventType, instance_id: str, keys: list[str] | None = None
+) -> None:
+    """Publishes an instance lifecycle event, failing to do so never fails whatever triggered it."""
+    event = InstanceEvent(type=event_type, instance_id=instance_id, timestamp=time.time())
+    if keys is not None:
+        event['keys'] = keys
+
+    try:
+        database.publish_event(event)
+    except Exception as e:
+        logger.opt(exception=e).warning(f'failed to publish {event_type} event of instance {instance_id}')
+
+
+@dataclass(eq=False)
+class Subscription:
+    loop: asyncio.AbstractEventLoop
+    # None receives the events of every instance
+    instance_ids: set[str] | None
+    queue: asyncio.Queue[InstanceEvent] = field(
+        default_factory=lambda: asyncio.Queue(maxsize=EVENTS_SUBSCRIBER_BACKLOG)
+    )
+    overflowed: bool = False
+
+    def deliver(self, event: InstanceEvent) -> None:
+        # runs on the loop of the subscriber
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class EventBroker:
+    """Receives the events of every worker through the database and hands them out to the subscribers of this one.
+
+    A single database subscription serves every subscriber of the worker, no matter how many there are.
+    """
+
+    def __init__(self, database: Database) -> None:
+        self.__database = database
+        self.__subscriptions: set[Subscription] = set()
+        self.__lock = Lock()
+
+    def start(self) -> None:
+        Thread(target=self.__run, name='Event Dispatcher', daemon=True).start()
+
+    @contextmanager
+    def subscribe(self, instance_ids: set[str] | None) -> Iterator[Subscription]:
+        """Subscribes the running event loop, to the events of `instance_ids` or to all events if it is None."""
+        subscription = Subscription(asyncio.get_running_loop(), instance_ids)
+        with self.__lock:
+            self.__subscriptions.add(subscription)
+        try:
+            yield subscription
+        finally:
+            with self.__lock:
+                self.__subscriptions.discard(subscription)
+
+    def __run(self) -> None:
+        while True:
+            try:
+                events = self.__database.wait_for_events(EVENTS_POLL_TIMEOUT)
+            except Exception as e:
+                logger.opt(exception=e).error('failed to receive instance events')
+                time.sleep(EVENTS_POLL_TIMEOUT)
+                continue
+
+            with self.__lock:
+                subscriptions = list(self.__subscriptions)
+
+            for event in events:
+                for subscription in subscriptions:
+                    if subscription.instance_ids is None or event['instance_id'] in subscription.instance_ids:
+                        # the loop might have been closed during shutdown
+                        with suppress(RuntimeError):
+                            subscription.loop.call_soon_threadsafe(subscription.deliver, event)
@@ -0,0 +1,200 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+from collections.abc import AsyncGenerator, Awaitable, Callable
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from threading import Lock
+
+import aiohttp
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
+from loguru import logger
+
+
+# Where the instances would have forked from, anvils should use this service as their fork_url instead
+FORK_CACHE_UPSTREAM = os.getenv('FORK_CACHE_UPSTREAM')
+FORK_CACHE_PATH = os.getenv('FORK_CACHE_PATH', 'fork-cache.sqlite3')
+FORK_CACHE_UPSTREAM_TIMEOUT = int(os.getenv('FORK_CACHE_UPSTREAM_TIMEOUT', '30'))
+
+# Methods whose result never changes once they are pinned to a block, mapped to the index of their block parameter
+CACHEABLE_METHODS = {
+    'eth_getStorageAt': 2,
+    'eth_getCode': 1,
+    'eth_getBalance': 1,
+    'eth_getTransactionCount': 1,
+    'eth_getBlockByNumber': 0,
+}
+
+Upstream = Callable[[dict], Awaitable[dict]]
+
+
+class ForkCacheError(Exception):
+    """Custom exception for fork cache errors."""
+
+
+def _is_pinned(block: object) -> bool:
+    # block tags like `latest` or `safe` move, plain numbers and EIP-1898 block hashes/numbers do not
+    if isinstance(block, str):
+        return block.startswith('0x')
+    if isinstance(block, dict):
+        return 'blockHash' in block or 'blockNumber' in block
+    return False
+
+
+def get_cache_key(request: dict) -> str | None:
+    """Returns the key `request` is cached under, or None if its result can change over time."""
+    method = request.get('method')
+    params = request.get('params')
+    if method not in CACHEABLE_METHODS or not isinstance(params, list):
+        return None
+
+    block_index = CACHEABLE_METHODS[method]
+    if len(params) <= block_index or not _is_pinned(params[block_index]):
+        return None
+
+    # every parameter of these methods is either hex or a bool, so the casing does not matter
+    key_material = json.dumps([method, params], separators=(',', ':')).lower()
+    return hashlib.sha256(key_material.encode()).hexdigest()
+
+
+class ForkCacheStorage:
+    def __init__(self, path: str) -> None:
+        self.__conn = sqlite3.connect(database=path, check_same_thread=False)
+        self.__lock = Lock()
+
+        with self.__lock:
+            self.__conn.execute('PRAGMA journal_mode=WAL')
+            self.__conn.execute('CREATE TABLE IF NOT EXISTS rpc_cache (key TEXT PRIMARY KEY, result TEXT NOT NULL)')
+            self.__conn.commit()
+
+    def get(self, key: str) -> object | None:
+        with self.__lock:
+            row = self.__conn.execute('SELECT result FROM rpc_cache WHERE key = ?', (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key: str, result: object) -> None:
+        with self.__lock:
+            self.__conn.execute('INSERT OR REPLACE INTO rpc_cache VALUES (?, ?)', (key, json.dumps(result)))
+            self.__conn.commit()
+
+
+class ForkCache:
+    """Answers block-pinned state reads from disk, forwarding everything else to the upstream.
+
+    Concurrent misses for the same key share a single upstream request, so a burst of anvils forking from the same
+    block only fetches every slot once.
+    """
+
+    def __init__(self, storage: ForkCacheStorage, upstream: Upstream) -> None:
+        self.__storage = storage
+        self.__upstream = upstream
+        self.__pending: dict[str, asyncio.Future[dict]] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    async def handle(self, request: dict) -> dict:
+        key = get_cache_key(request)
+        if key is None:
+            return await self.__upstream(request)
+
+        result = self.__storage.get(key)
+        if result is not None:
+            self.hits += 1
+            return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': result}
+
+        pending = self.__pending.get(key)
+        if pending is None:
+            self.misses += 1
+            pending = asyncio.ensure_future(self.__fetch(key, request))
+            self.__pending[key] = pending
+            pending.add_done_callback(lambda _: self.__pending.pop(key, None))
+
+        # shielded, so that a client hanging up does not cancel the fetch for everyone else waiting on it
+        response = await asyncio.shield(pending)
+        return response | {'id': request.get('id')}
+
+    async def __fetch(self, key: str, request: dict) -> dict:
+        response = await self.__upstream(request)
+        # errors and nulls (e.g. a block that does not exist yet) are not final, so they are not cached
+        if response.get('result') is not None and 'error' not in response:
+            self.__storage.put(key, response['result'])
+        return response
+
+
+@dataclass
+class Context:
+    # note(es3n1n, 27.03.24): HACK: mypy won't know that we will initialize these within the lifespan
+    session: aiohttp.ClientSession = None  # type: ignore[assignment]
+    cache: ForkCache = None  # type: ignore[assignment]
+
+    def setup(self) -> None:
+        if FORK_CACHE_UPSTREAM is None:
+            msg = 'FORK_CACHE_UPSTREAM is not set'
+            raise ForkCacheError(msg)
+
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=FORK_CACHE_UPSTREAM_TIMEOUT))
+        self.cache = ForkCache(ForkCacheStorage(FORK_CACHE_PATH), self.send_upstream)
+
+    async def send_upstream(self, request: dict) -> dict:
+        async with self.session.post(FORK_CACHE_UPSTREAM, json=request) as resp:  # type: ignore[arg-type]
+            return await resp.json()
+
+    async def shutdown(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+
+context = Context()
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncGenerator[None]:
+    context.setup()
+    yield
+    await context.shutdown()
+
+
+app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+
+
+def jsonrpc_fail(id_: str | int | None, code: int, message: str) -> dict:
+    return {'jsonrpc': '2.0', 'id': id_, 'error': {'code': code, 'message': message}}
+
+
+async def handle_request(request: object) -> dict:
+    if not isinstance(request, dict):
+        return jsonrpc_fail(None, -32600, 'expected json object')
+
+    try:
+        return await context.cache.handle(request)
+    except Exception as e:
+        logger.opt(exception=e).error(f'failed to forward {request.get("method")} to the upstream')
+        return jsonrpc_fail(request.get('id'), -32603, 'failed to forward request to the upstream')
+
+
+@app.post('/')
+async def rpc(request: Request) -> dict | list:
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        return jsonrpc_fail(None, -32600, 'expected json body')
+
+    if isinstance(body, list):
+        return list(await asyncio.gather(*(handle_request(item) for item in body)))
+    return await handle_request(body)
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics() -> str:
+    return (
+        '# HELP paradigmctf_fork_cache_hits_total Block-pinned requests answered from the cache.\n'
+        '# TYPE paradigmctf_fork_cache_hits_total counter\n'
+        f'paradigmctf_fork_cache_hits_total {context.cache.hits}\n'
+        '# HELP paradigmctf_fork_cache_misses_total Block-pinned requests fetched from the upstream.\n'
+        '# TYPE paradigmctf_fork_cache_misses_total counter\n'
+        f'paradigmctf_fork_cache_misses_total {context.cache.misses}\n'
+    )
@@ -1,6 +1,6 @@
 import os
 
-from .backends import Backend, DockerBackend, KubernetesBackend
+from .backends import Backend, DockerBackend, KubernetesBackend, ProcessBackend
 from .databases import Database, RedisDatabase, SQLiteDatabase
 
 
@@ -28,6 +28,8 @@ def load_backend(database: Database) -> Backend:
     if backend_type == 'kubernetes':
         config_file = os.getenv('KUBECONFIG', 'incluster')
         return KubernetesBackend(database, config_file)
+    if backend_type == 'process':
+        return ProcessBackend(database)
 
     msg = f'Invalid backend type: {backend_type}'
     raise BackendLoaderError(msg) from None
@@ -1,27 +1,50 @@
-from collections.abc import AsyncGenerator
+import asyncio
+import json
+import time
+import uuid
+from collections.abc import AsyncGenerator, AsyncIterator, Awaitable, Callable
 from contextlib import asynccontextmanager
 from dataclasses import dataclass
+from typing import Annotated
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Query, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from loguru import logger
 
+from . import debug
+from .admission import AdmissionController, AdmissionRejectedError
 from .backends import Backend
-from .backends.backend import InstanceExistsError
+from .backends.backend import InstanceExistsError, InstanceResetError, LaunchInProgressError
 from .databases import Database
+from .databases.database import InvalidCursorError
+from .events import EventBroker, publish_event
 from .loaders import load_backend, load_database
-from .types import CreateInstanceRequest, UserData
+from .tracing import tracer
+from .types import BulkExtendRequest, BulkKillRequest, CreateInstanceRequest, ImageStatus, UserData
 from .utils import worker
 
 
+# Comment lines sent while nothing happens, so that proxies and clients do not time the stream out
+EVENTS_KEEPALIVE_INTERVAL = 15.0
+LIST_MAX_LIMIT = 1000
+# Instances a single bulk request may target
+BULK_MAX_INSTANCES = 10000
+
+
 @dataclass
 class Context:
     # note(es3n1n, 27.03.24): HACK: mypy won't know that we will initialize these within the lifespan
     database: Database = None  # type: ignore[assignment]
     backend: Backend = None  # type: ignore[assignment]
+    admission: AdmissionController = None  # type: ignore[assignment]
+    events: EventBroker = None  # type: ignore[assignment]
 
     def setup(self) -> None:
         self.database = load_database()
         self.backend = load_backend(self.database)
+        self.admission = AdmissionController(self.database, self.backend)
+        self.events = EventBroker(self.database)
+        self.events.start()
 
 
 context = Context()
@@ -29,38 +52,138 @@ context = Context()
 
 @asynccontextmanager
 async def lifespan(_: FastAPI) -> AsyncGenerator[None]:
-    worker.setup('orchestrator')
     context.setup()
+    tracer.setup('orchestrator')
+    worker.setup('orchestrator', context.database)
     yield
+    worker.shutdown()
 
 
 app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+debug.install(app)
+
+
+@app.middleware('http')
+async def continue_trace(request: Request, call_next: Callable[[Request], Awaitable[Response]]) -> Response:
+    # the launchers pass their trace along, so that our spans end up in the same trace as theirs
+    with tracer.continue_trace(request.headers):
+        return await call_next(request)
 
 
 @app.post('/instances')
-def create_instance(args: CreateInstanceRequest) -> dict[str, bool | str | UserData]:
-    logger.info(f'launching new instance: {args["instance_id"]}')
+def create_instance(args: CreateInstanceRequest) -> dict[str, bool | str | UserData | dict[str, float]]:
+    with tracer.span('orchestrator.create_instance', instance_id=args['instance_id'], challenge=args.get('challenge')):
+        return _create_instance(args)
 
+
+def _create_instance(args: CreateInstanceRequest) -> dict[str, bool | str | UserData | dict[str, float]]:
+    # per request rather than per instance, the instance id is the same for every connection of a team
+    ticket = args.get('ticket') or uuid.uuid4().hex
     try:
-        user_data = context.backend.launch_instance(args)
+        with tracer.span('orchestrator.admission'):
+            queued = context.admission.admit(args, ticket)
+    except AdmissionRejectedError as e:
+        logger.warning(f'refused to launch instance {args["instance_id"]}: {e}')
+        return {
+            'ok': False,
+            'message': str(e),
+        }
+
+    if queued is not None:
+        return {
+            'ok': False,
+            'message': 'launch queued',
+            'ticket': ticket,
+            'queue': {
+                'position': queued.position,
+                'estimated_wait': queued.estimated_wait,
+            },
+        }
+
+    logger.info(f'launching new instance: {args["instance_id"]}')
+    started_at = time.monotonic()
+    try:
+        user_data, attached = context.backend.launch_or_attach_instance(args)
     except InstanceExistsError:
         logger.warning(f'instance already exists: {args["instance_id"]}')
         return {
             'ok': False,
             'message': 'instance already exists',
         }
+    except LaunchInProgressError as e:
+        logger.warning(str(e))
+        return {
+            'ok': False,
+            'message': 'instance is still being launched',
+        }
     except Exception as e:
         logger.opt(exception=e).error(f'failed to launch instance: {args["instance_id"]}')
         return {
             'ok': False,
             'message': 'an internal error occurred',
         }
+    finally:
+        context.admission.release(ticket, time.monotonic() - started_at)
 
-    logger.info(f'launched new instance: {args["instance_id"]}')
+    # whoever started the launch deploys the challenge, a caller that attached to it only has to wait for that
+    logger.info(f'{"attached to the launch of" if attached else "launched new"} instance: {args["instance_id"]}')
     return {
         'ok': True,
-        'message': 'instance launched',
+        'message': 'instance already being launched' if attached else 'instance launched',
         'data': user_data,
+        'attached': attached,
+    }
+
+
+@app.get('/instances')
+def list_instances(
+    cursor: str | None = None,
+    limit: Annotated[int, Query(gt=0, le=LIST_MAX_LIMIT)] = 100,
+    challenge: str | None = None,
+    expires_after: float | None = None,
+    expires_before: float | None = None,
+) -> dict[str, bool | str | list[UserData] | None]:
+    """Lists instances ordered by expiry, pass the returned cursor back to get the next page."""
+    try:
+        instances, next_cursor = context.database.list_instances(
+            cursor,
+            limit,
+            challenge=challenge,
+            expires_after=expires_after,
+            expires_before=expires_before,
+        )
+    except InvalidCursorError as e:
+        return {'ok': False, 'message': str(e)}
+
+    return {'ok': True, 'message': 'fetched instances', 'data': instances, 'cursor': next_cursor}
+
+
+@app.post('/instances/bulk-kill')
+def bulk_kill_instances(args: BulkKillRequest) -> dict[str, bool | str | list[str]]:
+    if len(args['instance_ids']) > BULK_MAX_INSTANCES:
+        return {'ok': False, 'message': f'at most {BULK_MAX_INSTANCES} instances at once'}
+
+    logger.info(f'killing {len(args["instance_ids"])} instances in bulk')
+    instances = context.backend.kill_instances(args['instance_ids'])
+    return {
+        'ok': True,
+        'message': f'{len(instances)} instances deleted',
+        'data': [instance['instance_id'] for instance in instances],
+    }
+
+
+@app.post('/instances/bulk-extend')
+def bulk_extend_instances(args: BulkExtendRequest) -> dict[str, bool | str | dict[str, float]]:
+    if len(args['instance_ids']) > BULK_MAX_INSTANCES:
+        return {'ok': False, 'message': f'at most {BULK_MAX_INSTANCES} instances at once'}
+    if args['seconds'] <= 0:
+        return {'ok': False, 'message': 'instances can only be extended by a positive amount of seconds'}
+
+    expiries = context.database.extend_instances(args['instance_ids'], args['seconds'])
+    return {
+        'ok': True,
+        'message': f'{len(expiries)} instances extended',
+        'data': expiries,
     }
 
 
@@ -84,12 +207,59 @@ def update_metadata(instance_id: str, metadata: dict[str, str | list[dict[str, s
         # FIXME(es3n1n, 16.07.25): do not catch all exceptions, but only the ones we expect
         return {'ok': False, 'message': 'instance does not exist'}
 
+    publish_event(context.database, 'metadata-updated', instance_id, keys=list(metadata))
+
     return {
         'ok': True,
         'message': 'metadata updated',
     }
 
 
+@app.post('/instances/{instance_id}/wake')
+def wake_instance(instance_id: str) -> dict[str, bool | str | UserData]:
+    try:
+        user_data = context.backend.wake_instance(instance_id)
+    except Exception as e:
+        logger.opt(exception=e).error(f'failed to wake instance up: {instance_id}')
+        return {'ok': False, 'message': 'failed to wake instance up'}
+
+    if user_data is None:
+        return {'ok': False, 'message': 'instance does not exist'}
+
+    return {'ok': True, 'message': 'instance is awake', 'data': user_data}
+
+
+@app.post('/instances/{instance_id}/snapshot')
+def snapshot_instance(instance_id: str) -> dict[str, bool | str]:
+    try:
+        user_data = context.backend.snapshot_instance(instance_id)
+    except Exception as e:
+        logger.opt(exception=e).error(f'failed to snapshot instance: {instance_id}')
+        return {'ok': False, 'message': 'failed to snapshot instance'}
+
+    if user_data is None:
+        return {'ok': False, 'message': 'instance does not exist'}
+
+    return {'ok': True, 'message': 'instance snapshotted'}
+
+
+@app.post('/instances/{instance_id}/reset')
+def reset_instance(instance_id: str) -> dict[str, bool | str]:
+    logger.info(f'resetting instance: {instance_id}')
+    try:
+        user_data = context.backend.reset_instance(instance_id)
+    except InstanceResetError as e:
+        return {'ok': False, 'message': str(e)}
+    except Exception as e:
+        logger.opt(exception=e).error(f'failed to reset instance: {instance_id}')
+        return {'ok': False, 'message': 'an internal error occurred'}
+
+    if user_data is None:
+        return {'ok': False, 'message': 'instance does not exist'}
+
+    return {'ok': True, 'message': 'instance reset'}
+
+
 @app.delete('/instances/{instance_id}')
 def delete_instance(instance_id: str) -> dict[str, bool | str]:
     logger.info(f'killing instance: {instance_id}')
@@ -104,3 +274,60 @@ def delete_instance(instance_id: str) -> dict[str, bool | str]:
         'ok': True,
         'message': 'instance deleted',
     }
+
+
+@app.delete('/challenges/{challenge}/instances')
+def delete_challenge_instances(challenge: str) -> dict[str, bool | str | list[str]]:
+    logger.info(f'killing every instance of challenge: {challenge}')
+    instances = context.backend.kill_challenge(challenge)
+    return {
+        'ok': True,
+        'message': f'{len(instances)} instances deleted',
+        'data': [instance['instance_id'] for instance in instances],
+    }
+
+
+@app.get('/events')
+async def stream_events(instance_id: Annotated[list[str] | None, Query()] = None) -> StreamingResponse:
+    """Streams instance lifecycle events as server-sent events, only the ones of `instance_id` if it is given."""
+    return StreamingResponse(
+        _event_stream(set(instance_id) if instance_id else None),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache'},
+    )
+
+
+async def _event_stream(instance_ids: set[str] | None) -> AsyncIterator[str]:
+    with context.events.subscribe(instance_ids) as subscription:
+        # from here on nothing gets missed, clients fetch whatever state they need once they see this
+        yield 'event: subscribed\ndata: {}\n\n'
+
+        # a subscriber that fell too far behind is dropped, it reconnects and fetches the state again
+        while not subscription.overflowed:
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), EVENTS_KEEPALIVE_INTERVAL)
+            except TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+
+            yield f'event: {event["type"]}\ndata: {json.dumps(event)}\n\n'
+
+
+@app.get('/images')
+def get_images() -> dict[str, bool | str | dict[str, dict[str, ImageStatus]]]:
+    return {'ok': True, 'message': 'fetched images', 'data': context.database.get_image_statuses()}
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+def metrics() -> str:
+    expired = context.database.count_expired_instances()
+    # killed instances whose resources are still queued for teardown, or failed to be torn down so far
+    teardowns = context.database.count_pending_teardowns()
+    return (
+        '# HELP paradigmctf_reaper_backlog Expired instances that have not been torn down yet.\n'
+        '# TYPE paradigmctf_reaper_backlog gauge\n'
+        f'paradigmctf_reaper_backlog {expired + teardowns}\n'
+        '# HELP paradigmctf_teardown_backlog Killed instances whose resources have not been torn down yet.\n'
+        '# TYPE paradigmctf_teardown_backlog gauge\n'
+        f'paradigmctf_teardown_backlog {teardowns}\n'
+    ) + tracer.histograms.render()
@@ -0,0 +1,258 @@
+import atexit
+import json
+import os
+import re
+import secrets
+import time
+from bisect import bisect_left
+from collections.abc import Iterator, Mapping
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from threading import Lock, Thread
+
+import requests
+from loguru import logger
+
+
+# Where finished spans go: `off`, `file` (json lines) or `otlp` (OTLP/HTTP json, e.g. an OpenTelemetry collector)
+TRACING_EXPORTER = os.getenv('TRACING_EXPORTER', 'off')
+TRACING_FILE = Path(os.getenv('TRACING_FILE', 'traces.jsonl'))
+TRACING_OTLP_ENDPOINT = os.getenv('TRACING_OTLP_ENDPOINT', 'http://127.0.0.1:4318/v1/traces')
+TRACING_EXPORT_INTERVAL = 5.0
+TRACING_EXPORT_TIMEOUT = 5
+
+# W3C trace context, so that the traces line up with whatever else the collector receives
+TRACEPARENT_HEADER = 'traceparent'
+TRACEPARENT_PATTERN = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+
+HISTOGRAM_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+AttributeValue = str | int | float | bool
+
+
+@dataclass
+class Span:
+    name: str
+    service: str
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    # unix timestamps, in seconds
+    start_time: float
+    end_time: float
+    attributes: dict[str, AttributeValue] = field(default_factory=dict)
+    error: str | None = None
+
+
+class LatencyHistograms:
+    """Durations of the finished spans of this process, by span name."""
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.__buckets: dict[str, list[int]] = {}
+        self.__sums: dict[str, float] = {}
+
+    def observe(self, name: str, duration: float) -> None:
+        with self.__lock:
+            buckets = self.__buckets.setdefault(name, [0] * (len(HISTOGRAM_BUCKETS) + 1))
+            buckets[bisect_left(HISTOGRAM_BUCKETS, duration)] += 1
+            self.__sums[name] = self.__sums.get(name, 0.0) + duration
+
+    def render(self) -> str:
+        lines = [
+            '# HELP paradigmctf_span_duration_seconds Duration of the traced launch phases.',
+            '# TYPE paradigmctf_span_duration_seconds histogram',
+        ]
+        with self.__lock:
+            for name, buckets in sorted(self.__buckets.items()):
+                cumulative = 0
+                for bound, count in zip((*HISTOGRAM_BUCKETS, '+Inf'), buckets, strict=True):
+                    cumulative += count
+                    lines.append(f'paradigmctf_span_duration_seconds_bucket{{span="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'paradigmctf_span_duration_seconds_sum{{span="{name}"}} {self.__sums[name]}')
+                lines.append(f'paradigmctf_span_duration_seconds_count{{span="{name}"}} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+class FileExporter:
+    def __init__(self, path: Path) -> None:
+        self.__path = path
+        self.__lock = Lock()
+
+    def export(self, span: Span) -> None:
+        with self.__lock, self.__path.open('a') as f:
+            f.write(json.dumps(asdict(span)) + '\n')
+
+
+class OtlpExporter:
+    """Sends the spans in batches from a background thread, whatever is left gets flushed when the process exits."""
+
+    def __init__(self, endpoint: str) -> None:
+        self.__endpoint = endpoint
+        self.__lock = Lock()
+        self.__pending: list[Span] = []
+
+        Thread(target=self.__run, name='Trace Exporter', daemon=True).start()
+        atexit.register(self.flush)
+
+    def export(self, span: Span) -> None:
+        with self.__lock:
+            self.__pending.append(span)
+
+    def __run(self) -> None:
+        while True:
+            time.sleep(TRACING_EXPORT_INTERVAL)
+            self.flush()
+
+    def flush(self) -> None:
+        with self.__lock:
+            spans, self.__pending = self.__pending, []
+        if not spans:
+            return
+
+        try:
+            requests.post(self.__endpoint, json=self.__serialize(spans), timeout=TRACING_EXPORT_TIMEOUT)
+        except Exception as e:
+            logger.opt(exception=e).warning(f'failed to export {len(spans)} spans')
+
+    @staticmethod
+    def __serialize(spans: list[Span]) -> dict:
+        by_service: dict[str, list[Span]] = {}
+        for span in spans:
+            by_service.setdefault(span.service, []).append(span)
+
+        return {
+            'resourceSpans': [
+                {
+                    'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': service}}]},
+                    'scopeSpans': [
+                        {
+                            'scope': {'name': 'paradigmctf'},
+                            'spans': [OtlpExporter.__serialize_span(span) for span in service_spans],
+                        }
+                    ],
+                }
+                for service, service_spans in by_service.items()
+            ]
+        }
+
+    @staticmethod
+    def __serialize_span(span: Span) -> dict:
+        attributes = []
+        for key, value in span.attributes.items():
+            if isinstance(value, bool):
+                attributes.append({'key': key, 'value': {'boolValue': value}})
+            elif isinstance(value, int):
+                attributes.append({'key': key, 'value': {'intValue': str(value)}})
+            elif isinstance(value, float):
+                attributes.append({'key': key, 'value': {'doubleValue': value}})
+            else:
+                attributes.append({'key': key, 'value': {'stringValue': value}})
+
+        return {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'parentSpanId': span.parent_id or '',
+            'name': span.name,
+            # internal
+            'kind': 1,
+            'startTimeUnixNano': str(int(span.start_time * 1e9)),
+            'endTimeUnixNano': str(int(span.end_time * 1e9)),
+            'attributes': attributes,
+            # error or ok
+            'status': {'code': 2, 'message': span.error} if span.error is not None else {'code': 1},
+        }
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.service = 'paradigmctf'
+        self.histograms = LatencyHistograms()
+        # trace id and span id of the innermost span we are in
+        self.__current: ContextVar[tuple[str, str] | None] = ContextVar('paradigmctf_trace', default=None)
+
+        self.__exporter: FileExporter | OtlpExporter | None = None
+        self.__exporter_lock = Lock()
+
+    def setup(self, service: str) -> None:
+        self.service = service
+
+    @contextmanager
+    def span(self, name: str, **attributes: AttributeValue | None) -> Iterator[None]:
+        """Traces everything within the block as `name`, as a child of the span we are in, if any."""
+        parent = self.__current.get()
+        trace_id = parent[0] if parent is not None else secrets.token_hex(16)
+        span_id = secrets.token_hex(8)
+
+        token = self.__current.set((trace_id, span_id))
+        start_time = time.time()
+        started_at = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            self.__current.reset(token)
+            duration = time.perf_counter() - started_at
+            self.histograms.observe(name, duration)
+            self.__export(
+                Span(
+                    name=name,
+                    service=self.service,
+                    trace_id=trace_id,
+                    span_id=span_id,
+                    parent_id=parent[1] if parent is not None else None,
+                    start_time=start_time,
+                    end_time=start_time + duration,
+                    attributes={key: value for key, value in attributes.items() if value is not None},
+                    error=error,
+                )
+            )
+
+    @contextmanager
+    def continue_trace(self, headers: Mapping[str, str]) -> Iterator[None]:
+        """Makes the spans within the block children of the span that sent the request with `headers`."""
+        match = TRACEPARENT_PATTERN.match(headers.get(TRACEPARENT_HEADER, ''))
+        if match is None:
+            yield
+            return
+
+        token = self.__current.set((match.group(1), match.group(2)))
+        try:
+            yield
+        finally:
+            self.__current.reset(token)
+
+    def get_headers(self) -> dict[str, str]:
+        """Returns the headers that carry the current trace over to the service we are about to call."""
+        current = self.__current.get()
+        if current is None:
+            return {}
+        return {TRACEPARENT_HEADER: f'00-{current[0]}-{current[1]}-01'}
+
+    def __export(self, span: Span) -> None:
+        exporter = self.__get_exporter()
+        if exporter is None:
+            return
+
+        try:
+            exporter.export(span)
+        except Exception as e:
+            logger.opt(exception=e).warning(f'failed to export span {span.name}')
+
+    def __get_exporter(self) -> FileExporter | OtlpExporter | None:
+        # created on first use, so that processes that never trace anything do not start the exporter thread
+        with self.__exporter_lock:
+            if self.__exporter is None:
+                if TRACING_EXPORTER == 'file':
+                    self.__exporter = FileExporter(TRACING_FILE)
+                elif TRACING_EXPORTER == 'otlp':
+                    self.__exporter = OtlpExporter(TRACING_OTLP_ENDPOINT)
+            return self.__exporter
+
+
+tracer = Tracer()
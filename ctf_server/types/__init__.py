@@ -1,5 +1,5 @@
 import os
-from typing import NotRequired
+from typing import Literal, NotRequired
 
 from eth_account import Account
 from eth_account.account import LocalAccount
@@ -13,6 +13,11 @@ DEFAULT_DERIVATION_PATH = "m/44'/60'/0'/0/"
 DEFAULT_ACCOUNTS = 10
 DEFAULT_BALANCE = 1000
 DEFAULT_MNEMONIC = 'test test test test test test test test test test test junk'
+DEFAULT_PERSISTENCE = os.getenv('DEFAULT_PERSISTENCE', 'disk')
+DEFAULT_STATE_INTERVAL = 5
+
+# Where anvil keeps its state: nowhere, in memory (survives anvil restarts, not container ones) or on disk
+Persistence = Literal['off', 'tmpfs', 'disk']
 
 PUBLIC_HOST = os.getenv('PUBLIC_HOST', 'http://127.0.0.1:8545')
 
@@ -31,15 +36,38 @@ class LaunchAnvilInstanceArgs(TypedDict):
     code_size_limit: NotRequired[int | None]
     block_time: NotRequired[int | None]
     extra_allowed_methods: NotRequired[list[str] | None]
-
-
-def format_anvil_args(args: LaunchAnvilInstanceArgs, anvil_id: str, port: int = 8545) -> list[str]:
+    # resource profile (see ctf_server.backends.resources), cpus and memory (MiB) override its limits
+    profile: NotRequired[str | None]
+    cpus: NotRequired[float | None]
+    memory: NotRequired[int | None]
+    # True keeps no history at all, a number keeps that many states
+    prune_history: NotRequired[int | bool | None]
+    transaction_block_keeper: NotRequired[int | None]
+    compute_units_per_second: NotRequired[int | None]
+    persistence: NotRequired[Persistence | None]
+    state_interval: NotRequired[int | None]
+
+
+def get_persistence(args: LaunchAnvilInstanceArgs) -> Persistence:
+    return args.get('persistence') or DEFAULT_PERSISTENCE  # type: ignore[return-value]
+
+
+def format_anvil_args(
+    args: LaunchAnvilInstanceArgs,
+    anvil_id: str,
+    port: int = 8545,
+    *,
+    host: str = '0.0.0.0',
+    state_dir: str = '/data',
+) -> list[str]:
     cmd_args = []
-    cmd_args += ['--host', '0.0.0.0']
+    cmd_args += ['--host', host]
     cmd_args += ['--port', str(port)]
     cmd_args += ['--accounts', '0']
-    cmd_args += ['--state', f'/data/{anvil_id}-state.json']
-    cmd_args += ['--state-interval', '5']
+
+    if get_persistence(args) != 'off':
+        cmd_args += ['--state', f'{state_dir}/{anvil_id}-state.json']
+        cmd_args += ['--state-interval', str(args.get('state_interval') or DEFAULT_STATE_INTERVAL)]
 
     if args.get('fork_url') is not None:
         cmd_args += ['--fork-url', str(args['fork_url'])]
@@ -62,6 +90,24 @@ def format_anvil_args(args: LaunchAnvilInstanceArgs, anvil_id: str, port: int =
     if args.get('block_time') is not None:
         cmd_args += ['--block-time', str(args['block_time'])]
 
+    return cmd_args + _format_resource_anvil_args(args)
+
+
+def _format_resource_anvil_args(args: LaunchAnvilInstanceArgs) -> list[str]:
+    cmd_args = []
+
+    prune_history = args.get('prune_history')
+    if prune_history is True:
+        cmd_args += ['--prune-history']
+    elif prune_history:
+        cmd_args += ['--prune-history', str(prune_history)]
+
+    if args.get('transaction_block_keeper') is not None:
+        cmd_args += ['--transaction-block-keeper', str(args['transaction_block_keeper'])]
+
+    if args.get('compute_units_per_second') is not None:
+        cmd_args += ['--compute-units-per-second', str(args['compute_units_per_second'])]
+
     return cmd_args
 
 
@@ -72,8 +118,21 @@ class DaemonInstanceArgs(TypedDict):
 class CreateInstanceRequest(TypedDict):
     instance_id: str
     timeout: int
+    team: NotRequired[str | None]
+    challenge: NotRequired[str | None]
     anvil_instances: NotRequired[dict[str, LaunchAnvilInstanceArgs]]
     daemon_instances: NotRequired[dict[str, DaemonInstanceArgs]]
+    # handed out with the first queued response, sent back while polling so that the launch keeps its place
+    ticket: NotRequired[str | None]
+
+
+class BulkKillRequest(TypedDict):
+    instance_ids: list[str]
+
+
+class BulkExtendRequest(TypedDict):
+    instance_ids: list[str]
+    seconds: float
 
 
 class InstanceInfo(TypedDict):
@@ -81,16 +140,59 @@ class InstanceInfo(TypedDict):
     ip: NotRequired[str]
     port: NotRequired[int]
     extra_allowed_methods: NotRequired[list[str] | None]
+    persistence: NotRequired[Persistence]
 
 
 class UserData(TypedDict):
     instance_id: str
+    # missing for instances launched before launches had generations, their resources are named after the instance
+    generation: NotRequired[str]
     external_id: str
     created_at: float
     expires_at: float
     anvil_instances: dict[str, InstanceInfo]
     daemon_instances: dict[str, InstanceInfo]
     metadata: dict
+    team: NotRequired[str | None]
+    challenge: NotRequired[str | None]
+    node: NotRequired[str | None]
+    network: NotRequired[str | None]
+    hibernated: NotRequired[bool]
+    health: NotRequired['HealthStatus']
+    # every image the instance runs, missing for instances launched before it was recorded
+    images: NotRequired[list[str]]
+
+
+class HealthStatus(TypedDict):
+    healthy: bool
+    # seconds the slowest anvil of the instance took to answer, missing or None if it was not measured
+    latency: NotRequired[float | None]
+    checked_at: float
+    # consecutive failed checks
+    failures: int
+
+
+InstanceEventType = Literal['launching', 'ready', 'metadata-updated', 'expiring', 'killed']
+
+
+class InstanceEvent(TypedDict):
+    type: InstanceEventType
+    instance_id: str
+    timestamp: float
+    # metadata-updated: the keys that changed
+    keys: NotRequired[list[str]]
+
+
+class ImageStatus(TypedDict):
+    # pulling, ready or failed
+    state: str
+    updated_at: float
+    error: NotRequired[str | None]
+
+
+def keeps_state(instance: UserData) -> bool:
+    """Whether every anvil of the instance keeps its state on disk, i.e. whether it survives being restarted."""
+    return all(anvil.get('persistence') == 'disk' for anvil in instance['anvil_instances'].values())
 
 
 def get_account(mnemonic: str, offset: int) -> LocalAccount:
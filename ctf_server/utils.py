@@ -1,22 +1,126 @@
-import contextlib
+import os
+import secrets
+import socket
+import time
+from collections.abc import Callable
+from threading import Thread
+from typing import TYPE_CHECKING
 
-from filelock import FileLock, Timeout
+from loguru import logger
+
+
+if TYPE_CHECKING:
+    from ctf_server.databases import Database
+
+
+LEADER_LEASE_TTL = float(os.getenv('LEADER_LEASE_TTL', '10'))
 
 
 class Worker:
+    """Elects a single leader among all the workers of a service, across every replica, through a database lease.
+
+    Background work (pruning, reconciliation, etc.) only runs on the leader; if it dies, another worker takes the
+    lease over once it expires, within `LEADER_LEASE_TTL` seconds. Leader-only actions that change anything call
+    `still_leader` right before acting, so that a leader that got paused past its lease stops once it resumes.
+    """
+
     def __init__(self) -> None:
-        self.lock: FileLock | None = None
+        self.holder = f'{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(4)}'
+        self.fencing_token: int | None = None
 
-    def setup(self, service_name: str) -> None:
-        self.lock = FileLock(f'worker-{service_name}.lock')
-        with contextlib.suppress(Timeout):
-            self.lock.acquire(blocking=False)
+        self.__database: Database | None = None
+        self.__lease_name: str | None = None
+        self.__leader_until = 0.0
+
+    def setup(self, service_name: str, database: 'Database') -> None:
+        self.__database = database
+        self.__lease_name = f'leader/{service_name}'
+
+        self.__elect()
+        Thread(target=self.__election_thread, name=f'{service_name} Leader Election', daemon=True).start()
+
+    def shutdown(self) -> None:
+        if self.__database is None or self.__lease_name is None or not self.is_leader:
+            return
+
+        # let the other workers take over right away instead of waiting for the lease to expire
+        self.__leader_until = 0.0
+        try:
+            self.__database.release_lease(self.__lease_name, self.holder)
+        except Exception as e:
+            logger.opt(exception=e).warning('failed to release the leader lease')
 
     @property
-    def is_first(self) -> bool:
-        if self.lock is None:
+    def is_leader(self) -> bool:
+        return time.monotonic() < self.__leader_until
+
+    def still_leader(self) -> bool:
+        """Checks with the database that the lease is still ours under our fencing token.
+
+        Unlike `is_leader`, this catches a leader that was paused for longer than the lease and did not notice yet. The
+        window between the check and the action it guards is a single round trip, rather than the whole lease.
+        """
+        token = self.fencing_token
+        if self.__database is None or self.__lease_name is None or token is None or not self.is_leader:
             return False
-        return self.lock.is_locked
+
+        try:
+            held = self.__database.holds_lease(self.__lease_name, self.holder, token)
+        except Exception as e:
+            logger.opt(exception=e).warning('failed to check the leader lease')
+            return False
+
+        if not held:
+            logger.warning(f'lost leadership of {self.__lease_name} (fencing token {token})')
+            self.__leader_until = 0.0
+            self.fencing_token = None
+        return held
+
+    def run_periodically(self, name: str, target: Callable[[], None], interval: float) -> None:
+        """Runs `target` every `interval` seconds in a background thread, only while this worker is the leader."""
+
+        @logger.catch
+        def step() -> None:
+            if self.is_leader:
+                target()
+
+        def loop() -> None:
+            while True:
+                step()
+                time.sleep(interval)
+
+        Thread(target=loop, name=name, daemon=True).start()
+
+    def __election_thread(self) -> None:
+        while True:
+            time.sleep(LEADER_LEASE_TTL / 3)
+            self.__elect()
+
+    def __elect(self) -> None:
+        if self.__database is None or self.__lease_name is None:
+            return
+
+        started_at = time.monotonic()
+        was_leader = self.is_leader
+        try:
+            token = self.__database.acquire_lease(self.__lease_name, self.holder, LEADER_LEASE_TTL)
+        except Exception as e:
+            # keep whatever we had, if we were the leader the lease will lapse on its own
+            logger.opt(exception=e).warning('failed to renew the leader lease')
+            return
+
+        if token is None:
+            self.__leader_until = 0.0
+            self.fencing_token = None
+            if was_leader:
+                logger.warning(f'lost leadership of {self.__lease_name}')
+            return
+
+        # leave some headroom so that we stop acting as a leader before anyone else can acquire the lease
+        self.__leader_until = started_at + LEADER_LEASE_TTL * 0.8
+        if not was_leader or token != self.fencing_token:
+            logger.info(f'became the leader of {self.__lease_name} (fencing token {token})')
+        self.fencing_token = token
 
 
 worker = Worker()
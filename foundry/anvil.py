@@ -55,3 +55,31 @@ def anvil_set_balance(
             [addr, balance],
         )
     )
+
+
+def anvil_dump_state(web3: Web3) -> str:
+    resp = web3.provider.make_request(
+        'anvil_dumpState',  # type: ignore[arg-type]
+        [],
+    )
+    check_error(resp)
+    return resp['result']
+
+
+def anvil_load_state(web3: Web3, state: str) -> None:
+    check_error(
+        web3.provider.make_request(
+            'anvil_loadState',  # type: ignore[arg-type]
+            [state],
+        )
+    )
+
+
+def anvil_reset(web3: Web3) -> None:
+    """Throws the whole chain state away, going back to genesis (or to the fork block for forks)."""
+    check_error(
+        web3.provider.make_request(
+            'anvil_reset',  # type: ignore[arg-type]
+            [],
+        )
+    )
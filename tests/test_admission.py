@@ -0,0 +1,48 @@
+import pytest
+
+from ctf_server import admission
+from ctf_server.admission import AdmissionController, AdmissionRejectedError
+from ctf_server.databases import SQLiteDatabase
+from ctf_server.types import CreateInstanceRequest
+
+
+def test_rejected_launch_leaves_the_queue(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(admission, 'ADMISSION_MAX_CONCURRENT_LAUNCHES', 1)
+    monkeypatch.setattr(admission, 'ADMISSION_MAX_TEAM_LAUNCHES_PER_MINUTE', 1)
+    database = SQLiteDatabase(':memory:')
+    # the backend is only asked for its node count when capacity is limited
+    controller = AdmissionController(database, None)  # type: ignore[arg-type]
+
+    running = CreateInstanceRequest(instance_id='running', timeout=60)
+    rejected = CreateInstanceRequest(instance_id='rejected', timeout=60, team='greedy')
+    waiting = CreateInstanceRequest(instance_id='waiting', timeout=60)
+    assert controller.admit(running, 'running') is None
+    assert controller.admit(rejected, 'rejected') is not None
+    queued = controller.admit(waiting, 'waiting')
+    assert queued is not None
+    assert queued.position == 2  # noqa: PLR2004
+
+    # the team used up its quota while its launch was queued
+    database.record_team_launch('greedy', 'elsewhere', 60)
+    with pytest.raises(AdmissionRejectedError):
+        controller.admit(rejected, 'rejected')
+
+    queued = controller.admit(waiting, 'waiting')
+    assert queued is not None
+    assert queued.position == 1
+
+
+def test_duplicate_requests_get_their_own_slot(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(admission, 'ADMISSION_MAX_CONCURRENT_LAUNCHES', 1)
+    database = SQLiteDatabase(':memory:')
+    controller = AdmissionController(database, None)  # type: ignore[arg-type]
+
+    # two connections of the same team launch the same instance
+    request = CreateInstanceRequest(instance_id='blockchain-challenge-team', timeout=60, team='team')
+    assert controller.admit(request, 'first') is None
+    assert controller.admit(request, 'second') is not None
+    assert database.count_team_launches('team', 60) == 1
+
+    controller.release('first', 1.0)
+    assert controller.admit(request, 'second') is None
+    assert database.count_team_launches('team', 60) == 2  # noqa: PLR2004
@@ -0,0 +1,78 @@
+import asyncio
+from pathlib import Path
+
+from ctf_server.fork_cache import ForkCache, ForkCacheStorage, get_cache_key
+
+
+class StubUpstream:
+    def __init__(self) -> None:
+        self.requests: list[dict] = []
+
+    async def __call__(self, request: dict) -> dict:
+        self.requests.append(request)
+        # give concurrent callers a chance to pile up on the same fetch
+        await asyncio.sleep(0.05)
+        if request['method'] == 'eth_getBlockByNumber' and request['params'][0] == '0xffffff':
+            return {'jsonrpc': '2.0', 'id': request['id'], 'result': None}
+        return {'jsonrpc': '2.0', 'id': request['id'], 'result': f'0x{len(self.requests):064x}'}
+
+
+def make_request(id_: int, method: str, *params: object) -> dict:
+    return {'jsonrpc': '2.0', 'id': id_, 'method': method, 'params': list(params)}
+
+
+def test_cache_key() -> None:
+    pinned = make_request(1, 'eth_getStorageAt', '0xAbC', '0x0', '0x10')
+    assert get_cache_key(pinned) == get_cache_key(make_request(2, 'eth_getStorageAt', '0xabc', '0x0', '0x10'))
+    assert get_cache_key(make_request(1, 'eth_getStorageAt', '0xabc', '0x0', 'latest')) is None
+    assert get_cache_key(make_request(1, 'eth_getBalance', '0xabc', {'blockHash': '0x01'})) is not None
+    assert get_cache_key(make_request(1, 'eth_blockNumber')) is None
+
+
+def test_hits_are_served_from_disk(tmp_path: Path) -> None:
+    upstream = StubUpstream()
+    request = make_request(1, 'eth_getCode', '0xabc', '0x10')
+
+    async def run() -> None:
+        first = await ForkCache(ForkCacheStorage(str(tmp_path / 'cache.sqlite3')), upstream).handle(request)
+        # a fresh cache over the same file, like another worker or a restarted service
+        cache = ForkCache(ForkCacheStorage(str(tmp_path / 'cache.sqlite3')), upstream)
+        second = await cache.handle(request | {'id': 2})
+        assert second == first | {'id': 2}
+        assert cache.hits == 1
+
+    asyncio.run(run())
+    assert len(upstream.requests) == 1
+
+
+def test_concurrent_misses_are_coalesced(tmp_path: Path) -> None:
+    upstream = StubUpstream()
+    cache = ForkCache(ForkCacheStorage(str(tmp_path / 'cache.sqlite3')), upstream)
+
+    async def run() -> list[dict]:
+        return await asyncio.gather(
+            *(cache.handle(make_request(i, 'eth_getStorageAt', '0xabc', '0x1', '0x10')) for i in range(10))
+        )
+
+    responses = asyncio.run(run())
+    assert len(upstream.requests) == 1
+    assert [response['id'] for response in responses] == list(range(10))
+    assert len({response['result'] for response in responses}) == 1
+
+
+def test_unpinned_and_null_results_are_not_cached(tmp_path: Path) -> None:
+    upstream = StubUpstream()
+    cache = ForkCache(ForkCacheStorage(str(tmp_path / 'cache.sqlite3')), upstream)
+
+    async def run() -> None:
+        for _ in range(2):
+            await cache.handle(make_request(1, 'eth_getBalance', '0xabc', 'latest'))
+            await cache.handle(make_request(1, 'eth_getBlockByNumber', '0xffffff', False))  # noqa: FBT003
+
+    asyncio.run(run())
+    assert [request['method'] for request in upstream.requests] == [
+        'eth_getBalance',
+        'eth_getBlockByNumber',
+        'eth_getBalance',
+        'eth_getBlockByNumber',
+    ]
@@ -0,0 +1,88 @@
+import pytest
+import redis
+
+from ctf_server.databases import RedisDatabase, SQLiteDatabase
+from ctf_server.databases.database import InvalidCursorError
+from ctf_server.types import UserData
+
+
+def make_instance(instance_id: str, expires_at: float, challenge: str) -> UserData:
+    return UserData(
+        instance_id=instance_id,
+        generation='0',
+        external_id=f'rpc-{instance_id}',
+        created_at=0.0,
+        expires_at=expires_at,
+        anvil_instances={},
+        daemon_instances={},
+        metadata={},
+        challenge=challenge,
+    )
+
+
+@pytest.fixture
+def database() -> SQLiteDatabase:
+    database = SQLiteDatabase(':memory:')
+    # several instances share an expiry, so that pages have to break ties by id
+    for i in range(10):
+        database.register_instance(f'i{i}', make_instance(f'i{i}', 1000.0 + i // 3, 'even' if i % 2 else 'odd'))
+    return database
+
+
+def list_all(database: SQLiteDatabase, limit: int, **filters: str | float) -> list[str]:
+    instance_ids: list[str] = []
+    cursor = None
+    while True:
+        instances, cursor = database.list_instances(cursor, limit, **filters)  # type: ignore[arg-type]
+        assert len(instances) <= limit
+        instance_ids += [instance['instance_id'] for instance in instances]
+        if cursor is None:
+            return instance_ids
+
+
+def test_pagination(database: SQLiteDatabase) -> None:
+    expected = [f'i{i}' for i in range(10)]
+    assert list_all(database, 1) == expected
+    assert list_all(database, 4) == expected
+    assert list_all(database, 10) == expected
+
+    assert list_all(database, 2, challenge='even') == ['i1', 'i3', 'i5', 'i7', 'i9']
+    assert list_all(database, 2, expires_after=1001, expires_before=1002) == ['i3', 'i4', 'i5', 'i6', 'i7', 'i8']
+
+    with pytest.raises(InvalidCursorError):
+        database.list_instances('garbage', 1)
+
+
+def test_bulk_extend_and_unregister(database: SQLiteDatabase) -> None:
+    assert database.extend_instances(['i0', 'i9', 'missing'], 100) == {'i0': 1100.0, 'i9': 1103.0}
+    assert list_all(database, 3)[-2:] == ['i0', 'i9']
+
+    unregistered = database.unregister_instances(['i0', 'i1', 'missing'], 60)
+    assert sorted(instance['instance_id'] for instance in unregistered) == ['i0', 'i1']
+    assert database.unregister_instances(['i0'], 60) == []
+    assert len(list_all(database, 3)) == 8  # noqa: PLR2004
+    assert database.count_pending_teardowns() == 2  # noqa: PLR2004
+
+
+def test_redis_indexes_existing_instances(monkeypatch: pytest.MonkeyPatch) -> None:
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, 'from_url', lambda _, **kwargs: fakeredis.FakeRedis(server=server, **kwargs))
+
+    database = RedisDatabase('redis://fake')
+    for i in range(3):
+        database.register_instance(f'i{i}', make_instance(f'i{i}', 1000.0 + i, 'old'))
+    # as left behind by a version that did not index instances by challenge
+    client = redis.Redis.from_url('redis://fake', decode_responses=True)
+    client.delete('challenge-expiries/old', 'challenge-expiries-indexed')
+
+    database = RedisDatabase('redis://fake')
+    database.register_instance('i3', make_instance('i3', 1003.0, 'old'))
+    instances, cursor = database.list_instances(None, 10, challenge='old')
+    assert [instance['instance_id'] for instance in instances] == ['i0', 'i1', 'i2', 'i3']
+    assert cursor is None
+
+    unregistered = database.unregister_instances(['i0', 'i1', 'missing'], 60)
+    assert sorted(instance['instance_id'] for instance in unregistered) == ['i0', 'i1']
+    assert database.unregister_instances(['i0'], 60) == []
+    assert database.count_pending_teardowns() == 2  # noqa: PLR2004
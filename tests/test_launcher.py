@@ -0,0 +1,51 @@
+from typing import Any
+
+import pytest
+
+from ctf_launchers import launcher
+from ctf_launchers.launcher import Launcher
+from ctf_server.types import UserData
+
+
+class FakeResponse:
+    def __init__(self, body: dict[str, Any]) -> None:
+        self.__body = body
+
+    def json(self) -> dict[str, Any]:
+        return self.__body
+
+
+def test_attached_launch_does_not_deploy(monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]) -> None:
+    user_data = UserData(
+        instance_id='blockchain-challenge-team',
+        generation='0',
+        external_id='rpc',
+        created_at=0.0,
+        expires_at=0.0,
+        anvil_instances={'main': {'id': 'main', 'ip': '127.0.0.1', 'port': 8545}},
+        daemon_instances={},
+        metadata={},
+    )
+    deployed = {
+        **user_data,
+        'metadata': {
+            'mnemonic': 'test test test test test test test test test test test junk',
+            'challenge_contracts': [{'name': 'challenge', 'address': '0x1234'}],
+        },
+    }
+    # the launch in progress is still deploying the first time we look
+    polls = iter([user_data, deployed])
+
+    monkeypatch.setattr(launcher, 'ATTACH_POLL_INTERVAL', 0)
+    monkeypatch.setattr(
+        launcher.requests,
+        'post',
+        lambda *_, **__: FakeResponse({'ok': True, 'message': '', 'data': user_data, 'attached': True}),
+    )
+    monkeypatch.setattr(launcher.requests, 'get', lambda *_, **__: FakeResponse({'ok': True, 'data': next(polls)}))
+    monkeypatch.setattr(Launcher, 'deploy', lambda *_: pytest.fail('deployed an instance someone else launched'))
+
+    challenge = Launcher('project', None)  # type: ignore[arg-type]
+    challenge.team = 'team'
+    assert challenge.launch_instance() == 0
+    assert '- challenge contract: 0x1234' in capsys.readouterr().out
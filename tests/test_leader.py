@@ -0,0 +1,18 @@
+from ctf_server.databases import SQLiteDatabase
+from ctf_server.utils import Worker
+
+
+def test_paused_leader_is_fenced() -> None:
+    database = SQLiteDatabase(':memory:')
+    leader = Worker()
+    leader.setup('test', database)
+    assert leader.is_leader
+    assert leader.still_leader()
+
+    # the lease lapses while the leader is paused, and someone else takes it over before it notices
+    database.release_lease('leader/test', leader.holder)
+    assert database.acquire_lease('leader/test', 'someone-else', 10) is not None
+
+    assert leader.is_leader
+    assert not leader.still_leader()
+    assert not leader.is_leader
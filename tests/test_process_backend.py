@@ -0,0 +1,248 @@
+import sys
+import time
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+from web3 import Web3
+
+from ctf_server.backends import backend as backend_module
+from ctf_server.backends import process_backend
+from ctf_server.backends.backend import HibernationError, InstanceExistsError
+from ctf_server.backends.process_backend import ProcessBackend
+from ctf_server.databases import SQLiteDatabase
+from ctf_server.types import CreateInstanceRequest, UserData
+from ctf_server.utils import worker
+
+
+# Answers every json-rpc request with `0x0`, and dies on `stub_crash` so that the supervisor has to restart it. Its
+# whole chain state is a single string, set through `stub_setState` and kept in the `--state` file like anvil does
+STUB_ANVIL = """\
+import json
+import os
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+args = sys.argv[1:]
+state_path = args[args.index('--state') + 1] if '--state' in args else None
+state = open(state_path).read() if state_path and os.path.exists(state_path) else ''
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        global state
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        method, params = request['method'], request.get('params', [])
+        if method == 'stub_crash':
+            os._exit(1)
+
+        result = '0x0'
+        if method == 'anvil_dumpState':
+            result = state
+        elif method in ('stub_setState', 'anvil_loadState', 'anvil_reset'):
+            if method == 'stub_setState':
+                state = params[0]
+            elif method == 'anvil_loadState':
+                # like anvil, loading a dump merges it into whatever state there already is
+                state = '+'.join(filter(None, [state, params[0]]))
+            else:
+                state = ''
+            if state_path:
+                with open(state_path, 'w') as f:
+                    f.write(state)
+
+        body = json.dumps({'jsonrpc': '2.0', 'id': request['id'], 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+HTTPServer((args[args.index('--host') + 1], int(args[args.index('--port') + 1])), Handler).serve_forever()
+"""
+
+
+def wait_for(condition: object, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():  # type: ignore[operator]
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+
+
+@pytest.fixture
+def backend(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Iterator[ProcessBackend]:
+    stub = tmp_path / 'anvil'
+    stub.write_text(f'#!{sys.executable}\n{STUB_ANVIL}')
+    stub.chmod(0o755)
+
+    monkeypatch.setattr(process_backend, 'PROCESS_ANVIL_BINARY', str(stub))
+    monkeypatch.setattr(process_backend, 'PROCESS_WORKDIR', tmp_path / 'instances')
+    monkeypatch.setattr(process_backend, 'PROCESS_TMPFS_DIR', tmp_path / 'tmpfs')
+    monkeypatch.setattr(process_backend, 'PROCESS_CGROUP_ROOT', None)
+    # act as the leader, there is no election running here
+    monkeypatch.setattr(worker, 'still_leader', lambda: True)
+
+    backend = ProcessBackend(SQLiteDatabase(':memory:'))
+    yield backend
+
+    for launch_dir in (tmp_path / 'instances').iterdir():
+        if launch_dir.name != 'ports':
+            instance_id, generation = launch_dir.name.rsplit('-', 1)
+            backend._destroy_instance(instance_id, generation, None)  # noqa: SLF001
+
+
+def test_launch_restart_and_kill(backend: ProcessBackend, tmp_path: Path) -> None:
+    started_at = time.monotonic()
+    user_data = backend.launch_instance(
+        {'instance_id': 'test', 'timeout': 60, 'anvil_instances': {'main': {'accounts': 1, 'persistence': 'disk'}}}
+    )
+    assert time.monotonic() - started_at < 5  # noqa: PLR2004
+
+    anvil = user_data['anvil_instances']['main']
+    web3 = Web3(Web3.HTTPProvider(f'http://{anvil["ip"]}:{anvil["port"]}'))
+    assert web3.is_connected()
+
+    launch_dir = tmp_path / 'instances' / f'test-{user_data["generation"]}'
+    assert (tmp_path / 'instances' / 'ports' / str(anvil['port'])).read_text() == launch_dir.name
+    assert f'--state {launch_dir}/main-state.json' in (launch_dir / 'main.sh').read_text()
+
+    # the supervisor brings a crashed anvil back up on the same port
+    with pytest.raises(OSError, match='aborted'):
+        web3.provider.make_request('stub_crash', [])  # type: ignore[arg-type]
+    wait_for(lambda: not web3.is_connected())
+    wait_for(web3.is_connected)
+
+    backend.kill_instance('test')
+    wait_for(lambda: not launch_dir.exists())
+    assert not web3.is_connected()
+    assert not (tmp_path / 'instances' / 'ports' / str(anvil['port'])).exists()
+
+
+def test_hibernation(backend: ProcessBackend) -> None:
+    user_data = backend.launch_instance(
+        {'instance_id': 'sleepy', 'timeout': 60, 'anvil_instances': {'main': {'accounts': 1, 'persistence': 'disk'}}}
+    )
+    anvil = user_data['anvil_instances']['main']
+    web3 = Web3(Web3.HTTPProvider(f'http://{anvil["ip"]}:{anvil["port"]}'))
+
+    backend.hibernate_instance('sleepy')
+    assert not web3.is_connected()
+
+    woken = backend.wake_instance('sleepy')
+    assert woken is not None
+    assert woken['anvil_instances']['main']['port'] == anvil['port']
+    assert web3.is_connected()
+
+
+def test_ports_are_not_shared(backend: ProcessBackend) -> None:
+    ports = set()
+    for i in range(3):
+        user_data = backend.launch_instance(
+            {'instance_id': f'instance-{i}', 'timeout': 60, 'anvil_instances': {'a': {'accounts': 1}, 'b': {}}}
+        )
+        ports |= {anvil['port'] for anvil in user_data['anvil_instances'].values()}
+    assert len(ports) == 6  # noqa: PLR2004
+    assert {int(claim.name) for claim in (process_backend.PROCESS_WORKDIR / 'ports').iterdir()} == ports
+
+
+def test_restart(backend: ProcessBackend) -> None:
+    user_data = backend.launch_instance({'instance_id': 'flaky', 'timeout': 60, 'anvil_instances': {'main': {}}})
+    restarted = backend.restart_instance('flaky')
+    assert restarted is not None
+    assert restarted['anvil_instances'] == user_data['anvil_instances']
+
+    anvil = restarted['anvil_instances']['main']
+    assert Web3(Web3.HTTPProvider(f'http://{anvil["ip"]}:{anvil["port"]}')).is_connected()
+
+    # a restart would wipe anvils that only keep their state in memory
+    backend.launch_instance(
+        {'instance_id': 'volatile', 'timeout': 60, 'anvil_instances': {'main': {'persistence': 'off'}}}
+    )
+    with pytest.raises(HibernationError):
+        backend.restart_instance('volatile')
+
+
+def test_reset_after_restart(backend: ProcessBackend) -> None:
+    user_data = backend.launch_instance(
+        {'instance_id': 'resettable', 'timeout': 60, 'anvil_instances': {'main': {'persistence': 'disk'}}}
+    )
+    anvil = user_data['anvil_instances']['main']
+    web3 = Web3(Web3.HTTPProvider(f'http://{anvil["ip"]}:{anvil["port"]}'))
+
+    web3.provider.make_request('stub_setState', ['deployed'])  # type: ignore[arg-type]
+    backend.snapshot_instance('resettable')
+    web3.provider.make_request('stub_setState', ['solved'])  # type: ignore[arg-type]
+
+    # the anvil comes back with its state from disk, but whatever it had in memory is gone
+    backend.hibernate_instance('resettable')
+    backend.wake_instance('resettable')
+    assert web3.provider.make_request('anvil_dumpState', [])['result'] == 'solved'  # type: ignore[arg-type]
+
+    backend.reset_instance('resettable')
+    assert web3.provider.make_request('anvil_dumpState', [])['result'] == 'deployed'  # type: ignore[arg-type]
+
+
+def test_duplicate_launches_share_the_result(backend: ProcessBackend) -> None:
+    args = CreateInstanceRequest(instance_id='twice', timeout=60, anvil_instances={'main': {}})
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        results = list(pool.map(backend.launch_or_attach_instance, [args] * 3))
+
+    assert len({user_data['generation'] for user_data, _ in results}) == 1
+    # only the launch that actually provisioned the instance goes on to deploy the challenge
+    assert sorted(attached for _, attached in results) == [False, True, True]
+    assert len([path for path in process_backend.PROCESS_WORKDIR.iterdir() if path.name.startswith('twice-')]) == 1
+
+    # once the launch is over, launching again is a conflict
+    with pytest.raises(InstanceExistsError):
+        backend.launch_instance(args)
+
+
+def test_instances_without_generation(backend: ProcessBackend) -> None:
+    # registered before launches had generations
+    legacy = UserData(
+        instance_id='legacy',
+        external_id='legacy-rpc',
+        created_at=0.0,
+        expires_at=time.time() + 60,
+        anvil_instances={},
+        daemon_instances={},
+        metadata={},
+    )
+    backend._database.register_instance('legacy', legacy)  # noqa: SLF001
+
+    # its resources are never listed, which must not be mistaken for them being gone
+    backend.reconcile()
+    assert backend._database.get_instance('legacy') is not None  # noqa: SLF001
+
+    assert backend.kill_instance('legacy') is not None
+    assert backend._database.get_instance('legacy') is None  # noqa: SLF001
+
+
+def test_failed_teardowns_are_retried(backend: ProcessBackend, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(backend_module, 'TEARDOWN_RETRY_INTERVAL', 0)
+    user_data = backend.launch_instance({'instance_id': 'stubborn', 'timeout': 60, 'anvil_instances': {'main': {}}})
+    launch_dir = process_backend.PROCESS_WORKDIR / f'stubborn-{user_data["generation"]}'
+
+    destroy = backend._destroy_instance  # noqa: SLF001
+    attempts: list[str] = []
+
+    def failing_destroy(instance_id: str, *_: str | None) -> None:
+        attempts.append(instance_id)
+        msg = 'docker is down'
+        raise RuntimeError(msg)
+
+    monkeypatch.setattr(backend, '_destroy_instance', failing_destroy)
+    backend.kill_instance('stubborn')
+    wait_for(lambda: attempts)
+    assert backend._database.count_pending_teardowns() == 1  # noqa: SLF001
+    assert launch_dir.exists()
+
+    monkeypatch.setattr(backend, '_destroy_instance', destroy)
+    backend.retry_teardowns()
+    assert backend._database.count_pending_teardowns() == 0  # noqa: SLF001
+    assert not launch_dir.exists()
@@ -0,0 +1,63 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from ctf_server import tracing
+from ctf_server.tracing import Tracer
+
+
+@pytest.fixture
+def tracer(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Tracer:
+    monkeypatch.setattr(tracing, 'TRACING_EXPORTER', 'file')
+    monkeypatch.setattr(tracing, 'TRACING_FILE', tmp_path / 'traces.jsonl')
+    return Tracer()
+
+
+def read_spans(tmp_path: Path) -> dict[str, dict]:
+    lines = (tmp_path / 'traces.jsonl').read_text().splitlines()
+    return {span['name']: span for span in map(json.loads, lines)}
+
+
+def test_nested_spans(tracer: Tracer, tmp_path: Path) -> None:
+    with tracer.span('outer', instance_id='test', skipped=None), tracer.span('inner'):
+        pass
+
+    msg = 'boom'
+    with pytest.raises(RuntimeError), tracer.span('failing'):
+        raise RuntimeError(msg)
+
+    spans = read_spans(tmp_path)
+    assert spans['inner']['trace_id'] == spans['outer']['trace_id']
+    assert spans['inner']['parent_id'] == spans['outer']['span_id']
+    assert spans['outer']['parent_id'] is None
+    assert spans['outer']['attributes'] == {'instance_id': 'test'}
+    assert spans['failing']['trace_id'] != spans['outer']['trace_id']
+    assert spans['failing']['error'] == 'RuntimeError: boom'
+
+
+def test_trace_propagation(tracer: Tracer, tmp_path: Path) -> None:
+    assert tracer.get_headers() == {}
+    with tracer.span('client'):
+        headers = tracer.get_headers()
+
+    with tracer.continue_trace(headers), tracer.span('server'):
+        pass
+    with tracer.continue_trace({'traceparent': 'garbage'}), tracer.span('untraced'):
+        pass
+
+    spans = read_spans(tmp_path)
+    assert spans['server']['trace_id'] == spans['client']['trace_id']
+    assert spans['server']['parent_id'] == spans['client']['span_id']
+    assert spans['untraced']['parent_id'] is None
+
+
+def test_histograms(tracer: Tracer) -> None:
+    tracer.histograms.observe('launch', 0.2)
+    tracer.histograms.observe('launch', 3.0)
+
+    rendered = tracer.histograms.render()
+    assert 'paradigmctf_span_duration_seconds_bucket{span="launch",le="0.1"} 0' in rendered
+    assert 'paradigmctf_span_duration_seconds_bucket{span="launch",le="0.25"} 1' in rendered
+    assert 'paradigmctf_span_duration_seconds_bucket{span="launch",le="+Inf"} 2' in rendered
+    assert 'paradigmctf_span_duration_seconds_count{span="launch"} 2' in rendered